@@ -42,6 +42,9 @@ architecture RTL of spi_ctrl is
 	constant JEDEC_ID      : std_logic_vector(7 downto 0) := X"9F";
 	constant READ_DATA     : std_logic_vector(7 downto 0) := X"03";
 	constant READ_FAST     : std_logic_vector(7 downto 0) := X"0B";
+	constant READ_SFDP     : std_logic_vector(7 downto 0) := X"5A";
+	constant READ_DATA_4B  : std_logic_vector(7 downto 0) := X"13";
+	constant READ_FAST_4B  : std_logic_vector(7 downto 0) := X"0C";
 
 	constant NO_PAYLOAD    : std_logic_vector(8 downto 0) := (others => '0');
 	type states is (Idle, Active);
@@ -149,7 +152,7 @@ begin
 						when WRITE_DISABLE =>
 							active_mode_en <= '0';
 							read_mode_en   <= '0';
-						when READ_SR1 | READ_SR2 | READ_DATA | READ_FAST | DEVICE_ID | UNIQUE_ID | JEDEC_ID =>
+						when READ_SR1 | READ_SR2 | READ_DATA | READ_FAST | READ_DATA_4B | READ_FAST_4B | READ_SFDP | DEVICE_ID | UNIQUE_ID | JEDEC_ID =>
 							read_mode_en <= '1';
 						when others =>
 							read_mode_en <= '0';
@@ -0,0 +1,504 @@
+import asyncio
+import hashlib
+import time
+import zlib
+import serial
+from flash import Flash, FlashError, VerifyError, BusyTimeout, ResponseTimeout
+from image import Image, load_image
+import sfdp
+import calibration
+
+## Coroutine counterpart of Flash.
+##
+## The port is opened non-blocking and responses are awaited on the event
+## loop (add_reader where the loop supports it, short sleeps otherwise), so
+## one loop can drive many programmers without a thread per device.
+## Frame building, timing models and compare helpers are shared with Flash;
+## every public operation is a coroutine taking an optional timeout in
+## seconds and can be cancelled. Operations on one AsyncFlash are serialized.
+## The blocking methods inherited from Flash (write, iter_read, blank_check,
+## unique_id, ...) raise FlashError, their transport does not work on the
+## non-blocking port.
+##
+##     flash = AsyncFlash()
+##     await flash.open('/dev/ttyACM0')
+##     info = await flash.get_device_info()
+##     await flash.write_hex(0, 'image.hex', 16, True, timeout=120)
+##     ranges = await flash.verify_image(0, 'image.hex')
+##     await flash.close()
+
+
+class AsyncFlash(Flash):
+    def __init__(self):
+        Flash.__init__(self)
+        self.verbose = False
+        # seconds to wait for the response of one transaction
+        self.timeout = 1.0
+        self._lock = None
+        self._dirty = False
+
+    # the blocking transport of Flash, every inherited blocking method ends
+    # up here and would spin or sleep on the event loop
+
+    def _blocking(self, *args, **kwargs):
+        raise FlashError('Blocking Flash method called on an AsyncFlash, use its coroutines')
+
+    _send = _blocking
+    _receive = _blocking
+    _drain = _blocking
+    _wait = _blocking
+
+    async def _op(self, coro, timeout):
+        async with self._lock:
+            return await asyncio.wait_for(coro, timeout)
+
+    # transport
+
+    async def _send_async(self, cmd):
+        if self._dirty:
+            await self._drain_async()
+        cmd = memoryview(cmd)
+        written = 0
+        while written < len(cmd):
+            n = self.port.write(cmd[written:])
+            if n:
+                written += n
+            else:
+                await asyncio.sleep(0.001)
+        if self.debug:
+            print('write ({}/{}): {}'.format(written, len(cmd), list(cmd)), file = self.log_file)
+
+    async def _readable(self, timeout):
+        loop = asyncio.get_event_loop()
+        try:
+            fd = self.port.fileno()
+        except (AttributeError, ValueError, OSError):
+            fd = None
+        if fd is not None:
+            ready = loop.create_future()
+            try:
+                loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+            except NotImplementedError:
+                fd = None
+        if fd is None:
+            # no reader support (Windows), poll the driver buffer
+            await asyncio.sleep(min(0.001, timeout))
+            return
+        try:
+            await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(fd)
+
+    async def _receive_async(self, size, buf = None):
+        ## like Flash._receive, fills buf while the loop serves other devices
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.timeout
+        last = loop.time() + size / self.MIN_RATE
+        if buf is None:
+            buf = bytearray(size)
+        rd = memoryview(buf)[:size]
+        got = 0
+        # let other devices run even if the response is already buffered
+        await asyncio.sleep(0)
+        while got < size:
+            n = self.port.readinto(rd[got:])
+            if n:
+                got += n
+                # late but still coming, wait for the rest
+                deadline = min(loop.time() + self.timeout, last + self.timeout)
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            await self._readable(remaining)
+        if self.debug:
+            print('read ({}/{}): {}'.format(got, size, list(rd[:got])), file = self.log_file)
+        return rd[:got]
+
+    async def _send_batch(self, batch):
+        if self.telemetry is not None:
+            batch.sent = time.time()
+        await self._send_async(batch.pending())
+
+    async def _receive_batch(self, batch):
+        rd = await self._receive_async(batch.total - batch.done, batch.buffer())
+        return batch.received(len(rd))
+
+    async def _recover(self, batch, following = 0):
+        ## see Batch.recover
+        for attempt in range(0, self.link_retries):
+            late = await self._drain_async()
+            if late != batch.total - batch.got + following:
+                batch.first = 0
+                batch.done = 0
+            following = 0
+            batch.resend = True
+            await self._send_batch(batch)
+            rsp = await self._receive_batch(batch)
+            if rsp is not None:
+                return rsp
+        received = batch.done
+        batch.first = 0
+        batch.done = 0
+        raise ResponseTimeout(self.port.port, batch.total, received, self.link_retries)
+
+    async def _drain_async(self):
+        ## waits until the bridge stops sending, then drops what arrived,
+        ## returns the number of bytes dropped
+        dropped = 0
+        while True:
+            await asyncio.sleep(self.QUIET)
+            n = self.port.in_waiting
+            if n == 0:
+                break
+            dropped += n
+            self.port.reset_input_buffer()
+        self.port.reset_input_buffer()
+        self._dirty = False
+        return dropped
+
+    async def _run(self, batch):
+        if len(batch) == 0:
+            return []
+        try:
+            await self._send_batch(batch)
+            rsp = await self._receive_batch(batch)
+            if rsp is None:
+                rsp = await self._recover(batch)
+            return rsp
+        except asyncio.CancelledError:
+            # responses may still be on the way, resync before the next one
+            self._dirty = True
+            raise
+
+    async def _transact(self, data, dummies = 0, read = False):
+        batch = self._batch()
+        batch.add(data, dummies, read)
+        rd = (await self._run(batch))[0]
+        return rd if rd is not None else b''
+
+    async def _wait_async(self, op, started = None, read = None):
+        ## same policy as Flash._wait
+        typ, tmax = self.timings[op]
+        if started is None:
+            started = time.time()
+        inband = self.inband_poll > 0 and typ <= self.INBAND_LIMIT
+        if not inband:
+            delay = typ * 0.8 - (time.time() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        interval = max(typ / 20, 0.0005)
+        polls = 0
+        while True:
+            batch = self._status_batch(inband, read)
+            elapsed = time.time() - started
+            busy, data = self._status_result(batch, await self._run(batch))
+            polls += 1
+            if not busy:
+                break
+            if polls > 1 and elapsed > tmax * 2:
+                raise BusyTimeout(op, elapsed)
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, max(typ / 8, 0.0005))
+        self._observe(op, elapsed, polls)
+        return data
+
+    async def _read_chunks(self, address, size):
+        ## async generator with the pipelining of Flash._read_stream
+        pending = None
+        spare = None
+        finished = False
+        try:
+            while size > 0 or pending is not None:
+                batch = None
+                if size > 0:
+                    n = min(self.read_chunk, size)
+                    batch = self._read_batch(address, n, spare)
+                    await self._send_batch(batch)
+                    address += n
+                    size -= n
+                if pending is not None:
+                    rsp = await self._receive_batch(pending)
+                    if rsp is None:
+                        rsp = await self._recover(pending, batch.total if batch is not None else 0)
+                        if batch is not None:
+                            await self._send_batch(batch)
+                    data = self._read_batch_data(pending, rsp)
+                    spare = pending
+                    yield data
+                pending = batch
+            finished = True
+        finally:
+            # stopped early: responses may still be on the way
+            if not finished:
+                self._dirty = True
+
+    # session
+
+    async def open(self, port, timeout = None, calibrate = False):
+        ## calibrate = True applies the link calibration Flash.open cached
+        ## for the port, if there is one
+        self.port = serial.Serial(port, write_timeout=0, timeout=0)
+        self._lock = asyncio.Lock()
+        try:
+            self._log(self.port.port)
+            await asyncio.sleep(0.1)
+            await self._op(self._transact([self.WRITE_ENA]), timeout)
+            self._apply_device(await self._op(self._discover_device_async(), timeout))
+            await self._op(self._set_address_mode_async(), timeout)
+        except BaseException:
+            # see Flash.open
+            self.port.close()
+            self.port = None
+            raise
+        if calibrate:
+            result = calibration.load(calibration.link_key(port))
+            if result is not None:
+                self._apply_calibration(result)
+
+    async def _set_address_mode_async(self):
+        ## see Flash.open
+        for mode in self._address_modes():
+            if mode != 'dedicated' or await self._probe_async(self._read_4b_batch()) is not None:
+                break
+        else:
+            raise FlashError('The bridge firmware does not return 4-byte reads and the part has no 4-byte mode')
+        self._use_address_mode(mode)
+        if mode == 'enter':
+            await self._run(self._address_mode_batch(True))
+
+    async def _probe_async(self, batch):
+        ## see Flash._probe
+        await self._send_batch(batch)
+        timeout = self.timeout
+        self.timeout = self.QUIET * 2
+        try:
+            rsp = await self._receive_batch(batch)
+        finally:
+            self.timeout = timeout
+        if rsp is None:
+            await self._drain_async()
+        return rsp
+
+    async def _read_sfdp_async(self, address, size):
+        rsp = await self._probe_async(self._sfdp_batch(address, size))
+        return self._sfdp_data(rsp) if rsp is not None else None
+
+    async def _discover_device_async(self):
+        ## see Flash._discover_device and sfdp.discover
+        jedec_id = list((await self._transact([self.JEDEC_ID], 3, True))[1:])
+        device = sfdp.load(jedec_id)
+        if device is not None:
+            return device
+        try:
+            header = await self._read_sfdp_async(0, 8)
+            if header is not None:
+                params = await self._read_sfdp_async(8, sfdp.parse_header(header) * 8)
+            if header is not None and params is not None:
+                pointer, dwords = sfdp.find_bfpt(sfdp.parse_parameters(params))
+                bfpt = await self._read_sfdp_async(pointer, dwords * 4)
+                if bfpt is not None:
+                    device = sfdp.parse_bfpt(jedec_id, bfpt)
+                    device.save()
+                    return device
+        except sfdp.SfdpError:
+            pass
+        return self._builtin_device(jedec_id)
+
+    async def close(self):
+        if self._lock is None or self.port is None:
+            # not opened, or open failed and closed the port
+            return
+        async with self._lock:
+            if self.address_mode == 'enter':
+                await self._run(self._address_mode_batch(False))
+            await self._transact([self.WRITE_DIS])
+            await asyncio.sleep(1)
+            self.port.close()
+
+    # operations
+
+    async def get_device_info(self, timeout = None):
+        async def info():
+            rd = await self._transact([self.JEDEC_ID], 3, True)
+            return self._device_info(rd[1:])
+        return await self._op(info(), timeout)
+
+    async def get_device_status(self, timeout = None):
+        async def status():
+            sr1 = await self._transact([self.READ_SR_1], 1, True)
+            sr2 = await self._transact([self.READ_SR_2], 1, True)
+            return self._device_status([sr1[1], sr2[1]])
+        return await self._op(status(), timeout)
+
+    async def erase_chip(self, timeout = None):
+        async def erase():
+            self._changed(0)
+            batch = self._batch()
+            self._write_enable(batch)
+            self._chip_erase(batch)
+            await self._run(batch)
+            started = time.time()
+            await self._wait_async('chip', started)
+        await self._op(erase(), timeout)
+
+    async def _erase_block_async(self, address, bsize):
+        ## see Flash._erase_block
+        if bsize in self.ERASE_OPS and bsize not in self.erase_types:
+            start = self._block_start_address(address, bsize)
+            await self._run_plan_async(self.plan_erase(start, 1 << bsize))
+            return
+        batch, op = self._erase_batch(address, bsize)
+        if batch is None:
+            return
+        self._changed(self._block_start_address(address, bsize), 1 << bsize)
+        await self._run(batch)
+        started = time.time()
+        await self._wait_async(op, started)
+
+    async def _run_plan_async(self, plan):
+        for address, op in plan:
+            if op == 'chip':
+                self._changed(0)
+                batch = self._batch()
+                self._write_enable(batch)
+                self._chip_erase(batch)
+                await self._run(batch)
+                started = time.time()
+                await self._wait_async('chip', started)
+            else:
+                await self._erase_block_async(address, self.ERASE_SIZES[op])
+
+    async def erase_range(self, address, size, timeout = None):
+        ## erases the 4K sectors of [address, address + size) with the plan
+        ## of Flash.plan_erase and returns it
+        plan = self.plan_erase(address, size)
+        await self._op(self._run_plan_async(plan), timeout)
+        return plan
+
+    async def erase_chip_partial(self, start_addr, bsize, bcount, timeout = None):
+        ## bsize in bytes, 4K or 64K like Flash.erase_chip_partial
+        async def erase(start_addr, bcount):
+            while bcount > 0:
+                await self._erase_block_async(start_addr, 12 if bsize == 4*1024 else 16)
+                start_addr += bsize
+                bcount -= 1
+        await self._op(erase(start_addr, bcount), timeout)
+
+    async def _page_program_async(self, address, data):
+        verify = self.verify == 'page'
+        size = len(data)
+        start = 0
+        self._changed(address, size)
+        mask = self.page_size - 1
+        while size > 0:
+            real_size = min((address | mask) - address + 1, size)
+            retries = 0
+            while True:
+                batch = self._program_batch(address, data[start:start + real_size])
+                await self._run(batch)
+                # see Flash._page_program
+                started = time.time()
+                page = await self._wait_async('page', started, (address & ~mask, self.page_size) if verify else None)
+                if not verify:
+                    break
+                offset = address & mask
+                if page[offset:offset + real_size] == bytes(data[start:start + real_size]):
+                    break
+                retries += 1
+                if retries > self.retries:
+                    raise VerifyError(address, 'page', self.retries)
+            address += real_size
+            start += real_size
+            size -= real_size
+
+    async def _read_all(self, address, size):
+        chunks = []
+        async for rd in self._read_chunks(address, size):
+            chunks.append(rd)
+        return b''.join(chunks)
+
+    async def _update_block_async(self, address, data, bsize):
+        ## see Flash._update_block
+        start = self._block_start_address(address, bsize)
+        old = await self._read_all(start, 1 << bsize)
+        new = bytearray(old)
+        new[address - start:address - start + len(data)] = bytes(data)
+        if new == old:
+            return 'skipped'
+        o = int.from_bytes(old, 'big')
+        n = int.from_bytes(new, 'big')
+        if (o & n) == n:
+            action = 'programmed'
+        else:
+            action = 'erased'
+            await self._erase_block_async(start, bsize)
+            old = b'\xFF' * len(old)
+        step = self.page_size
+        for page in range(0, len(new), step):
+            if new[page:page + step] != old[page:page + step]:
+                await self._page_program_async(start + page, new[page:page + step])
+        return action
+
+    async def write_hex(self, address, hexfile, bsize = None, erasing = False, incremental = False, timeout = None):
+        ## same arguments and verify policy as Flash.write_hex, without its
+        ## journal and device index; the units of Flash._write_units are
+        ## planned on the event loop instead of a pipeline thread, a unit is
+        ## erased just before its blocks are programmed
+        image = hexfile if isinstance(hexfile, Image) else load_image(hexfile)
+        if bsize is None:
+            bsize = 12 if incremental else 8
+        # (address, size, sha256) of every segment, see Flash._write_units
+        runs = []
+        units = self._write_units(image, address, bsize, erasing and not incremental, set(), self._erase_costs(), runs)
+
+        async def write():
+            written = 0
+            for erase, blocks in units:
+                await self._run_plan_async([(a, op) for step, a, op in erase])
+                for index, block_address, block, crc, kept in blocks:
+                    retries = 0
+                    while True:
+                        if incremental:
+                            await self._update_block_async(block_address, block, bsize)
+                        elif erasing and retries > 0:
+                            # see Flash._program_units
+                            await self._update_block_async(block_address, block, max(bsize, 12))
+                        else:
+                            await self._page_program_async(block_address, block)
+                        if self.verify != 'block':
+                            break
+                        if zlib.crc32(await self._read_all(block_address, len(block))) == crc:
+                            break
+                        retries += 1
+                        if retries > self.retries:
+                            raise VerifyError(block_address, 'block', self.retries)
+                    written += len(block)
+            if self.verify == 'image':
+                for run_address, run_size, digest in runs:
+                    retries = 0
+                    while hashlib.sha256(await self._read_all(run_address, run_size)).digest() != digest:
+                        retries += 1
+                        if retries > self.retries:
+                            raise VerifyError(run_address, 'image', self.retries)
+            return written
+        return await self._op(write(), timeout)
+
+    async def read(self, address, size, timeout = None):
+        return await self._op(self._read_all(address, size), timeout)
+
+    async def verify_image(self, address, image, timeout = None):
+        ## returns the mismatching [start, end) ranges like Flash.verify_image
+        image = image if isinstance(image, Image) else load_image(image)
+
+        async def verify():
+            ranges = []
+            for offset, data in image.segments:
+                pos = 0
+                async for rd in self._read_chunks(address + offset, len(data)):
+                    self._merge_ranges(ranges, self._diff_ranges(address + offset + pos, data[pos:pos + len(rd)], rd))
+                    pos += len(rd)
+            return ranges
+        return await self._op(verify(), timeout)
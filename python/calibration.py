@@ -0,0 +1,61 @@
+import re
+import json
+import time
+import os
+from journal import state_path
+
+## Link calibration of a bridge port.
+##
+## Flash.calibrate() times harmless reads over a sweep of read frame sizes
+## and batch depths, and status polls of several lengths, and keeps the
+## fastest settings. How fast a setting is depends on the host USB stack and
+## the bridge build (XO2 BoB, XO3LF starter kit), so the result is cached
+## per port and USB VID:PID under STATE_DIR/calibration and later sessions
+## start tuned:
+##
+##     flash.open('/dev/ttyACM0', calibrate = True)  # measured once, then loaded
+##
+## Delete the file to measure again.
+
+# data bytes per read frame tried, capped by what a frame can carry
+FRAMES = [64, 128, 256, 384, 511]
+# read frames per USB write tried
+DEPTHS = [8, 32, 128]
+# status bytes per in-band poll tried
+POLLS = [16, 32, 64, 128, 256, 480]
+
+
+def link_key(port):
+    ## port name and VID:PID of the USB device behind it, as a file name
+    vid = None
+    pid = None
+    try:
+        from serial.tools import list_ports
+        for p in list_ports.comports():
+            if p.device == port:
+                vid, pid = p.vid, p.pid
+    except ImportError:
+        pass
+    name = re.sub('[^A-Za-z0-9]+', '_', port).strip('_')
+    if vid is None or pid is None:
+        return name
+    return '{}-{:04x}_{:04x}'.format(name, vid, pid)
+
+
+def load(key):
+    ## the cached result for key, None if there is none
+    try:
+        with open(state_path('calibration', key + '.json'), mode='rt') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save(key, result):
+    path = state_path('calibration', key + '.json')
+    result = dict(result)
+    result['time'] = time.time()
+    tmp = path + '.tmp'
+    with open(tmp, mode='wt') as f:
+        json.dump(result, f, indent=1)
+    os.replace(tmp, path)
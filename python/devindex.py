@@ -0,0 +1,89 @@
+import os
+import json
+import time
+from journal import state_path
+
+## Content index of the devices programmed on this host.
+##
+## For every device, keyed by its unique ID, the index keeps a digest of
+## every 4K sector as it was last programmed and verified. write_hex uses
+## it to leave out the sectors that already hold the image, and the state
+## of a known board can be told without reading it back. Any program or
+## erase through a Flash the index is attached to drops the sectors it
+## touches; changes made elsewhere are caught by spot checks of a few
+## sampled sectors (see Flash.write_hex).
+##
+##     index = DeviceIndex(flash.unique_id())
+##     flash.write_hex(0, 'image.hex', erasing = True, index = index)
+
+SECTOR = 0x1000
+
+
+class DeviceIndex:
+    def __init__(self, uid, path = None):
+        self.uid = uid
+        self.path = path if path is not None else state_path('index', uid + '.json')
+        # sector address -> digest of the sector content
+        self.sectors = {}
+        self.image = None
+        self.time = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, mode='rt') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.sectors = dict([(int(a), d) for a, d in state.get('sectors', {}).items()])
+        self.image = state.get('image')
+        self.time = state.get('time')
+
+    def save(self):
+        state = {
+            'uid': self.uid,
+            'image': self.image,
+            'time': self.time,
+            'sectors': dict([(str(a), d) for a, d in self.sectors.items()])
+        }
+        tmp = self.path + '.tmp'
+        with open(tmp, mode='wt') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+    def __len__(self):
+        return len(self.sectors)
+
+    def get(self, sector):
+        return self.sectors.get(sector)
+
+    def record(self, sector, digest):
+        self.sectors[sector] = digest
+
+    def invalidate(self, address, size = None):
+        ## Flash listener: the content of [address, address + size) changes,
+        ## the whole device without a size
+        if size is None:
+            self.sectors.clear()
+            return
+        first = address & ~(SECTOR - 1)
+        for sector in range(first, address + size, SECTOR):
+            self.sectors.pop(sector, None)
+
+    def clear(self):
+        self.sectors.clear()
+
+    def written(self, name):
+        ## notes the image last written, for reports
+        self.image = name
+        self.time = time.time()
+
+    def ranges(self):
+        ## [start, end) address ranges of the known sectors
+        ranges = []
+        for sector in sorted(self.sectors):
+            if len(ranges) > 0 and ranges[-1][1] == sector:
+                ranges[-1][1] = sector + SECTOR
+            else:
+                ranges.append([sector, sector + SECTOR])
+        return [(start, end) for start, end in ranges]
@@ -1,7 +1,227 @@
 import serial
 import time
-import os
+import re
+import struct
+import zlib
+import hashlib
+import functools
+import random
 from progressbar import ProgressBar
+from image import Image, load_image, stream_image, estimate_size
+from pipeline import Pipeline
+import sfdp
+import calibration
+
+class FlashError(Exception):
+    pass
+
+class BusyTimeout(FlashError):
+    def __init__(self, op, elapsed):
+        FlashError.__init__(self, 'Flash still busy after {:.3f}s ({})'.format(elapsed, op))
+        self.op = op
+        self.elapsed = elapsed
+
+class VerifyError(FlashError):
+    def __init__(self, address, mode, retries):
+        FlashError.__init__(self, 'Verification failed at 0x{:06x} ({} verify, {} retries)'.format(address, mode, retries))
+        self.address = address
+        self.mode = mode
+
+class TransportError(FlashError):
+    pass
+
+class LinkError(TransportError):
+    ## the serial port failed (unplugged, closed, driver error)
+    def __init__(self, port, error):
+        TransportError.__init__(self, '{}: {}'.format(port, error))
+        self.port = port
+        self.error = error
+
+class ResponseTimeout(TransportError):
+    ## the bridge did not send the whole response in time, also after the
+    ## missing frames were requested again
+    def __init__(self, port, expected, received, retries):
+        TransportError.__init__(self, 'No complete response from {}: {}/{} bytes after {} retries'.format(port, received, expected, retries))
+        self.port = port
+        self.expected = expected
+        self.received = received
+
+# frame header: opcode, payload length
+_HEADER = struct.Struct('<BH')
+# dummy bytes clocked out after a command, the same 0, 1, 2, ... sequence
+# the bridge always got
+_DUMMIES = bytes(range(256)) * 2
+
+def _phase(name):
+    ## counts the transactions of a Flash method for the operation name
+    ## when telemetry is enabled
+    def wrap(method):
+        @functools.wraps(method)
+        def run(self, *args, **kwargs):
+            if self.telemetry is None:
+                return method(self, *args, **kwargs)
+            with self.telemetry.phase(name):
+                return method(self, *args, **kwargs)
+        return run
+    return wrap
+
+class _NoBar:
+    ## stands in for ProgressBar when Flash.verbose is off
+
+    def update(self, value):
+        pass
+
+    def finish(self):
+        pass
+
+
+class Batch:
+    ## Collects several bridge frames (opcode, 16-bit length, payload) and
+    ## sends them to the bridge in one USB write. The bridge answers only
+    ## frames flagged as read, so the combined response is split back per
+    ## frame in the same order.
+    ## Frames are built in one bytearray and the response is read into a
+    ## buffer owned by the batch; the responses are memoryviews into it and
+    ## stay valid until the batch is received again.
+    ## A short response keeps the frames that came back complete when the
+    ## missing bytes only came late; only the rest of the batch is sent
+    ## again (see recover). If bytes were lost on the way every later frame
+    ## is shifted, the whole batch is sent again then.
+    ## A batch may end with a check frame whose response is known (the
+    ## JEDEC ID after the reads of Flash._read_batch): a complete response
+    ## that does not end with it is shifted by lost bytes, and filled up
+    ## with the response of the next batch in flight.
+
+    def __init__(self, flash):
+        self.flash = flash
+        self.cmd = bytearray()
+        self.sizes = []
+        # start of every frame in cmd
+        self.offsets = []
+        self.total = 0
+        self.rx = None
+        # while recovering: first frame still to send, response bytes kept
+        # and response bytes received in all
+        self.first = 0
+        self.done = 0
+        self.got = 0
+        # (frame, expected response after the opcode byte) of the check frame
+        self.check = None
+        # for telemetry: send time and whether this is a repeated request
+        self.sent = 0.0
+        self.resend = False
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, data, dummies = 0, read = False):
+        self.offsets.append(len(self.cmd))
+        self.flash._frame_into(self.cmd, data, dummies)
+        size = len(self.cmd) - self.offsets[-1] - 2 if read else 0
+        self.sizes.append(size)
+        self.total += size
+        return len(self.sizes) - 1
+
+    def send(self):
+        if self.flash.telemetry is not None:
+            self.sent = time.time()
+        self.flash._send(self.pending())
+
+    def pending(self):
+        ## the frames to send, all of them unless a short response is resumed
+        if self.first == 0:
+            return self.cmd
+        return memoryview(self.cmd)[self.offsets[self.first]:]
+
+    def buffer(self):
+        ## where the response to pending() goes
+        if self.rx is None:
+            self.rx = bytearray(self.total)
+        return memoryview(self.rx)[self.done:]
+
+    def receive(self):
+        rd = self.flash._receive(self.total - self.done, self.buffer())
+        return self.received(len(rd))
+
+    def received(self, n):
+        ## n bytes arrived in buffer(), returns the responses or None if some
+        ## are missing; the frames that came back complete are kept
+        if self.flash.telemetry is not None:
+            self.record(n)
+        got = self.done + n
+        self.got = got
+        if got == self.total:
+            self.first = 0
+            self.done = 0
+            rsp = self.split(self.rx)
+            if self.check is None or bytes(rsp[self.check[0]][1:]) == self.check[1]:
+                return rsp
+            # shifted: nothing of it can be kept
+            self.got = 0
+            return None
+        i = self.first
+        while i < len(self.sizes) and self.done + self.sizes[i] <= got:
+            self.done += self.sizes[i]
+            i += 1
+        self.first = i
+        return None
+
+    def recover(self, following = 0):
+        ## after a short response: waits until the link is quiet, drops the
+        ## partial frame and requests the missing frames again
+        ## following is the size of the responses of batches sent after this
+        ## one, which the resync drops as well; the complete frames are kept
+        ## only if the bytes dropped are exactly the ones missing
+        for attempt in range(0, self.flash.link_retries):
+            late = self.flash._drain()
+            if late != self.total - self.got + following:
+                self.first = 0
+                self.done = 0
+            following = 0
+            self.resend = True
+            self.send()
+            rsp = self.receive()
+            if rsp is not None:
+                return rsp
+        received = self.done
+        self.first = 0
+        self.done = 0
+        raise ResponseTimeout(self.flash.port.port, self.total, received, self.flash.link_retries)
+
+    def record(self, received):
+        self.flash.telemetry.transaction(self.cmd[0], len(self.sizes) - self.first, len(self.pending()),
+                                         received, self.total - self.done, time.time() - self.sent, self.resend)
+
+    def split(self, rd):
+        ## returns None if the response came back short
+        if len(rd) != self.total:
+            return None
+        rd = memoryview(rd)
+        rsp = []
+        offset = 0
+        for size in self.sizes:
+            if size > 0:
+                rsp.append(rd[offset:offset + size])
+                offset += size
+            else:
+                rsp.append(None)
+        return rsp
+
+    def readdress(self, index, address):
+        ## points a frame that starts with an address at another address
+        ## without building it again, address is from Flash._address2bytes
+        start = self.offsets[index] + _HEADER.size
+        self.cmd[start:start + len(address)] = bytes(address)
+
+    def run(self):
+        if len(self.sizes) == 0:
+            return []
+        self.send()
+        rsp = self.receive()
+        if rsp is None:
+            rsp = self.recover()
+        return rsp
+
 
 class Flash:
     # W25Q32 instructions
@@ -27,12 +247,69 @@ class Flash:
     JEDEC_ID = 0x9F
     READ_DATA = 0x03
     READ_DATA_FAST = 0x0B
-    
-    BLOCK_SIZE_WR = 64
-    BLOCK_SIZE_RD = 64
+    READ_SFDP = 0x5A
+    # 4-byte address instructions of parts over 16MB
+    ENTER_4B = 0xB7
+    EXIT_4B = 0xE9
+    READ_DATA_4B = 0x13
+    READ_DATA_FAST_4B = 0x0C
+    PAGE_PROG_4B = 0x12
+    ERASE_4B = {
+        0x20: 0x21,
+        0x52: 0x5C,
+        0xD8: 0xDC
+    }
+
+    # spi_ctrl keeps a 9-bit transfer length, only bit 0 of the length MSB
+    # is used, so one frame carries at most 511 bytes after the opcode
+    MAX_PAYLOAD = 511
+    # units of write_hex planned ahead of the one being programmed
+    PIPELINE_DEPTH = 2
+
+    # data bytes requested per USB write by the streaming reader, by
+    # default; calibrate() tunes Flash.read_chunk
+    READ_CHUNK = 0x10000
+
+    # typical and maximum operation times in seconds (W25Q32 datasheet)
+    TIMINGS = {
+        'page': (0.0007, 0.003),
+        'erase_4k': (0.045, 0.4),
+        'erase_32k': (0.12, 1.6),
+        'erase_64k': (0.15, 2.0),
+        'chip': (10.0, 50.0),
+        'wrsr': (0.01, 0.015)
+    }
+    # operations shorter than this are polled in-band
+    INBAND_LIMIT = 0.005
+    # slowest response rate still accepted in bytes/s, the receive deadline
+    # grows with the response size
+    MIN_RATE = 100000
+    # silence on the link that ends a resync
+    QUIET = 0.05
+    # host side cost of one erase command (USB round-trips) in seconds
+    ERASE_OVERHEAD = 0.002
+
+    ERASE_SIZES = {
+        'erase_4k': 12,
+        'erase_32k': 15,
+        'erase_64k': 16
+    }
+    ERASE_OPS = {
+        12: 'erase_4k',
+        15: 'erase_32k',
+        16: 'erase_64k'
+    }
+    SECTOR = 0x1000
+    BLANK_SECTOR = b'\xFF' * 0x1000
 
     Manufacturer_IDs = {
+        0x01: "Spansion",
+        0x1F: "Adesto",
         0x20: "Micron",
+        0x9D: "ISSI",
+        0xBF: "SST",
+        0xC2: "Macronix",
+        0xC8: "GigaDevice",
         0xEF: "Winbond"
     }
 
@@ -42,52 +319,183 @@ class Flash:
     0x16: '32M',
     0x17: '64M',
     0x18: '128M',
-    0x19: '256M'
+    0x19: '256M',
+    0x20: '512M',
+    0x21: '1G',
+    0x22: '2G'
     }
 
     def __init__(self):
         self.port = None
         self.debug = False
         self.verbose = True
+        # stream of messages and progress bars, stdout by default
+        self.log_file = None
+        # program verify policy: 'none', 'page' (compare every page),
+        # 'block' (CRC of every block) or 'image' (digest of the whole image)
+        self.verify = 'page'
+        self.retries = 3
+        # [typical, maximum] per operation, the typical time follows what is
+        # observed on this part; observed keeps (count, total, longest)
+        self.timings = dict([(op, list(t)) for op, t in self.TIMINGS.items()])
+        self.observed = {}
+        # status bytes per in-band poll, 0 disables in-band polling
+        self.inband_poll = 256
+        # data bytes per read frame (at most what a frame carries) and per
+        # read batch, see calibrate()
+        self.read_frame = self.MAX_PAYLOAD
+        self.read_chunk = self.READ_CHUNK
+        # telemetry.Telemetry recording every transaction, None disables it
+        self.telemetry = None
+        # seconds of silence before a response is short, and how often the
+        # missing part of a response is requested again
+        self.timeout = 1.0
+        self.link_retries = 3
+        # sectors changed by write() and not flushed yet: address -> (old, new)
+        self._sectors = {}
+        # most sectors held by write() before they are flushed
+        self.write_buffer = 64
+        # indexed sectors read back to check a device index before use
+        self.index_samples = 2
+        # callbacks (address, size) run before the flash content changes,
+        # size None for the whole chip
+        self._listeners = []
+        # sfdp.Descriptor of the part, set by open(); until then the values
+        # below are the W25Q32 ones
+        self.device = None
+        self.page_size = 256
+        # erase opcode per erase unit size in bits
+        self.erase_types = {12: self.SECTOR_ERASE_4K, 15: self.BLOCK_ERASE_32K, 16: self.BLOCK_ERASE_64K}
+        # dummy bytes after the address of a fast read
+        self.read_dummies = 1
+        # how addresses past 16MB are reached (see _address_modes) and the
+        # opcodes that go with it
+        self.address_mode = None
+        self.addr_bytes = 3
+        self.read_opcode = self.READ_DATA
+        self.fast_read_opcode = self.READ_DATA_FAST
+        self.program_opcode = self.PAGE_PROG
 
-    def _write(self, data, dummies, read = False):
-        for x in range(0, dummies):
-            data.append(x & 0xFF)
+    def add_listener(self, callback):
+        self._listeners.append(callback)
 
-        cmd = [data[0]]
-        cmd.append((len(data) - 1) & 0xFF)
-        cmd.append(((len(data) - 1) >> 8) & 0xFF)
-        cmd.extend(data[1:])
-        
-        while(True):
-            written = self.port.write(bytes(cmd))
+    def remove_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _changed(self, address, size = None):
+        for callback in self._listeners:
+            callback(address, size)
+
+    def _log(self, msg):
+        if self.verbose:
+            print(msg, file = self.log_file)
+
+    def _progress(self, max_value):
+        if self.verbose:
+            if self.log_file is not None:
+                return ProgressBar(max_value=max_value, fd=self.log_file).start()
+            return ProgressBar(max_value=max_value).start()
+        return _NoBar()
+
+    def _frame_into(self, cmd, data, dummies):
+        ## appends the frame of data followed by dummies dummy bytes to the
+        ## bytearray cmd
+        length = len(data) - 1 + dummies
+        cmd += _HEADER.pack(data[0], length)
+        cmd += bytes(data[1:]) if isinstance(data, list) else data[1:]
+        while dummies > 0:
+            n = min(dummies, len(_DUMMIES))
+            cmd += _DUMMIES[:n]
+            dummies -= n
+
+    def _frame(self, data, dummies):
+        cmd = bytearray()
+        self._frame_into(cmd, data, dummies)
+        return cmd
+
+    def _send(self, cmd):
+        ## the port is opened with write_timeout=0, so a long batch may be
+        ## accepted partially; keep writing until the whole buffer is out
+        cmd = memoryview(cmd)
+        written = 0
+        deadline = time.time() + self.timeout
+        try:
+            while written < len(cmd):
+                n = self.port.write(cmd[written:])
+                if n:
+                    written += n
+                    deadline = time.time() + self.timeout
+                elif time.time() > deadline:
+                    raise LinkError(self.port.port, 'write stalled at {}/{} bytes'.format(written, len(cmd)))
+                else:
+                    time.sleep(0.001)
             self.port.flush()
-        
-            if self.debug:
-                print('write ({}/{}): {}'.format(written, len(cmd), cmd))
-        
-            rd = []
-            size = written
-            if read :
-                rd = self.port.read(written - 2)
-                if len(rd) == written - 2:
-                    break;
-                    
-                #while len(rd) < written - 2:
-                #    rd.extend(self.port.read())
+        except serial.SerialException as e:
+            raise LinkError(self.port.port, e)
 
-            else:
-                break;
-                
         if self.debug:
-            if read:
-                print('read ({}/{}): {}'.format(len(rd), written - 2, rd))
-                
-        return rd
+            print('write ({}/{}): {}'.format(written, len(cmd), list(cmd)), file = self.log_file)
+
+        return written
+
+    def _receive(self, size, buf = None):
+        ## reads size bytes into buf (a new buffer if None), returns a
+        ## memoryview of what arrived; a late response is read on as long as
+        ## bytes keep coming, it is short only after self.timeout of silence
+        ## or when the whole deadline for size bytes has passed
+        if size == 0:
+            return b''
+        if buf is None:
+            buf = bytearray(size)
+        rd = memoryview(buf)[:size]
+        got = 0
+        deadline = time.time() + self.timeout + size / self.MIN_RATE
+        try:
+            while got < size:
+                n = self.port.readinto(rd[got:])
+                if not n:
+                    break
+                got += n
+                if time.time() > deadline:
+                    break
+        except serial.SerialException as e:
+            raise LinkError(self.port.port, e)
+        if self.debug:
+            print('read ({}/{}): {}'.format(got, size, list(rd[:got])), file = self.log_file)
+        return rd[:got]
+
+    def _drain(self):
+        ## resynchronizes after a short response: waits until the bridge has
+        ## been quiet for QUIET seconds and drops whatever arrived late,
+        ## returns the number of bytes dropped
+        dropped = 0
+        try:
+            while True:
+                time.sleep(self.QUIET)
+                n = self.port.in_waiting
+                if n == 0:
+                    break
+                dropped += len(self.port.read(n))
+            self.port.reset_input_buffer()
+        except serial.SerialException as e:
+            raise LinkError(self.port.port, e)
+        return dropped
+
+    def _write(self, data, dummies, read = False, batch = None):
+        if batch is not None:
+            return batch.add(data, dummies, read)
+        batch = self._batch()
+        batch.add(data, dummies, read)
+        rd = batch.run()[0]
+        return rd if rd is not None else b''
+
+    def _batch(self):
+        return Batch(self)
 
-    def _write_enable(self):
+    def _write_enable(self, batch = None):
         data = [self.WRITE_ENA]
-        self._write(data, 0)
+        self._write(data, 0, batch = batch)
 
     def _write_disable(self):
         data = [self.WRITE_DIS]
@@ -109,66 +517,247 @@ class Flash:
     def _set_status(self, status):
         data = [self.WRITE_SR, status[0], status[1]]
         self._write(data, 0)
+        self._wait('wrsr')
 
     def _address2bytes(self, address):
         ba = []
+        if self.addr_bytes == 4:
+            ba.append((address >> 24) & 0xFF)
         ba.append((address >> 16) & 0xFF)
         ba.append((address >> 8) & 0xFF)
         ba.append((address) & 0xFF)
         return ba
 
     def _read_data(self, address, size):
-        data = [self.READ_DATA]
+        data = [self.read_opcode]
         data.extend(self._address2bytes(address))
         rd = self._write(data, size, True)
-        return rd[4:]
+        return rd[1 + self.addr_bytes:]
 
     def _read_data_fast(self, address, size):
-        data = [self.READ_DATA_FAST]
+        data = [self.fast_read_opcode]
         data.extend(self._address2bytes(address))
-        rd = self._write(data, size + 1, True)
-        return rd[5:]
+        rd = self._write(data, size + self.read_dummies, True)
+        return rd[1 + self.addr_bytes + self.read_dummies:]
+
+    def _read_batch(self, address, size, batch = None):
+        ## batch is a spare read batch of the same size, its frames and
+        ## buffers are reused with the new addresses
+        step = min(self.read_frame, self.MAX_PAYLOAD - self.addr_bytes - self.read_dummies)
+        if batch is not None and batch.size == size and batch.step == step:
+            batch.address = address
+            for i in range(0, batch.count):
+                batch.readdress(i, self._address2bytes(address + i * step))
+            return batch
+        batch = self._batch()
+        batch.address = address
+        batch.size = size
+        batch.step = step
+        while size > 0:
+            n = min(step, size)
+            data = [self.fast_read_opcode]
+            data.extend(self._address2bytes(address))
+            batch.add(data, n + self.read_dummies, True)
+            address += n
+            size -= n
+        batch.count = len(batch)
+        if self.device is not None:
+            batch.check = (batch.add([self.JEDEC_ID], 3, True), bytes(self.device.jedec_id))
+        return batch
+
+    def _read_batch_data(self, batch, rsp):
+        return b''.join([rd[1 + self.addr_bytes + self.read_dummies:] for rd in rsp[:batch.count]])
+
+    def _read_stream(self, address, size, chunk = None):
+        ## yields the range in chunks of read_chunk bytes, the request for
+        ## the next chunk is sent before the current one is received, so the
+        ## link keeps streaming while the caller consumes the data
+        if chunk is None:
+            chunk = self.read_chunk
+        pending = None
+        batch = None
+        # two batches take turns, one in flight while the other is received
+        spare = None
+        try:
+            while size > 0 or pending is not None:
+                batch = None
+                if size > 0:
+                    n = min(chunk, size)
+                    batch = self._read_batch(address, n, spare)
+                    batch.send()
+                    address += n
+                    size -= n
+                if pending is not None:
+                    rsp = pending.receive()
+                    if rsp is None:
+                        # short response: the resync drops the next chunk in
+                        # flight as well, it is requested again after the
+                        # missing part of this one
+                        rsp = pending.recover(batch.total if batch is not None else 0)
+                        if batch is not None:
+                            batch.send()
+                    data = self._read_batch_data(pending, rsp)
+                    spare = pending
+                    yield data
+                pending = batch
+        except GeneratorExit:
+            # closed early, the next chunk is still on the way
+            if batch is not None:
+                self._drain()
+            raise
 
+    @_phase('program')
     def _page_program(self, address, data):
+        ## with verify = 'page' every page is read back in the same round-trip
+        ## as the status poll and compared with the data written, a page that
+        ## does not match is programmed again up to self.retries times
+        verify = self.verify == 'page'
         size = len(data)
         start = 0
+        self._changed(address, size)
+        mask = self.page_size - 1
         while size > 0:
-            real_size = 0
+            page_size = (address | mask) - address + 1
+            real_size = min(page_size, size)
+            retries = 0
             while True:
-                self._write_enable()
-                page_size = (address | 0xFF) - address + 1
-                real_size = min(page_size, size)
-                real_size = min(256, real_size)
-                wr_data = [self.PAGE_PROG]
-                wr_data.extend(self._address2bytes(address))
-                wr_data.extend(data[start:start + real_size])
-                self._write(wr_data, 0)
-                while self._isbusy():
-                    time.sleep(0.01)
-                if not self._isPageErased(address):
+                batch = self._program_batch(address, data[start:start + real_size])
+                batch.run()
+                # timed from when the frames are out, not from before a
+                # possibly stalled USB write
+                started = time.time()
+                # status poll and page read back share one round-trip,
+                # the read back is valid once the status is not busy
+                page = self._wait('page', started, (address & ~mask, self.page_size) if verify else None)
+                if not verify:
                     break
-            
+                offset = address & mask
+                if page[offset:offset + real_size] == bytes(data[start:start + real_size]):
+                    break
+                retries += 1
+                if retries > self.retries:
+                    raise VerifyError(address, 'page', self.retries)
+
             address += real_size
             start += real_size
             size -= real_size
-            
 
-    def _sector_erase(self, address):
-        data = [self.SECTOR_ERASE_4K]
-        data.extend(self._address2bytes(address))
-        self._write(data, 0)
+    def _program_batch(self, address, data):
+        # write enable and page program go out in one USB write,
+        # neither of them produces a response
+        batch = self._batch()
+        self._write_enable(batch)
+        wr_data = bytearray([self.program_opcode])
+        wr_data += bytes(self._address2bytes(address))
+        wr_data.extend(data)
+        self._write(wr_data, 0, batch = batch)
+        return batch
 
-    def _block_erase(self, address, block64K=True):
-        if block64K:
-            data = [self.BLOCK_ERASE_64K]
+    def _poll_status(self, inband = False, read = None):
+        ## one round-trip status poll, returns (busy, data)
+        ## with inband = True READ_SR_1 is held for inband_poll dummy bytes,
+        ## the flash repeats the status for every byte, so the poll covers the
+        ## time the bridge needs to clock the whole frame
+        ## read = (address, size) appends a data read, which is only valid if
+        ## the status was not busy
+        batch = self._status_batch(inband, read)
+        return self._status_result(batch, batch.run())
+
+    def _status_batch(self, inband, read):
+        batch = self._batch()
+        batch.sr1 = batch.add([self.READ_SR_1], self.inband_poll if inband else 1, True)
+        batch.rd = None
+        if read is not None:
+            batch.rd = batch.add([self.read_opcode] + self._address2bytes(read[0]), read[1], True)
+        return batch
+
+    def _status_result(self, batch, rsp):
+        busy = (rsp[batch.sr1][-1] & 1) != 0
+        return busy, rsp[batch.rd][1 + self.addr_bytes:] if batch.rd is not None else None
+
+    def _wait(self, op, started = None, read = None, progress = None):
+        ## waits for op started at time started to complete, started is
+        ## taken once its frames are written
+        ## sleeps most of the typical time, then polls with a doubling
+        ## interval; short operations are polled in-band right away
+        ## the observed time tunes the typical time of op
+        ## BusyTimeout only follows a busy poll sent after twice the maximum
+        ## time, never the first poll, which a stalled host may send late
+        typ, tmax = self.timings[op]
+        if started is None:
+            started = time.time()
+        inband = self.inband_poll > 0 and typ <= self.INBAND_LIMIT
+        if not inband:
+            delay = typ * 0.8 - (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+        interval = max(typ / 20, 0.0005)
+        polls = 0
+        while True:
+            # the status is sampled when the poll goes out, a late response
+            # must not count as busy time
+            elapsed = time.time() - started
+            busy, data = self._poll_status(inband, read)
+            polls += 1
+            if not busy:
+                break
+            if progress is not None:
+                progress(elapsed)
+            if polls > 1 and elapsed > tmax * 2:
+                raise BusyTimeout(op, elapsed)
+            time.sleep(interval)
+            interval = min(interval * 2, max(typ / 8, 0.0005))
+
+        self._observe(op, elapsed, polls)
+        return data
+
+    def _observe(self, op, elapsed, polls):
+        typ, tmax = self.timings[op]
+        if polls == 1:
+            # done at the first poll, the typical time was too pessimistic
+            self.timings[op][0] = typ * 0.8
         else:
-            data = [self.BLOCK_ERASE_32K]
+            self.timings[op][0] = min(tmax, typ + (elapsed - typ) / 4)
+        count, total, longest = self.observed.get(op, (0, 0.0, 0.0))
+        self.observed[op] = (count + 1, total + elapsed, max(longest, elapsed))
+        if self.telemetry is not None:
+            self.telemetry.wait(op, elapsed, polls)
+
+    @_phase('verify')
+    def _crc(self, address, size):
+        crc = 0
+        for rd in self._read_stream(address, size):
+            crc = zlib.crc32(rd, crc)
+        return crc
+
+    @_phase('verify')
+    def _digest(self, address, size):
+        digest = hashlib.sha256()
+        for rd in self._read_stream(address, size):
+            digest.update(rd)
+        return digest.digest()
+
+    def _erase_type(self, bsize):
+        ## the erase opcode of the part for bsize units, SFDP parts may
+        ## lack the 32K or 64K erase
+        if bsize not in self.erase_types:
+            raise FlashError('The part has no {}K erase, it erases {}'.format(
+                (1 << bsize) >> 10, ', '.join(['{}K'.format((1 << b) >> 10) for b in self._erase_sizes()])))
+        return self.erase_types[bsize]
+
+    def _sector_erase(self, address, batch = None):
+        data = [self._erase_type(12)]
         data.extend(self._address2bytes(address))
-        self._write(data, 0)
+        self._write(data, 0, batch = batch)
+
+    def _block_erase(self, address, block64K=True, batch = None):
+        data = [self._erase_type(16 if block64K else 15)]
+        data.extend(self._address2bytes(address))
+        self._write(data, 0, batch = batch)
 
-    def _chip_erase(self):
+    def _chip_erase(self, batch = None):
         data = [self.CHIP_ERASE]
-        self._write(data, 0)
+        self._write(data, 0, batch = batch)
 
     def _suspend_erase(self):
         data = [self.ERASE_SUSPEND]
@@ -192,28 +781,22 @@ class Flash:
         return rd[4:]
 
     def _get_chip_size(self):
-        rd = self._read_id()
-        if rd[1] == 0x13:
-            return 1048576
-        elif rd[1] == 0x14:
-            return 2097152
-        elif rd[1] == 0x15:
-            return 4194304
-        else:
-            return 0
+        return self.get_chip_size()
             
     def _isPageErased(self, address):
         address &= 0xFFFFFF00;
         rd = self._read_data(address, 256);
-        for d in rd:
-            if d != 0xFF:
-                return False;
-        return True;
+        return self._isErased(rd)
+
+    def _isErased(self, rd):
+        return bytes(rd) == b'\xFF' * len(rd)
 
     def _read_iniq_id(self):
+        ## 4 dummy bytes before the ID, 5 while the part is in 4-byte mode
+        dummies = 5 if self.address_mode in ('enter', 'always') else 4
         data = [self.READ_UNIQ_ID]
-        rd = self._write(data, 12, True)
-        return rd[5:]
+        rd = self._write(data, dummies + 8, True)
+        return rd[1 + dummies:]
 
     def _read_jedec_id(self):
         data = [self.JEDEC_ID]
@@ -224,26 +807,219 @@ class Flash:
         sts = self._get_status_1()
         return True if (sts & 1) > 0 else False
         
-    def _ascii2hex(self, hex_data):
-        hex_array = hex_data.split(' ')
-        bin_data = []
-        for hex in hex_array:
-            try:
-                bin_data.append(int(hex, 16))
-            except ValueError:
-                pass
-        return bin_data
-
-
-    def open(self, port):
-        self.port = serial.Serial(port, write_timeout=0, timeout=1)
-        print(self.port.port)
-        time.sleep(0.1)
-        self._write_enable()
+    def open(self, port, calibrate = False):
+        ## calibrate = True tunes the link with the result cached for the
+        ## port, measured first if there is none (see calibrate())
+        try:
+            self.port = serial.Serial(port, write_timeout=0, timeout=self.timeout)
+        except serial.SerialException as e:
+            raise LinkError(port, e)
+        try:
+            self._log(self.port.port)
+            time.sleep(0.1)
+            self._write_enable()
+            self._apply_device(self._discover_device())
+            for mode in self._address_modes():
+                # the 4-byte reads need a bridge firmware that answers them
+                if mode != 'dedicated' or self._probe(self._read_4b_batch()) is not None:
+                    break
+            else:
+                raise FlashError('The bridge firmware does not return 4-byte reads and the part has no 4-byte mode')
+            self._use_address_mode(mode)
+            if mode == 'enter':
+                self._address_mode_batch(True).run()
+            if calibrate:
+                key = calibration.link_key(port)
+                result = calibration.load(key)
+                if result is None:
+                    result = self.calibrate()
+                    calibration.save(key, result)
+                else:
+                    self._apply_calibration(result)
+        except BaseException:
+            # the caller gets no Flash to close
+            self.port.close()
+            self.port = None
+            raise
+
+    def calibrate(self, size = 0x20000):
+        ## times reads of the first size bytes for every read frame size and
+        ## batch depth of calibration.FRAMES and DEPTHS, and status polls of
+        ## calibration.POLLS bytes; applies the fastest read settings and the
+        ## shortest in-band poll that spans a typical page program
+        ## returns the result, which open() caches per port
+        self.flush()
+        self._log('Calibrating the link...')
+        latency = self._round_trip(1)
+        limit = self.MAX_PAYLOAD - self.addr_bytes - self.read_dummies
+        rates = []
+        for frame in sorted(set([min(f, limit) for f in calibration.FRAMES])):
+            for depth in calibration.DEPTHS:
+                self.read_frame = frame
+                started = time.time()
+                for rd in self._read_stream(0, size, frame * depth):
+                    pass
+                rates.append([frame, depth, size / (time.time() - started) / 1e6])
+        frame, depth, mbps = max(rates, key = lambda r: r[2])
+        # the in-band poll covers the page program when its last status byte
+        # is clocked after the typical page time
+        polls = [(n, self._round_trip(n)) for n in calibration.POLLS]
+        inband = [n for n, rtt in polls if rtt >= self.timings['page'][0]]
+        result = {
+            'latency': latency,
+            'read_frame': frame,
+            'read_chunk': frame * depth,
+            'mbps': mbps,
+            'inband_poll': inband[0] if len(inband) > 0 else polls[-1][0],
+            'rates': rates,
+            'polls': [[n, rtt] for n, rtt in polls]
+        }
+        self._apply_calibration(result)
+        self._log('Round-trip {:.2f} ms, reads {:.2f} MB/s with {} byte frames x {}, in-band poll {} bytes'.format(
+            latency * 1e3, mbps, frame, depth, result['inband_poll']))
+        return result
+
+    def _round_trip(self, size, count = 9):
+        ## median time of a status read of size bytes
+        times = []
+        for i in range(0, count):
+            batch = self._batch()
+            batch.add([self.READ_SR_1], size, True)
+            started = time.time()
+            batch.run()
+            times.append(time.time() - started)
+        return sorted(times)[count // 2]
+
+    def _apply_calibration(self, result):
+        self.read_frame = result['read_frame']
+        self.read_chunk = result['read_chunk']
+        self.inband_poll = result['inband_poll']
+
+    def _address_modes(self):
+        ## how this part is addressed, in order of preference: None - 3 byte
+        ## addresses reach everything; 'always' - the part takes 4 bytes
+        ## only; 'dedicated' - the 4-byte opcodes, nothing to undo; 'enter'
+        ## - standard opcodes in 4-byte mode (B7), left again on close (E9)
+        ## since the FPGA boots with 3-byte reads
+        device = self.device
+        if device.address_mode == '4' or 'always' in device.four_byte:
+            return ['always']
+        if device.size <= 1 << 24:
+            return [None]
+        modes = []
+        if 'dedicated' in device.four_byte and all([op in self.ERASE_4B for op in self.erase_types.values()]):
+            modes.append('dedicated')
+        if 'enter' in device.four_byte:
+            modes.append('enter')
+        return modes
+
+    def _use_address_mode(self, mode):
+        self.address_mode = mode
+        self.addr_bytes = 3 if mode is None else 4
+        if mode == 'dedicated':
+            self.read_opcode = self.READ_DATA_4B
+            self.fast_read_opcode = self.READ_DATA_FAST_4B
+            self.program_opcode = self.PAGE_PROG_4B
+            self.erase_types = dict([(bits, self.ERASE_4B[op]) for bits, op in self.erase_types.items()])
+        else:
+            self.read_opcode = self.READ_DATA
+            self.fast_read_opcode = self.READ_DATA_FAST
+            self.program_opcode = self.PAGE_PROG
+
+    def _read_4b_batch(self):
+        batch = self._batch()
+        batch.add([self.READ_DATA_4B, 0, 0, 0, 0], 1, True)
+        batch.add([self.JEDEC_ID], 3, True)
+        return batch
+
+    def _address_mode_batch(self, enter):
+        ## write enable first, some parts need it for B7 and E9
+        batch = self._batch()
+        self._write_enable(batch)
+        self._write([self.ENTER_4B if enter else self.EXIT_4B], 0, batch = batch)
+        return batch
+
+    def _discover_device(self):
+        ## descriptor of the part: cached per JEDEC ID, read from SFDP, or
+        ## the built-in W25Q32 values if the table cannot be read
+        jedec_id = list(self._read_jedec_id())
+        device = sfdp.load(jedec_id)
+        if device is None:
+            device = sfdp.discover(jedec_id, self._read_sfdp)
+            if device is not None:
+                device.save()
+            else:
+                device = self._builtin_device(jedec_id)
+        return device
+
+    def _builtin_device(self, jedec_id):
+        ## W25Q values; the parts over 16MB of the makers listed have both
+        ## the 4-byte mode and the 4-byte opcodes
+        size = self._capacity_size(jedec_id[2])
+        return sfdp.Descriptor(jedec_id, size, 256,
+                               {12: self.SECTOR_ERASE_4K, 15: self.BLOCK_ERASE_32K, 16: self.BLOCK_ERASE_64K},
+                               self.TIMINGS, (self.READ_DATA_FAST, 8), '3' if size <= 1 << 24 else '3or4',
+                               ['enter', 'dedicated'] if size > 1 << 24 else [], 'builtin')
+
+    def _apply_device(self, device):
+        ## tunes page size, erase commands, timings and reads to the part
+        self.device = device
+        # a page program frame carries at most MAX_PAYLOAD - 4 data bytes,
+        # bigger pages are programmed in 256 byte parts
+        self.page_size = min(device.page_size, 256)
+        # the planner knows 64K, 32K and 4K units; 4K sectors are assumed
+        # all over (write buffer, device index), every SFDP part has them
+        self.erase_types = dict([(bits, op) for bits, op in device.erase.items() if bits in self.ERASE_OPS])
+        self.erase_types.setdefault(12, self.SECTOR_ERASE_4K)
+        for op, t in device.timings.items():
+            if op in self.timings:
+                self.timings[op] = list(t)
+        self.read_dummies = device.fast_read[1] // 8
+
+    def _sfdp_batch(self, address, size):
+        ## READ_SFDP frames of size bytes at address and a JEDEC ID read,
+        ## a firmware without READ_SFDP answers only the JEDEC ID
+        batch = self._batch()
+        step = self.MAX_PAYLOAD - 4
+        while size > 0:
+            n = min(step, size)
+            # always 3 address bytes and 8 dummy clocks
+            batch.add([self.READ_SFDP, (address >> 16) & 0xFF, (address >> 8) & 0xFF, address & 0xFF], 1 + n, True)
+            address += n
+            size -= n
+        batch.add([self.JEDEC_ID], 3, True)
+        return batch
+
+    def _sfdp_data(self, rsp):
+        return b''.join([bytes(rd[5:]) for rd in rsp[:-1]])
+
+    def _read_sfdp(self, address, size):
+        ## size bytes of the SFDP table, None if the bridge firmware does not
+        ## answer READ_SFDP (spi_ctrl before READ_SFDP was a read command)
+        rsp = self._probe(self._sfdp_batch(address, size))
+        return self._sfdp_data(rsp) if rsp is not None else None
+
+    def _probe(self, batch):
+        ## runs a batch with reads an older bridge firmware may not answer,
+        ## returns the responses or None if they did not all come
+        batch.send()
+        # the short answer of an old firmware is all there is, it is not
+        # waited for as long as a late response
+        timeout = self.timeout
+        self.timeout = self.port.timeout = self.QUIET * 2
+        try:
+            rsp = batch.receive()
+        finally:
+            self.timeout = self.port.timeout = timeout
+        if rsp is None:
+            self._drain()
+        return rsp
         
 
     def get_device_info(self):
-        dev_id = self._read_jedec_id()
+        return self._device_info(self._read_jedec_id())
+
+    def _device_info(self, dev_id):
         info = {}
         if dev_id[0] in self.Manufacturer_IDs:
             info['Manufacturer ID'] = [self.Manufacturer_IDs[dev_id[0]], dev_id[0]]
@@ -252,12 +1028,17 @@ class Flash:
         info['Memory Type'] = [dev_id[1], dev_id[1]]
         if dev_id[2] in self.Capacity_IDs:
             info['Capacity'] = [self.Capacity_IDs[dev_id[2]], dev_id[2]]
+        elif self.device is not None and self.device.source == 'sfdp':
+            # in Mbit like the names above
+            info['Capacity'] = ['{}M'.format((self.device.size * 8) >> 20), dev_id[2]]
         else:
             info['Capacity'] = ['Unknown', dev_id[2]]
         return info
 
     def get_device_status(self):
-        sts = self._get_status()
+        return self._device_status(self._get_status())
+
+    def _device_status(self, sts):
         status = {
             'BUSY' : sts[0] & 1,
             'Write Enable Latch' : (sts[0] >> 1) & 1,
@@ -271,42 +1052,195 @@ class Flash:
         return status
         
     def get_chip_size(self):
+        ## in bytes, from the device descriptor; before open() from the
+        ## capacity code, which is log2 of the size in bytes
+        if self.device is not None:
+            return self.device.size
         id = self._read_jedec_id()
-        return pow(2, (id[2] + 3))
+        return self._capacity_size(id[2])
+
+    def _capacity_size(self, code):
+        # 0x19 (256M) is followed by 0x20 (512M)
+        return 1 << (code - 6 if code >= 0x20 else code)
 
+    @_phase('erase')
     def erase_chip(self):
-        print('Chip erasing...')
-        self._write_enable()
-        self._chip_erase()
-        bar = ProgressBar(max_value=80).start()
-        i = 0
-        while self._isbusy():
-            time.sleep(1)
-            if i < 80:
-                i = i + 1
-            bar.update(i)
+        self.flush()
+        self._log('Chip erasing...')
+        self._changed(0)
+        batch = self._batch()
+        self._write_enable(batch)
+        self._chip_erase(batch)
+        batch.run()
+        started = time.time()
+        # the bar runs over the typical chip erase time
+        typ = self.timings['chip'][0]
+        bar = self._progress(100)
+        self._wait('chip', started, progress = lambda elapsed: bar.update(min(99, int(100 * elapsed / typ))))
         bar.finish()
-        print('Chip erased.')
+        self._log('Chip erased.')
         
+    @_phase('erase')
     def erase_chip_partial(self, start_addr, bsize, bcount):
-        print('Partial chip erasing...')
-        bar = ProgressBar(max_value=bcount).start()
+        self.flush()
+        self._log('Partial chip erasing...')
+        bar = self._progress(bcount)
         i = 0
         while bcount > 0:
-            self._write_enable()
-            if bsize == 4*1024:
-                self._sector_erase(start_addr)
-            else:
-                self._block_erase(start_addr)
+            # _erase_block erases a 64K block of a part without 64K erase
+            # in smaller units
+            self._erase_block(start_addr, 12 if bsize == 4*1024 else 16)
             bar.update(i)
             i = i + 1
             bcount = bcount - 1
             start_addr = start_addr + bsize
-            while self._isbusy():
-                time.sleep(0.05)
         bar.finish()
-        print('Chip erased')
+        self._log('Chip erased')
         
+    @_phase('blank')
+    def blank_check(self, address, size, fill = 0xFF, first = False):
+        ## checks that [address, address + size) holds only fill bytes
+        ## (0xFF for erased flash), chunks are compared as whole buffers
+        ## with first = True the scan stops at the first other byte and its
+        ## address is returned, None if the range is blank
+        ## otherwise returns one flag per 4K sector touched by the range,
+        ## starting with the sector of address, True if the sector is used
+        self.flush()
+        base = address >> 12
+        used = [False] * (((address + size + self.SECTOR - 1) >> 12) - base)
+        pattern = bytes([fill]) * self.read_chunk
+        bar = self._progress(max(1, size))
+        done = 0
+        stream = self._read_stream(address, size)
+        for rd in stream:
+            n = len(rd)
+            if rd != pattern[:n]:
+                if first:
+                    stream.close()
+                    bar.finish()
+                    return address + n - len(rd.lstrip(pattern[:1]))
+                a = address
+                while a < address + n:
+                    e = min((a | (self.SECTOR - 1)) + 1, address + n)
+                    if not used[(a >> 12) - base] and rd[a - address:e - address] != pattern[:e - a]:
+                        used[(a >> 12) - base] = True
+                    a = e
+            address += n
+            done += n
+            bar.update(done)
+        bar.finish()
+        return None if first else used
+
+    def _erase_cost(self, op):
+        return self.timings[op][0] + self.ERASE_OVERHEAD
+
+    def _erase_costs(self):
+        return dict([(op, self._erase_cost(op)) for op in self.ERASE_OPS.values()])
+
+    def _plan_block(self, address, bsize, used, base, costs, keep = None):
+        ## cheapest way to erase the used sectors of one aligned block: the
+        ## block itself or the best plans of its 32K/4K parts; a block with
+        ## a keep sector is only erased whole at the smallest erase size
+        op = self.ERASE_OPS[bsize]
+        first = (address - base) >> 12
+        if used is not None and not any(used[first:first + (1 << (bsize - 12))]):
+            return [], 0.0
+        kept = keep and [s in keep for s in range(address, address + (1 << bsize), self.SECTOR)]
+        if kept and all(kept):
+            return [], 0.0
+        whole = [(address, op)]
+        cost = costs[op]
+        sizes = self._erase_sizes()
+        if bsize == sizes[-1]:
+            return whole, cost
+        if kept and any(kept):
+            cost = float('inf')
+        sub = sizes[sizes.index(bsize) + 1]
+        plan = []
+        sub_cost = 0.0
+        for a in range(address, address + (1 << bsize), 1 << sub):
+            p, c = self._plan_block(a, sub, used, base, costs, keep)
+            plan += p
+            sub_cost += c
+        if cost <= sub_cost:
+            return whole, cost
+        return plan, sub_cost
+
+    def _erase_sizes(self):
+        ## erase unit sizes of the part in bits, biggest first
+        return sorted(self.erase_types, reverse = True)
+
+    def plan_erase(self, address, size, used = None, chip_ratio = None, chip_size = None, costs = None, keep = None):
+        ## covers [address, address + size), rounded out to 4K sectors, with
+        ## the fewest and fastest erase commands: 64K blocks in the middle,
+        ## 32K/4K at unaligned edges, as far as the part has these sizes
+        ## used is an optional per sector map from blank_check, sectors that
+        ## are already blank are left out of the plan
+        ## if chip_ratio is given the range covers at least that part of a
+        ## chip of chip_size bytes and a chip erase is faster, the plan is a
+        ## single chip erase, which erases outside the range as well
+        ## costs is op -> seconds, the current typical times by default
+        ## keep is an optional set of sector addresses to leave alone: no
+        ## 32K/64K block over one of them is chosen, only the smallest erase
+        ## unit of the part may still cover one together with a used sector
+        ## returns [(address, op)] with op one of the timings keys
+        if costs is None:
+            costs = self._erase_costs()
+        start = address & ~(self.SECTOR - 1)
+        end = (address + size + self.SECTOR - 1) & ~(self.SECTOR - 1)
+        plan = []
+        cost = 0.0
+        a = start
+        while a < end:
+            for bsize in self._erase_sizes():
+                if (a & ((1 << bsize) - 1)) == 0 and a + (1 << bsize) <= end:
+                    break
+            p, c = self._plan_block(a, bsize, used, start, costs, keep)
+            plan += p
+            cost += c
+            a += 1 << bsize
+        if chip_ratio is not None and chip_size and not keep:
+            if end - start >= chip_ratio * chip_size and self._erase_cost('chip') < cost:
+                return [(0, 'chip')]
+        return plan
+
+    @_phase('erase')
+    def erase_range(self, address, size, skip_blank = False, chip_ratio = None):
+        ## erases [address, address + size) rounded out to 4K sectors using
+        ## plan_erase; skip_blank reads the range first and leaves blank
+        ## sectors alone; returns the executed plan
+        self.flush()
+        start = address & ~(self.SECTOR - 1)
+        end = (address + size + self.SECTOR - 1) & ~(self.SECTOR - 1)
+        used = self.blank_check(start, end - start) if skip_blank else None
+        chip_size = self.get_chip_size() if chip_ratio is not None else None
+        plan = self.plan_erase(start, end - start, used, chip_ratio, chip_size)
+        counts = dict([(op, len([1 for a, o in plan if o == op])) for op in ('chip', 'erase_64k', 'erase_32k', 'erase_4k')])
+        self._log('Erasing 0x{:06x} - 0x{:06x}: {chip} chip, {erase_64k} x 64K, {erase_32k} x 32K, {erase_4k} x 4K'.format(start, end - 1, **counts))
+        self._run_plan(plan, self._progress(max(1, len(plan))))
+        return plan
+
+    @_phase('erase')
+    def _run_plan(self, plan, bar = None, done = None):
+        ## done(i) is called after the i-th command
+        for i, (address, op) in enumerate(plan):
+            if op == 'chip':
+                self._changed(0)
+                batch = self._batch()
+                self._write_enable(batch)
+                self._chip_erase(batch)
+                batch.run()
+                started = time.time()
+                self._wait('chip', started)
+            else:
+                self._erase_block(address, self.ERASE_SIZES[op])
+            if done is not None:
+                done(i)
+            if bar is not None:
+                bar.update(i + 1)
+        if bar is not None:
+            bar.finish()
+
     def _block_start_address(self, address, bsize):
         bsize_mask = 0xFFFFFFFF & (~((1 << bsize) - 1))
         return address & bsize_mask
@@ -316,65 +1250,344 @@ class Flash:
         return address | bsize_mask
 
 
-    def write_hex(self, address, hexfile, bsize = None, erasing = False):
-        ## if erasing = True bsize must be either 12(4KB), 15(32KB) or 16(64KB),
-        ## otherwise erasing will be passed
+    def _erase_batch(self, address, bsize):
+        ## write enable and erase of one bsize unit, returns (batch, op)
+        ## bsize must be an erase type of the part among 12(4KB), 15(32KB)
+        ## and 16(64KB), otherwise (None, None) is returned
+        if bsize not in self.erase_types:
+            return None, None
+        batch = self._batch()
+        self._write_enable(batch)
+        data = [self.erase_types[bsize]]
+        data.extend(self._address2bytes(address))
+        self._write(data, 0, batch = batch)
+        return batch, self.ERASE_OPS[bsize]
+
+    @_phase('erase')
+    def _erase_block(self, address, bsize):
+        ## for other bsize values than 12, 15 or 16 erasing will be passed;
+        ## a 32K/64K unit the part has no erase for is erased in the
+        ## smaller units it has
+        if bsize in self.ERASE_OPS and bsize not in self.erase_types:
+            start = self._block_start_address(address, bsize)
+            self._run_plan(self.plan_erase(start, 1 << bsize))
+            return
+        batch, op = self._erase_batch(address, bsize)
+        if batch is None:
+            return
+        self._changed(self._block_start_address(address, bsize), 1 << bsize)
+        batch.run()
+        started = time.time()
+        #waiting until erasing is done
+        self._wait(op, started)
+
+    def _update_block(self, address, data, bsize):
+        ## differential programming of one erase unit: the unit is read back
+        ## and merged with data, then it is either skipped, programmed
+        ## without erasing (only 1->0 bit changes) or erased and reprogrammed
+        start = self._block_start_address(address, bsize)
+        old = b''.join(self._read_stream(start, 1 << bsize))
+        new = bytearray(old)
+        new[address - start:address - start + len(data)] = bytes(data)
+        return self._apply_block(start, old, new, bsize)
+
+    def _apply_block(self, start, old, new, bsize):
+        ## brings the unit at start from old to new content
+        if new == old:
+            return 'skipped'
+        o = int.from_bytes(old, 'big')
+        n = int.from_bytes(new, 'big')
+        if (o & n) == n:
+            action = 'programmed'
+        else:
+            action = 'erased'
+            self._erase_block(start, bsize)
+            old = b'\xFF' * len(old)
+        step = self.page_size
+        for page in range(0, len(new), step):
+            if new[page:page + step] != old[page:page + step]:
+                self._page_program(start + page, new[page:page + step])
+        return action
+
+    def _verify_digest(self, address, size, digest):
+        ## a mismatch is read again before failing to rule out a link error
+        retries = 0
+        while self._digest(address, size) != digest:
+            retries += 1
+            if retries > self.retries:
+                raise VerifyError(address, 'image', self.retries)
+
+    @_phase('program')
+    def write_hex(self, address, hexfile, bsize = None, erasing = False, incremental = False, journal = None, index = None):
+        ## hexfile is a path or an already loaded image.Image
+        ## if erasing = True the 4K sectors under the image are erased with
+        ## the fewest commands plan_erase finds, unit by unit just before the
+        ## unit is programmed
+        ## if incremental = True every erase unit of bsize is read back first
+        ## and only rewritten when it differs, erasing is decided per unit
+        ## journal is a journal.Journal: the erases and blocks done are
+        ## recorded in it and a run of the same image on the same device
+        ## skips what an interrupted run already did
+        ## index is a devindex.DeviceIndex of this device: sectors it knows
+        ## to hold the image already are neither erased nor programmed,
+        ## after a few sampled ones were read back and found as indexed
+        ## the image goes through a pipeline (see pipeline.py): a background
+        ## thread parses it (a hex text path while it is read), plans the
+        ## erases and cuts the blocks of the next units while this thread
+        ## erases and programs the current one
+        self.flush()
+        updated = {'skipped': 0, 'programmed': 0, 'erased': 0}
+        if not isinstance(hexfile, Image) and (journal is not None or index is not None):
+            # the journal key and the index need the whole image first
+            hexfile = load_image(hexfile)
+        image = hexfile if isinstance(hexfile, Image) else None
+        self._log('Writing {} to 0x{:06x}'.format(image.name if image is not None else hexfile, address))
+        if bsize is None:
+            bsize = 12 if incremental else 8 # default bsize is a page size
+        sectors = None
+        keep = set()
+        if index is not None:
+            sectors = self._image_sectors(image, address)
+            keep = self._indexed_sectors(index, sectors)
+        # one plan for the whole run, the typical times change while it goes
+        costs = self._erase_costs()
+        erasing_units = erasing and not incremental
+        done = 0
+        if journal is not None and journal.begin(self._journal_key(image, address, bsize, erasing, incremental)):
+            units = list(self._write_units(image, address, bsize, erasing_units, keep, costs, []))
+            if self._journal_valid(journal, units):
+                self._log('Resuming: {} erases and {} blocks done before'.format(journal.erased, journal.programmed))
+                done = journal.programmed
+            else:
+                self._log('The device does not match the journal, starting over')
+                journal.reset()
+        if index is not None:
+            self.add_listener(index.invalidate)
+        # (address, size, sha256) of every segment, filled by the producer
+        runs = []
+        size = image.size if image is not None else estimate_size(hexfile)
+        pipeline = Pipeline(self._write_units(hexfile, address, bsize, erasing_units, keep, costs, runs), self.PIPELINE_DEPTH)
+        try:
+            written = self._program_units(pipeline, bsize, erasing, incremental, journal, done, updated, size)
+        except BaseException:
+            # interrupted, keep what is done for the next run
+            if journal is not None and journal.key is not None:
+                journal.save()
+            raise
+        finally:
+            pipeline.close()
+            if index is not None:
+                self.remove_listener(index.invalidate)
+                index.save()
+        if self.debug:
+            print('pipeline: the device waited {:.3f}s for data'.format(pipeline.waited), file = self.log_file)
+        if self.verify == 'image':
+            for run_address, run_size, digest in runs:
+                self._verify_digest(run_address, run_size, digest)
+        if journal is not None:
+            journal.finish()
+        if index is not None:
+            # the image is in place and verified as far as self.verify asks,
+            # sectors whose whole content is known go to the index; with
+            # verify = 'none' only those read back as expected
+            for sector, (content, whole) in sectors.items():
+                if whole or erasing_units:
+                    digest = self._sector_digest(content)
+                    if self.verify == 'none' and self._device_digest(sector) != digest:
+                        continue
+                    index.record(sector, digest)
+            index.written(image.name)
+            index.save()
+            if len(keep) > 0:
+                self._log('Sectors already in place: {}'.format(len(keep)))
+        if incremental:
+            self._log('Blocks skipped: {skipped}, programmed: {programmed}, erased and programmed: {erased}'.format(**updated))
+        self._log('Writing finished.')
+        return written
+
+    def _write_units(self, source, address, bsize, erasing, keep, costs, runs):
+        ## producer stage of write_hex, runs on the pipeline thread and does
+        ## not touch the port: yields (erase, blocks) for every aligned
+        ## window of the biggest erase size (or bsize if that is bigger) the
+        ## image has data in; erase is [(step, address, op)], blocks is
+        ## [(index, address, data, crc, kept)] numbered in the order of
+        ## Image.blocks, crc only for verify = 'block'
+        ## runs collects (address, size, sha256) of the segments for
+        ## verify = 'image'
+        shift = max([bsize] + self._erase_sizes())
+        segments = source.segments if isinstance(source, Image) else stream_image(source)
+        # contiguous [address, [pieces]] of the current window
+        parts = []
+        step = 0
+        index = 0
+        for offset, data in segments:
+            runs.append((address + offset, len(data), hashlib.sha256(data).digest() if self.verify == 'image' else None))
+            for piece_address, piece in Image([(offset, data)]).blocks(address, shift):
+                if len(parts) > 0 and piece_address >> shift != parts[0][0] >> shift:
+                    unit = self._write_unit(parts, bsize, erasing, keep, costs, step, index)
+                    step += len(unit[0])
+                    index += len(unit[1])
+                    yield unit
+                    parts = []
+                if len(parts) > 0 and parts[-1][0] + sum([len(p) for p in parts[-1][1]]) == piece_address:
+                    parts[-1][1].append(piece)
+                else:
+                    parts.append([piece_address, [piece]])
+        if len(parts) > 0:
+            yield self._write_unit(parts, bsize, erasing, keep, costs, step, index)
+
+    def _write_unit(self, parts, bsize, erasing, keep, costs, step, index):
+        ## the erase plan and blocks of one window, see _write_units
+        pieces = []
+        used = set()
+        for start, chunks in parts:
+            data = chunks[0] if len(chunks) == 1 else memoryview(b''.join(chunks))
+            pieces += Image([(0, data)]).blocks(start, bsize)
+            used.update(range(start & ~(self.SECTOR - 1), start + len(data), self.SECTOR))
+        plan = []
+        used -= keep
+        if erasing and len(used) > 0:
+            first = min(used)
+            end = max(used) + self.SECTOR
+            # kept sectors and the gaps between the parts, which hold data
+            # outside the image, are left out of the erase blocks
+            spared = set(range(first, end, self.SECTOR)) - used
+            plan = self.plan_erase(first, end - first, [s in used for s in range(first, end, self.SECTOR)], costs = costs, keep = spared)
+        # a kept sector the smallest erase unit takes with a used neighbour
+        # is programmed again
+        for a, op in plan:
+            keep = keep - set(range(a, a + (1 << self.ERASE_SIZES[op]), self.SECTOR))
+        verify = self.verify == 'block'
+        erase = [(step + i, a, op) for i, (a, op) in enumerate(plan)]
+        blocks = [(index + i, a, data, zlib.crc32(data) if verify else None, self._kept(keep, a, len(data)))
+                  for i, (a, data) in enumerate(pieces)]
+        return erase, blocks
+
+    def _program_units(self, units, bsize, erasing, incremental, journal, done, updated, size):
+        ## device stage of write_hex: erases and programs the units as they
+        ## come, returns the bytes written
         written = 0
-        with open(hexfile, mode='rt') as hex:
-            print('Writing {} to 0x{:06x}'.format(hexfile, address))
-            bar = ProgressBar(max_value=os.path.getsize(hexfile)).start()
-            if bsize is None:
-                bsize = 8 # default bsize is a page size
-            hex_bytes = 0
-            bin_data = []
-            while True:
-                # update progess bar
-                bar.update(hex_bytes)
-                # read a data block from hex file
-                while len(bin_data) < (1 << bsize):
-                    hx = hex.readline()
-                    hx = hx[:-1]
-                    if len(hx) > 0:
-                        hx += ' '
-                        hex_bytes += len(hx)
-                    if len(hx) == 0:
-                        break
+        erased = journal.erased if journal is not None else 0
+        bar = self._progress(max(1, size))
+        for erase, blocks in units:
+            # a unit that has a block done was erased before that block
+            started = len(blocks) > 0 and blocks[0][0] < done
+            for step, a, op in erase:
+                if step < erased or started:
+                    continue
+                self._run_plan([(a, op)])
+                if journal is not None:
+                    journal.update(erased = step + 1)
+            for index, block_address, block, crc, kept in blocks:
+                if index < done or kept:
+                    # done by an interrupted run or already on the device
+                    written += len(block)
+                    if incremental and index >= done:
+                        updated['skipped'] += 1
+                    continue
+                retries = 0
+                while True:
+                    if incremental:
+                        # erase and program only what differs
+                        action = self._update_block(block_address, block, bsize)
+                    elif erasing and retries > 0:
+                        # a failed block is rewritten with its sector: the
+                        # rest of the sector is read back and programmed again
+                        # if the sector has to be erased
+                        self._update_block(block_address, block, max(bsize, 12))
                     else:
-                        bin_data.extend(self._ascii2hex(hx))
-                        
-                # write a data block to flash
-                if len(bin_data) > 0:
-                    # align a data block to block size
-                    size = self._block_end_address(address, bsize) - address + 1
-                    # erasing current block or segment if enabled
-                    if erasing:
-                        if bsize == 12:
-                            self._write_enable()
-                            self._sector_erase(address)
-                        elif bsize == 15:
-                            self._write_enable()
-                            self._block_erase(address, False)
-                        elif bsize == 16:
-                            self._write_enable()
-                            self._block_erase(address, True)
-                        else:
-                            pass
-                        #waiting until erasing is done
-                        while self._isbusy():
-                            time.sleep(0.05)
-                    # program current block to flash
-                    self._page_program(address, bin_data[:size])
-                    real_size = len(bin_data[:size])
-                    address += real_size
-                    written += real_size
-                    bin_data = bin_data[size:]
-                else:
-                    break
-            
-            bar.finish()
-            print('Writing finished.')
-            return written
+                        # program current block to flash
+                        self._page_program(block_address, block)
+                    if self.verify != 'block':
+                        break
+                    if self._crc(block_address, len(block)) == crc:
+                        break
+                    retries += 1
+                    if retries > self.retries:
+                        raise VerifyError(block_address, 'block', self.retries)
+                if incremental:
+                    updated[action] += 1
+                written += len(block)
+                # the size of a streamed image is an estimate
+                bar.update(min(written, max(1, size)))
+                if journal is not None:
+                    journal.update(programmed = index + 1)
+        bar.finish()
+        return written
+
+    def _image_sectors(self, image, address):
+        ## sector address -> (content, whole) for every sector the image
+        ## touches, content is the image padded with 0xFF, whole is True
+        ## if the image covers all of the sector
+        sectors = {}
+        for piece_address, piece in image.blocks(address, 12):
+            sector = piece_address & ~(self.SECTOR - 1)
+            if sector not in sectors:
+                sectors[sector] = [bytearray(self.BLANK_SECTOR), 0]
+            content = sectors[sector]
+            content[0][piece_address - sector:piece_address - sector + len(piece)] = piece
+            content[1] += len(piece)
+        return dict([(s, (bytes(c), n == self.SECTOR)) for s, (c, n) in sectors.items()])
+
+    def _sector_digest(self, data):
+        return hashlib.sha256(data).hexdigest()[:32]
+
+    def _indexed_sectors(self, index, sectors):
+        ## the sectors the index has with the content the image will give
+        ## them; index_samples of them are read back, one that differs
+        ## makes the whole index of the device stale
+        keep = set([s for s, (content, whole) in sectors.items() if index.get(s) == self._sector_digest(content)])
+        samples = random.sample(sorted(keep), min(self.index_samples, len(keep)))
+        for sector in samples:
+            if self._device_digest(sector) != index.get(sector):
+                self._log('The device changed since it was indexed, the index is dropped')
+                index.clear()
+                return set()
+        return keep
 
+    def _device_digest(self, sector):
+        ## digest of the sector as read back from the device
+        return self._sector_digest(b''.join(self._read_stream(sector, self.SECTOR)))
+
+    def _kept(self, keep, address, size):
+        if len(keep) == 0:
+            return False
+        for sector in range(address & ~(self.SECTOR - 1), address + size, self.SECTOR):
+            if sector not in keep:
+                return False
+        return True
+
+    def unique_id(self):
+        ## the 64-bit unique ID of the flash as a hex string
+        return bytes(self._read_iniq_id()).hex()
+
+    def _journal_key(self, image, address, bsize, erasing, incremental):
+        key = hashlib.sha256()
+        key.update(self.unique_id().encode())
+        # erases and blocks are counted in the unit order of write_hex
+        key.update('{} {} {} {} units'.format(address, bsize, erasing, incremental).encode())
+        for offset, data in image.segments:
+            key.update('{} {}'.format(offset, len(data)).encode())
+            key.update(data)
+        return key.hexdigest()
+
+    def _journal_valid(self, journal, units):
+        ## spot check of the last erase or block the journal has as done,
+        ## units are the write units of the run (see _write_units)
+        if journal.programmed > 0:
+            for erase, blocks in units:
+                for index, block_address, block, crc, kept in blocks:
+                    if index == journal.programmed - 1:
+                        return self._crc(block_address, len(block)) == zlib.crc32(block)
+            return False
+        plan = [(a, op) for erase, blocks in units for step, a, op in erase]
+        if journal.erased > len(plan):
+            return False
+        start, op = plan[journal.erased - 1]
+        size = self.get_chip_size() if op == 'chip' else 1 << self.ERASE_SIZES[op]
+        return self.blank_check(start, size, 0xFF, True) is None
+
+    @_phase('read')
     def read_hex(self, address, binfile, size):
         if size is None:
             size = self._get_chip_size()
@@ -383,83 +1596,158 @@ class Flash:
                 return
 
         with open(binfile, mode='wb') as hh:
-            bar = ProgressBar(max_value=size).start()
+            bar = self._progress(size)
             i = 0
-            while size > 0:
-                rd = self._read_data(address, 256)
-                hh.write(bytes(rd))
-                size = size - len(rd)
-                address = address + len(rd)
-                bar.update(i)
+            for rd in self.iter_read(address, size):
+                hh.write(rd)
                 i = i + len(rd)
+                bar.update(i)
             bar.finish()
-            print('Reading finished')
-            
+            self._log('Reading finished')
+
+    def write(self, address, data):
+        ## buffered write of a few bytes anywhere: the 4K sectors touched
+        ## are read once and changed in memory, flush() writes them back
+        ## with one erase only where bits go from 0 to 1
+        data = memoryview(bytes(data))
+        pos = 0
+        while pos < len(data):
+            sector = (address + pos) & ~(self.SECTOR - 1)
+            n = min(sector + self.SECTOR - address - pos, len(data) - pos)
+            if sector not in self._sectors:
+                if len(self._sectors) >= self.write_buffer:
+                    self.flush()
+                old = b''.join(self._read_stream(sector, self.SECTOR))
+                self._sectors[sector] = (old, bytearray(old))
+            new = self._sectors[sector][1]
+            offset = address + pos - sector
+            new[offset:offset + n] = data[pos:pos + n]
+            pos += n
+
     def write_int(self, address, value):
-        data = []
-        data.append(value & 0xFF)
-        data.append((value >> 8) & 0xFF)
-        data.append((value >> 16) & 0xFF)
-        data.append((value >> 24) & 0xFF)
-        self._page_program(address, data)
+        ## 32-bit little endian value, buffered like write()
+        self.write(address, (value & 0xFFFFFFFF).to_bytes(4, 'little'))
+
+    @_phase('program')
+    def flush(self):
+        ## writes the sectors changed by write() back to the flash,
+        ## returns the number of sectors skipped, programmed and erased
+        updated = {'skipped': 0, 'programmed': 0, 'erased': 0}
+        sectors = self._sectors
+        self._sectors = {}
+        for sector in sorted(sectors):
+            old, new = sectors[sector]
+            updated[self._apply_block(sector, old, new, 12)] += 1
+        return updated
         
             
             
+    def iter_read(self, address, size, chunk = None):
+        ## yields [address, address + size) as bytes objects of chunk bytes
+        ## (read_chunk by default), the next chunk is read while the caller
+        ## handles the current one; stopping early is fine
+        self.flush()
+        if self.telemetry is None:
+            yield from self._read_stream(address, size, chunk)
+        else:
+            with self.telemetry.phase('read'):
+                yield from self._read_stream(address, size, chunk)
+
+    @_phase('read')
     def read(self, address, size):
-        bar = ProgressBar(max_value=size).start()
+        bar = self._progress(size)
         i = 0
         hh = []
-        while size > 0:
-            rds = min(256, size)
-            rd = self._read_data(address, rds)
-            hh.extend(bytes(rd))
-            size = size - len(rd)
-            address = address + len(rd)
-            bar.update(i)
+        for rd in self.iter_read(address, size):
+            hh.append(rd)
             i = i + len(rd)
-            time.sleep(0.01)
+            bar.update(i)
         bar.finish()
-        return hh
-        
-       
-    def verify_hex(self, address, hexfile, binfile):
-        with open(hexfile, mode='rt') as hex:
-            size = os.path.getsize(hexfile)
-            bar = ProgressBar(max_value=size).start()
-            err_addr = None
-            with open(binfile, mode = 'rb') as bin:
-                i = 0
-                hex_data = ''
-                while True:
-                    hex_data = ''
-                    while len(hex_data) < 3*self.BLOCK_SIZE_WR:
-                        hx = hex.readline()
-                        hx = hx[:-1]
-                        if len(hx) > 0:
-                            hx += ' '
-                        if len(hx) == 0:
-                            break
-                        else:
-                            hex_data += (hx)
-                    if len(hex_data) > 0:
-                        bin_data = self._ascii2hex(hex_data)
-                        rd_data = bin.read(len(bin_data))
-                        for index, bv in enumerate(bin_data):
-                            if bv != rd_data[index]:
-                                err_addr = address + index
-                                expected_value = bv
-                                value = rd_data[index]
-                                break
-                        address = address + len(bin_data)
-                        i = i + len(hex_data)
-                        bar.update(i)
-                    else:
-                        break
-            bar.finish()
-            if err_addr is not None:
-                print('Verification failed: at address 0x{:06x} expected value 0x{:02x} got 0x{:02x}'.format(err_addr, expected_value, value))
+        return b''.join(hh)
+
+    def _diff_ranges(self, address, expected, actual):
+        ## returns [start, end) address ranges where the buffers differ, the
+        ## XOR of both buffers is scanned for non-zero runs at C speed
+        if expected == actual:
+            return []
+        n = min(len(expected), len(actual))
+        x = int.from_bytes(expected[:n], 'big') ^ int.from_bytes(actual[:n], 'big')
+        ranges = [[address + m.start(), address + m.end()] for m in re.finditer(b'[^\x00]+', x.to_bytes(n, 'big'))]
+        if len(expected) > n:
+            # missing read data counts as a mismatch
+            ranges.append([address + n, address + len(expected)])
+        return ranges
+
+    def _merge_ranges(self, ranges, new):
+        for r in new:
+            if len(ranges) > 0 and ranges[-1][1] == r[0]:
+                ranges[-1][1] = r[1]
             else:
-                print('Verification completed successfully.')
+                ranges.append(r)
+        return ranges
+
+    def _report_ranges(self, ranges):
+        if len(ranges) == 0:
+            self._log('Verification completed successfully.')
+            return
+        self._log('Verification failed: {} bytes differ in {} ranges'.format(sum([e - s for s, e in ranges]), len(ranges)))
+        for start, end in ranges:
+            self._log('    0x{:06x} - 0x{:06x} ({} bytes)'.format(start, end - 1, end - start))
+
+    @_phase('verify')
+    def verify_image(self, address, image, binfile = None):
+        ## compares the device with image while streaming it back, nothing is
+        ## stored unless binfile is given, then the read back of the whole
+        ## image span is saved there as well
+        ## returns the list of mismatching [start, end) address ranges
+        self.flush()
+        image = image if isinstance(image, Image) else load_image(image)
+        if binfile is not None:
+            regions = [(0, image.span)]
+        else:
+            regions = [(offset, len(data)) for offset, data in image.segments]
+        bar = self._progress(max(1, sum([size for offset, size in regions])))
+        ranges = []
+        hh = open(binfile, mode='wb') if binfile is not None else None
+        try:
+            i = 0
+            for offset, size in regions:
+                for rd in self._read_stream(address + offset, size):
+                    if hh is not None:
+                        hh.write(rd)
+                    # compare with every segment overlapping this chunk
+                    for seg_offset, data in image.segments:
+                        start = max(offset, seg_offset)
+                        end = min(offset + len(rd), seg_offset + len(data))
+                        if start < end:
+                            self._merge_ranges(ranges, self._diff_ranges(address + start,
+                                data[start - seg_offset:end - seg_offset], rd[start - offset:end - offset]))
+                    offset += len(rd)
+                    i = i + len(rd)
+                    bar.update(i)
+        finally:
+            if hh is not None:
+                hh.close()
+        bar.finish()
+        self._report_ranges(ranges)
+        return ranges
+
+    def verify_hex(self, address, hexfile, binfile):
+        ## binfile holds the flash content read from address on
+        image = hexfile if isinstance(hexfile, Image) else load_image(hexfile)
+        bar = self._progress(max(1, image.size))
+        ranges = []
+        with open(binfile, mode = 'rb') as bin:
+            i = 0
+            for block_address, block in image.blocks(address, 16):
+                bin.seek(block_address - address)
+                rd_data = bin.read(len(block))
+                self._merge_ranges(ranges, self._diff_ranges(block_address, block, rd_data))
+                i = i + len(block)
+                bar.update(i)
+        bar.finish()
+        self._report_ranges(ranges)
+        return ranges
     
     def release_rst(self):
         self.port.flush()
@@ -469,5 +1757,10 @@ class Flash:
         
 
     def close(self):
-        self.release_rst()
-        self.port.close()
+        try:
+            self.flush()
+        finally:
+            if self.address_mode == 'enter':
+                self._address_mode_batch(False).run()
+            self.release_rst()
+            self.port.close()
@@ -0,0 +1,56 @@
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-p', dest='portname', default=None)
+parser.add_argument('-d', dest='debug', action='store_true')
+parser.add_argument('-a', dest='address', default='0')
+parser.add_argument('-s', dest='size', default='0')
+parser.add_argument('-f', dest='fill', default='0xFF')
+parser.add_argument('-q', dest='first', action='store_true')
+args = parser.parse_args()
+
+port = args.portname
+
+if port == None:
+    print('No port specified.')
+    exit()
+
+address = int(args.address, 0)
+size = int(args.size, 0)
+fill = int(args.fill, 0)
+if fill < 0 or fill > 0xFF:
+    print('Fill value {} is wrong. Expected a byte value'.format(args.fill))
+    exit()
+
+from flash import Flash
+
+flash = Flash()
+flash.debug = args.debug
+flash.open(port)
+
+try:
+    chip_size = flash.get_chip_size()
+    # size 0 checks up to the end of the chip
+    if size == 0 or address + size > chip_size:
+        size = chip_size - address
+    if args.first:
+        found = flash.blank_check(address, size, fill, True)
+        if found is None:
+            print('0x{:06x} - 0x{:06x}: blank'.format(address, address + size - 1))
+        else:
+            print('0x{:06x} - 0x{:06x}: not blank at 0x{:06x}'.format(address, address + size - 1, found))
+    else:
+        used = flash.blank_check(address, size, fill)
+        base = address & ~0xFFF
+        # one line per run of used or blank sectors
+        start = 0
+        for i in range(1, len(used) + 1):
+            if i == len(used) or used[i] != used[start]:
+                print('0x{:06x} - 0x{:06x}: {}'.format(base + (start << 12), base + (i << 12) - 1, 'used' if used[start] else 'blank'))
+                start = i
+        print('Sectors used: {}/{}'.format(used.count(True), len(used)))
+        found = None if True not in used else 0
+finally:
+    flash.close()
+
+exit(0 if found is None else 1)
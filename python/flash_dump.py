@@ -1,11 +1,20 @@
 import argparse
 import os
+import sys
+import zlib
+import hashlib
+import threading
+import queue
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-p', dest='portname', default=None)
 parser.add_argument('-d', dest='debug', action='store_true')
-parser.add_argument('-a', dest='address', default=None)
-parser.add_argument('-s', dest='size', default=None, type=int)
+parser.add_argument('-a', dest='address', default='0')
+parser.add_argument('-s', dest='size', default=None)
+parser.add_argument('-o', dest='output', default=None)
+parser.add_argument('-z', dest='compress', default=None, choices=['none', 'gzip', 'xz'])
+parser.add_argument('-H', dest='digests', default=[], nargs='+', choices=['sha256', 'crc32'])
+parser.add_argument('-C', dest='calibrate', action='store_true')
 args = parser.parse_args()
 
 port = args.portname
@@ -14,17 +23,109 @@ if port == None:
     print('No port specified.')
     exit()
 
+address = int(args.address, 0)
+size = int(args.size, 0) if args.size is not None else None
+
+output = args.output
+compress = args.compress
+if compress is None and output is not None:
+    # by the file name, stdout is not compressed unless asked
+    if output.endswith('.gz'):
+        compress = 'gzip'
+    elif output.endswith('.xz'):
+        compress = 'xz'
+    else:
+        compress = 'none'
+
+
+class Writer:
+    ## writes (and compresses) the dump on a background thread, so the
+    ## link keeps streaming while the compressor works
+
+    def __init__(self, f):
+        self.f = f
+        self.chunks = queue.Queue(maxsize=16)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            data = self.chunks.get()
+            if data is None:
+                break
+            if self.error is None:
+                try:
+                    self.f.write(data)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.chunks.put(data)
+
+    def close(self):
+        self.chunks.put(None)
+        self.thread.join()
+        self.f.close()
+        if self.error is not None:
+            raise self.error
+
+
+def open_output(output, compress):
+    ## closing the returned file leaves stdout open
+    f = sys.stdout.buffer if output == '-' else output
+    if compress == 'gzip':
+        import gzip
+        return gzip.GzipFile(fileobj=f, mode='wb') if output == '-' else gzip.open(f, mode='wb')
+    if compress == 'xz':
+        import lzma
+        return lzma.LZMAFile(f, mode='wb')
+    if output == '-':
+        return os.fdopen(os.dup(sys.stdout.fileno()), mode='wb')
+    return open(f, mode='wb')
+
 
 from flash import Flash 
 
 flash = Flash()
 flash.debug = args.debug
-flash.open(port)
+# stdout may be the dump itself, progress and messages go to stderr then
+if output == '-':
+    flash.log_file = sys.stderr
+flash.open(port, args.calibrate)
 
 try:
-    input("waiting")
-    print(flash.read(int(args.address,0), args.size))
-    
+    if size is None:
+        # up to the end of the chip
+        size = flash.get_chip_size() - address
+    if output is None and len(args.digests) == 0:
+        data = flash.read(address, size)
+        for i in range(0, len(data), 16):
+            print(' '.join(['{:02x}'.format(x) for x in data[i:i + 16]]))
+    else:
+        writer = Writer(open_output(output, compress)) if output is not None else None
+        sha256 = hashlib.sha256() if 'sha256' in args.digests else None
+        crc32 = 0
+        try:
+            for rd in flash.iter_read(address, size):
+                if writer is not None:
+                    writer.write(rd)
+                if sha256 is not None:
+                    sha256.update(rd)
+                if 'crc32' in args.digests:
+                    crc32 = zlib.crc32(rd, crc32)
+        finally:
+            if writer is not None:
+                writer.close()
+        out = sys.stderr if output == '-' else sys.stdout
+        if sha256 is not None:
+            print('sha256: {}'.format(sha256.hexdigest()), file=out)
+        if 'crc32' in args.digests:
+            print('crc32: {:08x}'.format(crc32), file=out)
+
 finally:    
     flash.close()
 
@@ -4,9 +4,11 @@ import os
 parser = argparse.ArgumentParser()
 parser.add_argument('-p', dest='portname', default=None)
 parser.add_argument('-d', dest='debug', action='store_true')
-parser.add_argument('-a', dest='address', default=0)
-parser.add_argument('-s', dest='size', default=0)
-parser.add_argument('-b', dest='bsize', default='64K')
+parser.add_argument('-a', dest='address', default='0')
+parser.add_argument('-s', dest='size', default='0')
+parser.add_argument('-b', dest='bsize', default='auto')
+parser.add_argument('-k', dest='skip_blank', action='store_true')
+parser.add_argument('-c', dest='chip_ratio', default=None, type=float)
 args = parser.parse_args()
 
 port = args.portname
@@ -15,12 +17,15 @@ if port == None:
     print('No port specified.')
     exit()
     
-if args.bsize == '64K':
+if args.bsize == 'auto':
+    # 4K/32K/64K mixed by Flash.plan_erase
+    bsize = None
+elif args.bsize == '64K':
     bsize = 64*1024
 elif args.bsize == '4K':
     bsize = 4*1024
 else:
-    print('Block size {} is wrong. Supported 4K or 64K value')
+    print('Block size {} is wrong. Supported auto, 4K or 64K value'.format(args.bsize))
     exit()
 
 
@@ -47,7 +52,10 @@ try:
             else:
                 end_address = address + size - 1
 
-        if bsize == 4*1024:
+        if bsize is None:
+            start_address = address & 0xFFFFF000
+            end_address = end_address | 0x00000FFF
+        elif bsize == 4*1024:
             start_address = address & 0xFFFFF000
             end_address = end_address | 0x00000FFF
         else:
@@ -61,6 +69,8 @@ try:
             exit()
         elif cont.lower() == 'n':
             exit()
+        elif bsize is None:
+            flash.erase_range(start_address, end_address - start_address + 1, args.skip_blank, args.chip_ratio)
         else:
             bcount = int((end_address - start_address)/bsize) + 1
             flash.erase_chip_partial(start_address, bsize, bcount)
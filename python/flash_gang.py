@@ -0,0 +1,152 @@
+import argparse
+import os
+import glob
+import fnmatch
+import threading
+import time
+import queue
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-p', dest='portnames', default=None, nargs='+')
+parser.add_argument('-i', dest='input', default=None)
+parser.add_argument('-a', dest='address', default='0')
+parser.add_argument('-e', dest='full_erase', action='store_true')
+parser.add_argument('-b', dest='block_size', default='64')
+parser.add_argument('-u', dest='update', action='store_true')
+parser.add_argument('-V', dest='verify', default='page', choices=['none', 'page', 'block', 'image'])
+parser.add_argument('-j', dest='jobs', default=None, type=int)
+parser.add_argument('-t', dest='timeout', default=None, type=float)
+parser.add_argument('-d', dest='debug', action='store_true')
+args = parser.parse_args()
+
+if args.portnames is None:
+    print('No port specified.')
+    exit()
+
+input = args.input
+if input is None:
+    print('No input file specified.')
+    exit()
+if not os.path.exists(input):
+    print('Input file {} not found.'.format(input))
+    exit()
+
+address = int(args.address, 0)
+
+if args.block_size == '4':
+    bsize = 12
+elif args.block_size == '32':
+    bsize = 15
+elif args.block_size == '64':
+    bsize = 16
+else:
+    print('Block size value \'{}\' is wrong. Expected 4, 32 or 64'.format(args.block_size))
+    exit()
+
+from serial.tools import list_ports
+from flash import Flash
+from image import load_image, ImageError
+
+# port names may be globs, they are matched against the serial ports known
+# to the system (COM*) and against device files (/dev/ttyACM*)
+known = [p.device for p in list_ports.comports()]
+ports = []
+for name in args.portnames:
+    matches = fnmatch.filter(known, name) + glob.glob(name)
+    if len(matches) == 0 and not glob.has_magic(name):
+        matches = [name]
+    for port in sorted(matches):
+        if port not in ports:
+            ports.append(port)
+
+if len(ports) == 0:
+    print('No port matches {}.'.format(' '.join(args.portnames)))
+    exit()
+
+# the image is parsed once, every worker reads the same blocks
+try:
+    image = load_image(input)
+except ImageError as e:
+    print(e)
+    exit()
+
+print('Programming {} ({} bytes) to 0x{:06x} on {} ports'.format(input, image.size, address, len(ports)))
+
+
+def program(port):
+    result = {'port': port, 'ok': False, 'error': None, 'time': 0.0}
+    started = time.time()
+    flash = Flash()
+    flash.debug = args.debug
+    flash.verbose = False
+    flash.verify = args.verify
+    try:
+        flash.open(port)
+        try:
+            if args.full_erase:
+                flash.erase_chip()
+            flash.write_hex(address, image, bsize, not args.full_erase, args.update and not args.full_erase)
+            ranges = flash.verify_image(address, image)
+            if len(ranges) > 0:
+                result['error'] = 'verify: {} bytes differ in {} ranges, first at 0x{:06x}'.format(
+                    sum([e - s for s, e in ranges]), len(ranges), ranges[0][0])
+            else:
+                result['ok'] = True
+        finally:
+            flash.close()
+    except Exception as e:
+        # a fault on one port must not stop the others
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['time'] = time.time() - started
+    return result
+
+
+# daemon workers, a port that hangs is reported and left behind
+jobs = queue.Queue()
+results = queue.Queue()
+for port in ports:
+    jobs.put(port)
+
+def worker():
+    while True:
+        try:
+            port = jobs.get_nowait()
+        except queue.Empty:
+            return
+        results.put(program(port))
+
+workers = args.jobs if args.jobs is not None else len(ports)
+for i in range(0, max(1, min(workers, len(ports)))):
+    t = threading.Thread(target=worker)
+    t.daemon = True
+    t.start()
+
+started = time.time()
+done = {}
+while len(done) < len(ports):
+    wait = None
+    if args.timeout is not None:
+        wait = args.timeout - (time.time() - started)
+        if wait <= 0:
+            break
+    try:
+        result = results.get(timeout=wait)
+    except queue.Empty:
+        break
+    done[result['port']] = result
+    if result['ok']:
+        rate = image.size / result['time'] / 1024 if result['time'] > 0 else 0
+        print('PASS {}: {:.1f}s, {:.1f} KB/s'.format(result['port'], result['time'], rate))
+    else:
+        print('FAIL {}: {:.1f}s, {}'.format(result['port'], result['time'], result['error']))
+
+for port in ports:
+    if port not in done:
+        print('FAIL {}: no result after {:.1f}s'.format(port, time.time() - started))
+
+elapsed = time.time() - started
+passed = len([r for r in done.values() if r['ok']])
+print('Passed: {}/{}, total {:.1f}s, {:.1f} KB/s aggregate'.format(passed, len(ports), elapsed,
+    image.size * passed / elapsed / 1024 if elapsed > 0 else 0))
+
+exit(0 if passed == len(ports) else 1)
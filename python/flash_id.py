@@ -1,5 +1,6 @@
 import argparse
 import os
+import time
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-p', dest='portname', default=None)
@@ -24,6 +25,24 @@ try:
 	chip_info = flash.get_device_info()
 	for key in chip_info:
 		print('{}: {} (0x{:02X})'.format(key, chip_info[key][0], chip_info[key][1]))
+	uid = flash.unique_id()
+	print('Unique ID: {}'.format(uid))
+	# geometry and timings the Flash works with, from SFDP or built in
+	device = flash.device
+	print('Device: {} bytes, {} byte pages, {} byte addresses, from {}'.format(device.size, device.page_size, device.address_mode, device.source))
+	if flash.address_mode is not None:
+		print('4-byte addresses: {}'.format(flash.address_mode))
+	for bits, op in sorted(device.erase.items()):
+		print('Erase {}K: 0x{:02X}'.format((1 << bits) >> 10, op))
+	for op, (typ, tmax) in sorted(device.timings.items()):
+		print('Time {}: {:.2f} ms typical, {:.2f} ms max'.format(op, typ * 1e3, tmax * 1e3))
+	# what this host last wrote to the device, from the device index
+	from devindex import DeviceIndex
+	index = DeviceIndex(uid)
+	if len(index) > 0:
+		print('Last written: {} at {}'.format(index.image, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(index.time))))
+		for start, end in index.ranges():
+			print('Known content: 0x{:06x} - 0x{:06x}'.format(start, end - 1))
 finally:	
 	flash.close()
 
@@ -0,0 +1,66 @@
+import argparse
+import os
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-p', dest='portname', default=None)
+parser.add_argument('-j', dest='job', default=None)
+parser.add_argument('-n', dest='dry_run', action='store_true')
+parser.add_argument('-d', dest='debug', action='store_true')
+args = parser.parse_args()
+
+if args.job is None:
+    print('No job manifest specified.')
+    exit()
+if not os.path.exists(args.job):
+    print('Job manifest {} not found.'.format(args.job))
+    exit()
+
+from manifest import load_manifest, ManifestError
+
+try:
+    job = load_manifest(args.job)
+except ManifestError as e:
+    print(e)
+    exit()
+
+for r in sorted(job.regions, key = lambda r: r.address):
+    actions = [a for a in ('erase', 'update', 'program', 'verify', 'blank_check') if getattr(r, a)]
+    print('{:<16} 0x{:06x} - 0x{:06x}: {}'.format(r.name, r.address, r.end - 1, ', '.join(actions)))
+
+if args.dry_run:
+    from flash import Flash
+    plan = job.plan(Flash())
+    print('Erase plan: {}'.format(', '.join(['{} at 0x{:06x}'.format(op, a) for a, op in plan]) or 'nothing'))
+    exit()
+
+port = args.portname
+if port == None:
+    print('No port specified.')
+    exit()
+
+from flash import Flash, FlashError
+
+flash = Flash()
+flash.debug = args.debug
+started = time.time()
+flash.open(port)
+
+failed = 0
+try:
+    results = job.run(flash)
+    for result in results:
+        if result['ok']:
+            print('PASS {}'.format(result['name']))
+        else:
+            failed += 1
+            print('FAIL {}: {}'.format(result['name'], result['error']))
+except (FlashError, ManifestError) as e:
+    print(e)
+    failed = len(job.regions)
+finally:
+    flash.close()
+    job.close()
+
+print('Regions passed: {}/{}, total {:.1f}s'.format(len(job.regions) - failed, len(job.regions), time.time() - started))
+exit(0 if failed == 0 else 1)
@@ -5,7 +5,8 @@ parser = argparse.ArgumentParser()
 parser.add_argument('-p', dest='portname', default=None)
 parser.add_argument('-d', dest='debug', action='store_true')
 parser.add_argument('-a', dest='address', default=None)
-parser.add_argument('-v', dest='value', default=None)
+parser.add_argument('-v', dest='value', default=None, nargs='+')
+parser.add_argument('-w', dest='words', default=[], nargs='+', action='extend')
 args = parser.parse_args()
 
 port = args.portname
@@ -14,6 +15,28 @@ if port == None:
     print('No port specified.')
     exit()
 
+# (address, value) of every 32-bit word, -v values go to consecutive words
+# from -a, -w takes address=value pairs
+words = []
+try:
+    if args.value is not None:
+        if args.address is None:
+            print('No address specified.')
+            exit()
+        address = int(args.address, 0)
+        for i, value in enumerate(args.value):
+            words.append((address + i * 4, int(value, 0)))
+    for word in args.words:
+        address, value = word.split('=')
+        words.append((int(address, 0), int(value, 0)))
+except ValueError:
+    print('Wrong address or value. Expected -a <address> -v <value>... or -w <address>=<value>...')
+    exit()
+
+if len(words) == 0:
+    print('No value specified.')
+    exit()
+
 
 from flash import Flash 
 
@@ -22,8 +45,12 @@ flash.debug = args.debug
 flash.open(port)
 
 try:
-	flash.write_int(int(args.address, 0), int(args.value, 0))
-	
-finally:	
-	flash.close()
+    # the words are collected per 4K sector and written back together
+    for address, value in words:
+        flash.write_int(address, value)
+    updated = flash.flush()
+    print('Sectors unchanged: {skipped}, programmed: {programmed}, erased and programmed: {erased}'.format(**updated))
+
+finally:    
+    flash.close()
 
@@ -0,0 +1,228 @@
+import argparse
+import os
+import sys
+import json
+import time
+import socket
+
+from journal import state_path
+
+## Client of flashd.py: every subcommand is one request to the daemon, the
+## port stays open there between calls. The port is -p or $USB2SPI_PORT.
+##
+##     python flashd.py &
+##     python flashctl.py -p /dev/ttyACM0 status
+##     python flashctl.py -p /dev/ttyACM0 -R flash -i top.hex
+##
+## Test scripts in Python can keep one connection for many requests:
+##
+##     from flashctl import Client
+##     client = Client()
+##     status = client.call('status', '/dev/ttyACM0')
+
+
+class Client:
+    def __init__(self, path = None):
+        self.path = path if path is not None else state_path('flashd.sock')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.rfile = self.sock.makefile('rb')
+
+    def call(self, op, port = None, **args):
+        ## returns the result, raises RuntimeError with the daemon error
+        request = dict(args)
+        request['op'] = op
+        if port is not None:
+            request['port'] = port
+        self.sock.sendall(json.dumps(request).encode() + b'\n')
+        line = self.rfile.readline()
+        if len(line) == 0:
+            raise RuntimeError('flashd closed the connection')
+        response = json.loads(line.decode())
+        if not response['ok']:
+            raise RuntimeError('{}: {}'.format(response['type'], response['error']))
+        return response['result']
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+def _int(value):
+    return int(value, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', dest='portname', default=os.environ.get('USB2SPI_PORT'))
+    parser.add_argument('-S', dest='socket', default=None)
+    parser.add_argument('-R', dest='release', action='store_true')
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('ping')
+    commands.add_parser('sessions')
+    commands.add_parser('stop')
+    commands.add_parser('release')
+    commands.add_parser('id')
+    commands.add_parser('status')
+    commands.add_parser('size')
+
+    cmd = commands.add_parser('dump')
+    cmd.add_argument('-a', dest='address', default=0, type=_int)
+    cmd.add_argument('-s', dest='size', default=None, type=_int)
+    cmd.add_argument('-o', dest='output', default=None)
+    cmd.add_argument('-H', dest='digests', nargs='+', default=[], choices=['sha256', 'crc32'])
+
+    cmd = commands.add_parser('write')
+    cmd.add_argument('-a', dest='address', default=None, type=_int)
+    cmd.add_argument('-v', dest='value', nargs='+', default=[], type=_int)
+    cmd.add_argument('-w', dest='words', nargs='+', default=[])
+
+    cmd = commands.add_parser('erase')
+    cmd.add_argument('-a', dest='address', default=0, type=_int)
+    cmd.add_argument('-s', dest='size', default=None, type=_int)
+    cmd.add_argument('-e', dest='chip', action='store_true')
+    cmd.add_argument('-k', dest='skip_blank', action='store_true')
+    cmd.add_argument('-c', dest='chip_ratio', default=None, type=float)
+
+    cmd = commands.add_parser('blank')
+    cmd.add_argument('-a', dest='address', default=0, type=_int)
+    cmd.add_argument('-s', dest='size', default=None, type=_int)
+    cmd.add_argument('-f', dest='fill', default=0xFF, type=_int)
+
+    cmd = commands.add_parser('flash')
+    cmd.add_argument('-i', dest='input', default=None)
+    cmd.add_argument('-a', dest='address', default=0, type=_int)
+    cmd.add_argument('-e', dest='full_erase', action='store_true')
+    cmd.add_argument('-b', dest='block_size', default='64', choices=['4', '32', '64'])
+    cmd.add_argument('-u', dest='update', action='store_true')
+    cmd.add_argument('-V', dest='verify', default='page', choices=['none', 'page', 'block', 'image'])
+    cmd.add_argument('-r', dest='resume', action='store_true')
+    cmd.add_argument('-x', dest='index', action='store_true')
+
+    cmd = commands.add_parser('job')
+    cmd.add_argument('-j', dest='job', default=None)
+
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_usage()
+        exit(2)
+
+    port = args.portname
+    if port is None and args.command not in ('ping', 'sessions', 'stop'):
+        print('No port specified.')
+        exit(2)
+
+    try:
+        client = Client(args.socket)
+    except OSError as e:
+        print('flashd is not running ({}), start it with: python flashd.py'.format(e))
+        exit(2)
+
+    # files are opened by the daemon, from its own working directory
+    request = {'release': True} if args.release else {}
+    command = args.command
+    started = time.time()
+    failed = False
+
+    try:
+        if command == 'ping':
+            result = client.call('ping')
+            print('flashd pid {}, up {:.0f}s, {:.1f} ms'.format(result['pid'], result['uptime'], (time.time() - started) * 1e3))
+        elif command == 'sessions':
+            for s in client.call('sessions'):
+                print('{}: {} requests, idle {:.1f}s{}'.format(s['port'], s['requests'], s['idle'], ', busy' if s['busy'] else ''))
+        elif command == 'stop':
+            client.call('shutdown')
+        elif command == 'release':
+            if not client.call('release', port):
+                print('{} has no session'.format(port))
+        elif command == 'id':
+            result = client.call('id', port, **request)
+            for key, (name, code) in result['info'].items():
+                print('{}: {} (0x{:02X})'.format(key, name, code))
+            print('Unique ID: {}'.format(result['uid']))
+            device = result['device']
+            print('Device: {} bytes, {} byte pages, {} byte addresses, from {}'.format(
+                device['size'], device['page_size'], device['address_mode'], device['source']))
+            if 'index' in result:
+                index = result['index']
+                print('Last written: {} at {}'.format(index['image'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(index['time']))))
+                for start, end in index['ranges']:
+                    print('Known content: 0x{:06x} - 0x{:06x}'.format(start, end - 1))
+        elif command == 'status':
+            for key, value in client.call('status', port, **request).items():
+                print('{}: {}'.format(key, value))
+        elif command == 'size':
+            print(client.call('size', port, **request))
+        elif command == 'dump':
+            if args.output is not None:
+                request['path'] = os.path.abspath(args.output)
+            result = client.call('read', port, address=args.address, size=args.size, digests=args.digests, **request)
+            if 'data' in result and args.output is None and len(args.digests) == 0:
+                data = bytes.fromhex(result['data'])
+                for i in range(0, len(data), 16):
+                    print(' '.join(['{:02x}'.format(x) for x in data[i:i + 16]]))
+            for name in args.digests:
+                print('{}: {}'.format(name, result[name]))
+        elif command == 'write':
+            words = [[args.address + i * 4, value] for i, value in enumerate(args.value)] if args.address is not None else []
+            if len(args.value) > 0 and args.address is None:
+                print('No address specified.')
+                exit(2)
+            for word in args.words:
+                address, value = word.split('=')
+                words.append([_int(address), _int(value)])
+            if len(words) == 0:
+                print('No value specified.')
+                exit(2)
+            updated = client.call('write', port, words=words, **request)
+            print('Sectors unchanged: {skipped}, programmed: {programmed}, erased and programmed: {erased}'.format(**updated))
+        elif command == 'erase':
+            plan = client.call('erase', port, address=args.address, size=args.size, chip=args.chip,
+                               skip_blank=args.skip_blank, chip_ratio=args.chip_ratio, **request)
+            ops = [op for address, op in plan]
+            print('Erased: {}'.format(', '.join(['{} x {}'.format(ops.count(op), op) for op in sorted(set(ops))]) or 'nothing'))
+        elif command == 'blank':
+            result = client.call('blank', port, address=args.address, size=args.size, fill=args.fill, **request)
+            if result['blank']:
+                print('blank')
+            else:
+                print('not blank at 0x{:06x}'.format(result['found']))
+                failed = True
+        elif command == 'flash':
+            if args.input is None or not os.path.exists(args.input):
+                print('Input file {} not found.'.format(args.input))
+                exit(2)
+            result = client.call('flash', port, path=os.path.abspath(args.input), address=args.address,
+                                 erase='chip' if args.full_erase else 'sectors', bsize={'4': 12, '32': 15, '64': 16}[args.block_size],
+                                 update=args.update, verify=args.verify, resume=args.resume, index=args.index, **request)
+            print('Written: {}'.format(result['written']))
+            for start, end in result['mismatches']:
+                print('Mismatch 0x{:06x} - 0x{:06x}'.format(start, end - 1))
+            failed = len(result['mismatches']) > 0
+        elif command == 'job':
+            if args.job is None or not os.path.exists(args.job):
+                print('Job manifest {} not found.'.format(args.job))
+                exit(2)
+            result = client.call('job', port, path=os.path.abspath(args.job), **request)
+            for line in result['log']:
+                print(line)
+            for r in result['results']:
+                if r['ok']:
+                    print('PASS {}'.format(r['name']))
+                else:
+                    failed = True
+                    print('FAIL {}: {}'.format(r['name'], r['error']))
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        failed = True
+    finally:
+        client.close()
+
+    exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
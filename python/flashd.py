@@ -0,0 +1,374 @@
+import argparse
+import os
+import json
+import time
+import hashlib
+import zlib
+import threading
+import socketserver
+
+from flash import Flash, FlashError, TransportError
+from image import load_image
+from manifest import load_manifest
+from journal import state_path
+
+## Programmer daemon: owns the Flash sessions of one or more ports and runs
+## commands sent over a Unix socket, so a port is opened once and not for
+## every query. flashctl.py is the client.
+##
+## The protocol is one JSON object per line both ways. A request names the
+## operation and its port, paths are absolute (the daemon has its own
+## working directory):
+##
+##     {"op": "status", "port": "/dev/ttyACM0"}
+##     {"ok": true, "result": {"BUSY": 0, ...}}
+##
+##     {"op": "flash", "port": "/dev/ttyACM0", "path": "/tmp/top.hex", "release": true}
+##     {"ok": false, "error": "...", "type": "VerifyError"}
+##
+## A session is opened by its first request and stays open, the board is
+## held until the session is released ("release": true in a request, the
+## release operation, the idle timeout or the daemon exit). A session whose
+## link failed is dropped and opened again by the next request.
+
+# largest read returned inline as hex, bigger reads go to a file
+INLINE_LIMIT = 0x100000
+
+
+class Session:
+    def __init__(self, port, debug = False):
+        self.port = port
+        self.flash = Flash()
+        self.flash.debug = debug
+        # the daemon has no terminal, no messages or progress bars
+        self.flash.verbose = False
+        self.flash.open(port)
+        self.lock = threading.Lock()
+        self.used = time.time()
+        self.requests = 0
+        # set once released or dropped, a request that waited for the lock
+        # opens the port again
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.flash.close()
+
+    def drop(self):
+        ## the link is gone, nothing can be released
+        self.closed = True
+        try:
+            self.flash.port.close()
+        except Exception:
+            pass
+
+
+class Daemon:
+    def __init__(self, idle = 0, debug = False):
+        ## idle > 0 releases sessions not used for that many seconds
+        self.idle = idle
+        self.debug = debug
+        self.sessions = {}
+        # guards sessions and locks; a port is opened and released under its
+        # own lock in locks, so a slow open only holds the requests for it
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.started = time.time()
+        self.server = None
+
+    def _port_lock(self, port):
+        with self.lock:
+            return self.locks.setdefault(port, threading.Lock())
+
+    def session(self, port):
+        with self._port_lock(port):
+            with self.lock:
+                session = self.sessions.get(port)
+            if session is None:
+                session = Session(port, self.debug)
+                with self.lock:
+                    self.sessions[port] = session
+            return session
+
+    def release(self, port, idle = None):
+        ## closes the session of port; with idle only if no request has it
+        ## and it was not used for idle seconds
+        with self._port_lock(port):
+            with self.lock:
+                session = self.sessions.get(port)
+            if session is None:
+                return False
+            if not session.lock.acquire(blocking = idle is None):
+                return False
+            try:
+                if idle is not None and time.time() - session.used <= idle:
+                    return False
+                with self.lock:
+                    del self.sessions[port]
+                session.close()
+            finally:
+                session.lock.release()
+        return True
+
+    def release_idle(self):
+        while self.idle > 0:
+            time.sleep(min(self.idle, 1.0))
+            with self.lock:
+                ports = list(self.sessions)
+            for port in ports:
+                try:
+                    self.release(port, self.idle)
+                except FlashError:
+                    pass
+
+    def close(self):
+        for port in list(self.sessions):
+            try:
+                self.release(port)
+            except FlashError:
+                pass
+
+    def handle(self, request):
+        op = request.get('op')
+        if op == 'ping':
+            return {'pid': os.getpid(), 'uptime': time.time() - self.started}
+        if op == 'sessions':
+            now = time.time()
+            return [{'port': p, 'idle': now - s.used, 'requests': s.requests, 'busy': s.lock.locked()}
+                    for p, s in sorted(self.sessions.items())]
+        if op == 'shutdown':
+            threading.Thread(target = self.server.shutdown).start()
+            return None
+        if op not in OPS:
+            raise ValueError('Unknown operation {}'.format(op))
+        port = request.get('port')
+        if port is None:
+            raise ValueError('No port specified.')
+        if op == 'release':
+            return self.release(port)
+        while True:
+            session = self.session(port)
+            session.lock.acquire()
+            if not session.closed:
+                break
+            # released or dropped while this request waited for it
+            session.lock.release()
+        try:
+            session.requests += 1
+            try:
+                return OPS[op](session.flash, request)
+            finally:
+                session.used = time.time()
+        except TransportError:
+            with self.lock:
+                if self.sessions.get(port) is session:
+                    del self.sessions[port]
+            session.drop()
+            raise
+        finally:
+            session.lock.release()
+            if request.get('release') and port in self.sessions:
+                self.release(port)
+
+
+# operations on a session, flash is the open Flash of the request port
+
+def _number(request, key, default = None):
+    value = request.get(key, default)
+    return int(value, 0) if isinstance(value, str) else value
+
+
+def op_id(flash, request):
+    uid = flash.unique_id()
+    result = {'info': flash.get_device_info(), 'uid': uid, 'device': flash.device.to_dict()}
+    from devindex import DeviceIndex
+    index = DeviceIndex(uid)
+    if len(index) > 0:
+        result['index'] = {'image': index.image, 'time': index.time, 'ranges': index.ranges()}
+    return result
+
+
+def op_status(flash, request):
+    return flash.get_device_status()
+
+
+def op_size(flash, request):
+    return flash.get_chip_size()
+
+
+def op_read(flash, request):
+    ## inline hex data, or the data saved to path; digests lists sha256
+    ## and/or crc32 computed on the way, a read for digests only may be
+    ## of any size
+    address = _number(request, 'address', 0)
+    size = _number(request, 'size')
+    if size is None:
+        size = flash.get_chip_size() - address
+    path = request.get('path')
+    digests = request.get('digests', [])
+    inline = path is None and size <= INLINE_LIMIT
+    if path is None and not inline and len(digests) == 0:
+        raise ValueError('{} bytes are too many to return, read to a file'.format(size))
+    sha = hashlib.sha256() if 'sha256' in digests else None
+    crc = 0
+    data = []
+    hh = open(path, mode='wb') if path is not None else None
+    try:
+        for rd in flash.iter_read(address, size):
+            if hh is not None:
+                hh.write(rd)
+            if inline:
+                data.append(rd)
+            if sha is not None:
+                sha.update(rd)
+            if 'crc32' in digests:
+                crc = zlib.crc32(rd, crc)
+    finally:
+        if hh is not None:
+            hh.close()
+    result = {'address': address, 'size': size}
+    if inline:
+        result['data'] = b''.join(data).hex()
+    if sha is not None:
+        result['sha256'] = sha.hexdigest()
+    if 'crc32' in digests:
+        result['crc32'] = '{:08x}'.format(crc)
+    return result
+
+
+def op_write(flash, request):
+    ## words is a list of [address, value] 32-bit words, data hex bytes at address
+    for address, value in request.get('words', []):
+        flash.write_int(address, value)
+    if 'data' in request:
+        flash.write(_number(request, 'address'), bytes.fromhex(request['data']))
+    return flash.flush()
+
+
+def op_erase(flash, request):
+    if request.get('chip'):
+        flash.erase_chip()
+        return [[0, 'chip']]
+    address = _number(request, 'address', 0)
+    size = _number(request, 'size')
+    if size is None:
+        size = flash.get_chip_size() - address
+    plan = flash.erase_range(address, size, request.get('skip_blank', False), request.get('chip_ratio'))
+    return [list(step) for step in plan]
+
+
+def op_blank(flash, request):
+    address = _number(request, 'address', 0)
+    size = _number(request, 'size')
+    if size is None:
+        size = flash.get_chip_size() - address
+    found = flash.blank_check(address, size, _number(request, 'fill', 0xFF), True)
+    return {'blank': found is None, 'found': found}
+
+
+def op_flash(flash, request):
+    ## write_hex and verify_image of flasher.py: erase is 'chip' or
+    ## 'sectors', bsize 12, 15 or 16, update programs only what differs
+    address = _number(request, 'address', 0)
+    image = load_image(request['path'])
+    # the session outlives the request, its verify policy is put back
+    verify = flash.verify
+    try:
+        flash.verify = request.get('verify', 'page')
+        chip = request.get('erase', 'sectors') == 'chip'
+        if chip:
+            flash.erase_chip()
+        journal = None
+        if request.get('resume'):
+            from journal import Journal
+            journal = Journal()
+        index = None
+        if request.get('index'):
+            from devindex import DeviceIndex
+            index = DeviceIndex(flash.unique_id())
+            if chip:
+                index.clear()
+        bsize = request.get('bsize', 16)
+        update = request.get('update', False) and not chip
+        written = flash.write_hex(address, image, bsize, not chip, update, journal, index)
+        ranges = flash.verify_image(address, image)
+    finally:
+        flash.verify = verify
+        image.close()
+    return {'written': written, 'mismatches': [list(r) for r in ranges]}
+
+
+def op_job(flash, request):
+    job = load_manifest(request['path'])
+    log = []
+    verify = flash.verify
+    try:
+        results = job.run(flash, log.append)
+    finally:
+        flash.verify = verify
+        job.close()
+    return {'log': log, 'results': results}
+
+
+OPS = {
+    'id': op_id,
+    'status': op_status,
+    'size': op_size,
+    'read': op_read,
+    'write': op_write,
+    'erase': op_erase,
+    'blank': op_blank,
+    'flash': op_flash,
+    'job': op_job,
+    'release': None
+}
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # any number of requests per connection, one line each
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+                response = {'ok': True, 'result': self.server.flashd.handle(request)}
+            except Exception as e:
+                # the client gets every error, the connection stays up
+                response = {'ok': False, 'error': str(e), 'type': type(e).__name__}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path, daemon):
+    if os.path.exists(path):
+        os.remove(path)
+    server = Server(path, Handler)
+    server.flashd = daemon
+    daemon.server = server
+    os.chmod(path, 0o600)
+    if daemon.idle > 0:
+        threading.Thread(target = daemon.release_idle, daemon = True).start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        daemon.close()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-S', dest='socket', default=None)
+    parser.add_argument('-i', dest='idle', default=0, type=float)
+    parser.add_argument('-d', dest='debug', action='store_true')
+    args = parser.parse_args()
+
+    path = args.socket if args.socket is not None else state_path('flashd.sock')
+    print('Listening on {}'.format(path))
+    try:
+        serve(path, Daemon(args.idle, args.debug))
+    except KeyboardInterrupt:
+        pass
@@ -10,6 +10,12 @@ parser.add_argument('-s', dest='size', default=None, type=int)
 parser.add_argument('-e', dest='full_erase', action='store_true')
 parser.add_argument('-b', dest='block_size', default='64')
 parser.add_argument('-d', dest='debug', action='store_true')
+parser.add_argument('-u', dest='update', action='store_true')
+parser.add_argument('-V', dest='verify', default='page', choices=['none', 'page', 'block', 'image'])
+parser.add_argument('-T', dest='trace', default=None)
+parser.add_argument('-r', dest='resume', action='store_true')
+parser.add_argument('-x', dest='index', action='store_true')
+parser.add_argument('-C', dest='calibrate', action='store_true')
 
 args = parser.parse_args()
 
@@ -37,11 +43,25 @@ else:
     print('Block size value \'{}\' is wrong. Expected 4, 32 or 64'.format(args.block_size))
     exit()
 
-from flash import Flash 
+from flash import Flash, FlashError
+from image import load_image, ImageError
+
+image = None
+if input is not None:
+    # the image is parsed once and shared by write, read and verify
+    try:
+        image = load_image(input)
+    except ImageError as e:
+        print(e)
+        exit()
 
 flash = Flash()
 flash.debug = args.debug
-flash.open(port)
+flash.verify = args.verify
+if args.trace is not None:
+    from telemetry import Telemetry
+    flash.telemetry = Telemetry()
+flash.open(port, args.calibrate)
 
 chip_info = {}
 chip_info = flash.get_device_info()
@@ -55,24 +75,52 @@ else:
     if args.full_erase:
         flash.erase_chip()
     
-    written = flash.write_hex(address, input, bsize, not args.full_erase)
+    journal = None
+    if args.resume:
+        # progress is journaled per device and image, an interrupted run
+        # started again with -r goes on where it stopped
+        from journal import Journal
+        journal = Journal()
+    index = None
+    if args.index:
+        # sectors this device is known to hold already are left out
+        from devindex import DeviceIndex
+        index = DeviceIndex(flash.unique_id())
+        if args.full_erase:
+            index.clear()
+    try:
+        written = flash.write_hex(address, image, bsize, not args.full_erase, args.update and not args.full_erase, journal, index)
+    except FlashError as e:
+        print(e)
+        flash.close()
+        exit(1)
     print('Written: {}'.format(written))
 
 output = args.output
 size = args.size
 
-if output is None:
+if input is not None and args.verify != 'none':
+    # the device is compared with the image while it is read back,
+    # with -o the read back is saved as well
+    print('Verify operation')
+    ranges = flash.verify_image(address, image, output)
+    if len(ranges) > 0:
+        print('Verify failed: {} bytes differ, first at 0x{:06x}'.format(sum([e - s for s, e in ranges]), ranges[0][0]))
+        flash.close()
+        exit(1)
+elif input is not None and output is not None:
+    # -V none: the image span is read back without comparing
+    print('Read operation')
+    flash.read_hex(address, output, image.span)
+elif output is None:
     pass
 else:
     print('Read operation')
-    if size is None:
-        if input is not None:
-            size = written
-    
     flash.read_hex(address, output, size)
-    
-    if input is not None:
-        flash.verify_hex(address, input, output)
 
 flash.close()
 
+if flash.telemetry is not None:
+    print(flash.telemetry.report())
+    flash.telemetry.save(args.trace)
+
@@ -0,0 +1,115 @@
+from collections import OrderedDict
+
+## Random access to the flash content of an open Flash.
+##
+## A FlashView reads the flash lazily in aligned chunks and keeps them in a
+## size bounded LRU cache, so repeated looks at headers, partition tables
+## or config blocks do not go over USB again. When the accesses run
+## forward chunk after chunk the following chunks are read ahead in the
+## same pipelined stream. Every program or erase done through the same
+## Flash drops the chunks it touches.
+##
+##     with FlashView(flash) as view:
+##         magic = view[0x100000:0x100004]
+##         flags = view[0x3FF000]
+
+
+class FlashView:
+    def __init__(self, flash, size = None, chunk = 0x10000, cache = 0x400000, prefetch = 2):
+        ## size defaults to the chip size, cache is the cache size in bytes,
+        ## prefetch the number of chunks read ahead on sequential access
+        self.flash = flash
+        self.size = size if size is not None else flash.get_chip_size()
+        self.chunk = chunk
+        self.capacity = max(1, cache // chunk)
+        self.prefetch = prefetch
+        self.hits = 0
+        self.misses = 0
+        self._chunks = OrderedDict()
+        self._last = None
+        flash.add_listener(self.invalidate)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            if start >= stop:
+                return b''
+            data = self.read(start, stop - start)
+            return data if step == 1 else data[::step]
+        if key < 0:
+            key += self.size
+        if key < 0 or key >= self.size:
+            raise IndexError('flash address out of range')
+        return self.read(key, 1)[0]
+
+    def read(self, address, size):
+        if address < 0 or address + size > self.size:
+            raise IndexError('flash range out of range')
+        # writes still buffered in the Flash go out first
+        self.flash.flush()
+        first = address // self.chunk
+        last = (address + size - 1) // self.chunk
+        sequential = self._last is not None and first in (self._last, self._last + 1)
+        self._load(first, last, self.prefetch if sequential else 0)
+        self._last = last
+        data = bytearray()
+        for index in range(first, last + 1):
+            rd = self._chunks[index]
+            start = max(address, index * self.chunk) - index * self.chunk
+            end = min(address + size, (index + 1) * self.chunk) - index * self.chunk
+            data += rd[start:end]
+        return bytes(data)
+
+    def _load(self, first, last, ahead):
+        ## makes chunks first..last cached, runs of missing chunks (and up to
+        ## ahead chunks after last) are read in one stream each
+        end = min(last + ahead, (self.size - 1) // self.chunk)
+        index = first
+        while index <= end:
+            if index in self._chunks:
+                self._chunks.move_to_end(index)
+                if index <= last:
+                    self.hits += 1
+                index += 1
+                continue
+            run = index
+            while run <= end and run not in self._chunks:
+                run += 1
+            self._fetch(index, run - index)
+            self.misses += len([i for i in range(index, run) if i <= last])
+            index = run
+
+    def _fetch(self, index, count):
+        address = index * self.chunk
+        size = min(count * self.chunk, self.size - address)
+        for rd in self.flash._read_stream(address, size, self.chunk):
+            self._chunks[index] = rd
+            self._chunks.move_to_end(index)
+            index += 1
+            while len(self._chunks) > self.capacity:
+                self._chunks.popitem(last = False)
+
+    def invalidate(self, address = None, size = None):
+        ## drops the cached chunks of [address, address + size), everything
+        ## without a range
+        if address is None or size is None:
+            self._chunks.clear()
+            return
+        first = address // self.chunk
+        last = (address + size - 1) // self.chunk
+        for index in list(self._chunks):
+            if first <= index <= last:
+                del self._chunks[index]
+
+    def close(self):
+        self.flash.remove_listener(self.invalidate)
+        self._chunks.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,299 @@
+import os
+import re
+import mmap
+
+## Image loading for the flash writer.
+##
+## Three formats are understood:
+##   - hex text: space separated hex bytes, the format of the .hex files here
+##   - Intel HEX: ':' records with extended segment/linear address records
+##   - raw binary: memory-mapped, never copied
+## Text formats may have comment lines (#, ; or //) and a CP/M end of file
+## mark (0x1A). A file that looks like neither text format nor binary is
+## rejected rather than flashed as raw bytes.
+##
+## An Image is a list of (offset, memoryview) segments, offsets are relative
+## to the address the image is written to.
+
+HEX_TEXT = 'hex'
+INTEL_HEX = 'ihex'
+BINARY = 'bin'
+
+# text read per bytes.fromhex call while parsing hex text
+PARSE_CHUNK = 1 << 20
+
+# bytes looked at by detect_format
+DETECT_SIZE = 1 << 16
+# share of the tokens of hex text that have to be hex bytes
+HEX_SHARE = 0.95
+
+_HEX_DIGITS = frozenset(b'0123456789abcdefABCDEF')
+_COMMENT = re.compile(r'(#|;|//)[^\n]*')
+_COMMENTS = (b'#', b';', b'//')
+# control bytes that are not in text files
+_CONTROL = frozenset(range(0, 32)) - frozenset(b'\t\n\r\f\v')
+EOF_MARK = '\x1a'
+
+
+class ImageError(ValueError):
+    pass
+
+
+class Image:
+    def __init__(self, segments, name = None, fmt = None):
+        self.segments = segments
+        self.name = name
+        self.format = fmt
+        self._mmap = None
+        self._file = None
+
+    def __len__(self):
+        return sum([len(data) for offset, data in self.segments])
+
+    @property
+    def size(self):
+        return len(self)
+
+    @property
+    def span(self):
+        ## offset of the first byte after the image
+        if len(self.segments) == 0:
+            return 0
+        offset, data = self.segments[-1]
+        return offset + len(data)
+
+    def blocks(self, address, bsize):
+        ## yields (address, memoryview) pieces that never cross a
+        ## (1 << bsize) boundary, the data is not copied
+        mask = (1 << bsize) - 1
+        for offset, data in self.segments:
+            start = address + offset
+            pos = 0
+            while pos < len(data):
+                n = min(((start + pos) | mask) - (start + pos) + 1, len(data) - pos)
+                yield start + pos, data[pos:pos + n]
+                pos += n
+
+    def close(self):
+        self.segments = []
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # blocks handed out are still alive, the map goes with them
+                pass
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _fromhex(text):
+    try:
+        return bytes.fromhex(text)
+    except ValueError:
+        # odd tokens such as single digits, parse them one by one and skip
+        # anything that is not hex like the old line parser did
+        data = bytearray()
+        for x in text.split():
+            try:
+                data.append(int(x, 16) & 0xFF)
+            except ValueError:
+                pass
+        return bytes(data)
+
+
+def _iter_hex_text(path):
+    ## yields the bytes of hex text as it is parsed, PARSE_CHUNK of text at
+    ## a time
+    rest = ''
+    with open(path, mode='rt') as f:
+        while True:
+            text = f.read(PARSE_CHUNK)
+            if len(text) == 0:
+                break
+            text = rest + text
+            end = text.find(EOF_MARK)
+            if end >= 0:
+                rest = text[:end]
+                break
+            # do not split a byte or a comment between two chunks
+            cut = text.rfind('\n')
+            if cut < 0:
+                cut = text.rfind(' ')
+            if cut < 0:
+                rest = text
+                continue
+            rest = text[cut:]
+            data = _fromhex(_COMMENT.sub('', text[:cut]))
+            if len(data) > 0:
+                yield data
+    data = _fromhex(_COMMENT.sub('', rest))
+    if len(data) > 0:
+        yield data
+
+
+def _load_hex_text(path):
+    data = bytearray()
+    for chunk in _iter_hex_text(path):
+        data += chunk
+    return [(0, memoryview(data))] if len(data) > 0 else []
+
+
+def _load_intel_hex(path):
+    segments = []
+    base = 0
+    start = None
+    data = None
+    with open(path, mode='rt') as f:
+        for n, line in enumerate(f):
+            line = line.strip()
+            if line.startswith(EOF_MARK):
+                break
+            if len(line) == 0 or line.startswith(('#', ';', '//')):
+                continue
+            if line[0] != ':':
+                raise ImageError('{}:{}: not an Intel HEX record'.format(path, n + 1))
+            try:
+                rec = bytes.fromhex(line[1:])
+            except ValueError:
+                raise ImageError('{}:{}: bad hex digits'.format(path, n + 1))
+            if len(rec) < 5 or len(rec) != rec[0] + 5:
+                raise ImageError('{}:{}: bad record length'.format(path, n + 1))
+            if sum(rec) & 0xFF != 0:
+                raise ImageError('{}:{}: checksum error'.format(path, n + 1))
+            rtype = rec[3]
+            value = rec[4:-1]
+            if rtype == 0x00:
+                address = base + ((rec[1] << 8) | rec[2])
+                if data is None or address != start + len(data):
+                    if data is not None:
+                        segments.append((start, data))
+                    start = address
+                    data = bytearray()
+                data += value
+            elif rtype == 0x01:
+                break
+            elif rtype == 0x02:
+                base = ((value[0] << 8) | value[1]) << 4
+            elif rtype == 0x04:
+                base = ((value[0] << 8) | value[1]) << 16
+            # 0x03 and 0x05 are start addresses, nothing to program
+    if data is not None:
+        segments.append((start, data))
+
+    # records may come in any order, sort and merge adjacent segments
+    segments.sort(key = lambda s: s[0])
+    merged = []
+    for start, data in segments:
+        if len(data) == 0:
+            continue
+        if len(merged) > 0:
+            prev_start, prev = merged[-1]
+            if start < prev_start + len(prev):
+                raise ImageError('{}: overlapping records at 0x{:08x}'.format(path, start))
+            if start == prev_start + len(prev):
+                prev += data
+                continue
+        merged.append((start, data))
+    return [(start, memoryview(data)) for start, data in merged]
+
+
+def detect_format(path):
+    ## the format by extension, for .hex and others by the content: Intel
+    ## HEX if every line is a ':' record, hex text if nearly all tokens are
+    ## hex bytes, binary if it is not text; anything else, text without a
+    ## byte included, is an ImageError
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.bin', '.raw'):
+        return BINARY
+    if ext in ('.ihex', '.ihx', '.mcs'):
+        return INTEL_HEX
+    # .hex is used both for hex text and for raw dumps, look at the content
+    with open(path, mode='rb') as f:
+        head = f.read(DETECT_SIZE)
+    full = len(head) < DETECT_SIZE
+    head = head.split(EOF_MARK.encode())[0]
+    high = len([c for c in head if c >= 0x80])
+    if any([c in _CONTROL for c in head]) or high > len(head) // 100:
+        return BINARY
+    lines = head.splitlines()
+    if not full and len(lines) > 1:
+        # the last line may be cut
+        lines = lines[:-1]
+    lines = [l.strip() for l in lines]
+    lines = [l for l in lines if len(l) > 0 and not l.startswith(_COMMENTS)]
+    records = len([l for l in lines if l[:1] == b':'])
+    if records > 0 and records == len(lines):
+        return INTEL_HEX
+    if records == 0:
+        tokens = b' '.join(lines).split()
+        if len(tokens) == 0 and full:
+            # empty or cut off by EOF_MARK right away
+            raise ImageError('{}: holds no data'.format(path))
+        hex_tokens = len([t for t in tokens if len(t) <= 2 and all([c in _HEX_DIGITS for c in t])])
+        if hex_tokens >= HEX_SHARE * len(tokens):
+            return HEX_TEXT
+    raise ImageError('{}: neither Intel HEX nor hex text, name a raw image .bin'.format(path))
+
+
+def load_image(path, fmt = None):
+    if fmt is None:
+        fmt = detect_format(path)
+    if fmt in (HEX_TEXT, INTEL_HEX):
+        segments = _load_hex_text(path) if fmt == HEX_TEXT else _load_intel_hex(path)
+        if len(segments) == 0:
+            raise ImageError('{}: holds no data'.format(path))
+        return Image(segments, path, fmt)
+    if fmt == BINARY:
+        image = Image([], path, fmt)
+        if os.path.getsize(path) > 0:
+            image._file = open(path, mode='rb')
+            image._mmap = mmap.mmap(image._file.fileno(), 0, access=mmap.ACCESS_READ)
+            image.segments = [(0, memoryview(image._mmap))]
+        return image
+    raise ImageError('Unknown image format {}'.format(fmt))
+
+
+def stream_image(path, fmt = None):
+    ## yields the (offset, data) segments of the image at path in address
+    ## order while the file is parsed, so writing can start before all of
+    ## it is read; hex text comes in pieces of PARSE_CHUNK text, Intel HEX
+    ## (whose records may be in any order) and binary images are loaded
+    ## first and come as their segments
+    if fmt is None:
+        fmt = detect_format(path)
+    if fmt == HEX_TEXT:
+        offset = 0
+        for data in _iter_hex_text(path):
+            yield offset, memoryview(data)
+            offset += len(data)
+        if offset == 0:
+            raise ImageError('{}: holds no data'.format(path))
+        return
+    image = load_image(path, fmt)
+    try:
+        for segment in image.segments:
+            yield segment
+    finally:
+        image.close()
+
+
+def estimate_size(path, fmt = None):
+    ## data bytes of the image at path without parsing it, for progress:
+    ## exact for binary images, close for hex text and for Intel HEX with
+    ## 16 byte records
+    if fmt is None:
+        fmt = detect_format(path)
+    size = os.path.getsize(path)
+    if fmt == HEX_TEXT:
+        return size // 3
+    if fmt == INTEL_HEX:
+        return size * 16 // 44
+    return size
@@ -0,0 +1,80 @@
+import os
+import json
+import time
+
+## Progress journal of a write_hex run, so an interrupted run can go on
+## where it stopped.
+##
+## The journal is keyed by a digest of the device unique ID, the image and
+## the write arguments (Flash._journal_key). It counts the erase commands
+## and the blocks done so far and is saved at most every interval seconds
+## while the run goes on, so a resumed run repeats at most a few blocks;
+## programming a block again with the same data does not change it.
+##
+##     journal = Journal()
+##     flash.write_hex(0, 'image.hex', 12, True, journal = journal)
+
+# per user state of the tools: journals, device indexes, link calibration
+STATE_DIR = os.path.join(os.path.expanduser('~'), '.usb2spi')
+
+
+def state_path(*names):
+    ## path of a file under STATE_DIR, the directories are created
+    path = os.path.join(STATE_DIR, *names)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    return path
+
+
+class Journal:
+    def __init__(self, path = None, interval = 0.5):
+        ## path None keeps the journal under STATE_DIR/journal, named by key
+        self.path = path
+        self.interval = interval
+        self.key = None
+        self.erased = 0
+        self.programmed = 0
+        self._saved = 0.0
+
+    def begin(self, key):
+        ## loads the state saved for key, returns True if there is one
+        self.key = key
+        if self.path is None:
+            self.path = state_path('journal', key[:32] + '.json')
+        self.erased = 0
+        self.programmed = 0
+        try:
+            with open(self.path, mode='rt') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if state.get('key') != key:
+            return False
+        self.erased = state.get('erased', 0)
+        self.programmed = state.get('programmed', 0)
+        return self.erased > 0 or self.programmed > 0
+
+    def update(self, erased = None, programmed = None):
+        if erased is not None:
+            self.erased = erased
+        if programmed is not None:
+            self.programmed = programmed
+        if time.time() - self._saved >= self.interval:
+            self.save()
+
+    def save(self):
+        # written next to the journal and renamed, never half written
+        tmp = self.path + '.tmp'
+        with open(tmp, mode='wt') as f:
+            json.dump({'key': self.key, 'erased': self.erased, 'programmed': self.programmed, 'time': time.time()}, f)
+        os.replace(tmp, self.path)
+        self._saved = time.time()
+
+    def reset(self):
+        self.erased = 0
+        self.programmed = 0
+        self.save()
+
+    def finish(self):
+        ## the run is complete, nothing to resume
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
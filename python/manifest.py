@@ -0,0 +1,246 @@
+import os
+import json
+from image import Image, load_image, ImageError
+
+## Job manifests: several regions of one device written in one session.
+##
+## A manifest is a JSON file:
+##
+##     {
+##         "erase": "sectors",
+##         "verify": "page",
+##         "regions": [
+##             {"name": "bitstream", "address": "0x000000", "image": "top.bit"},
+##             {"name": "user", "address": "0x200000", "size": "0x10000", "program": false, "blank_check": true},
+##             {"name": "config", "address": "0x3FF000", "data": "a5 5a 01 00", "update": true}
+##         ]
+##     }
+##
+## "erase" is "sectors" (default, the sectors under every erased region),
+## "chip" (one chip erase first) or "none". "verify" is the program verify
+## policy of Flash.verify. A region has an "address" and either an "image"
+## (a path relative to the manifest), inline hex "data", or a "size" only.
+## Per region actions, all optional:
+##     "erase"        erase the sectors under the region before programming,
+##                    default true for regions with content
+##     "update"       program only what differs, keeps the region unerased
+##     "program"      default true for regions with content
+##     "verify"       compare the region with its content after programming,
+##                    default true for regions with content
+##     "blank_check"  check that the region is erased, default false
+##
+## All erases run first as one plan, then all regions are programmed, then
+## verified and blank checked.
+
+ERASE_POLICIES = ('sectors', 'chip', 'none')
+VERIFY_POLICIES = ('none', 'page', 'block', 'image')
+REGION_KEYS = ('name', 'address', 'image', 'data', 'size', 'erase', 'update', 'program', 'verify', 'blank_check')
+
+SECTOR = 0x1000
+
+
+class ManifestError(ValueError):
+    pass
+
+
+def _number(value, what):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    try:
+        return int(value, 0)
+    except (TypeError, ValueError):
+        raise ManifestError('{}: {!r} is not a number'.format(what, value))
+
+
+def _flag(region, key, default):
+    value = region.get(key, default)
+    if not isinstance(value, bool):
+        raise ManifestError('{}: "{}" must be true or false'.format(region['name'], key))
+    return value
+
+
+class Region:
+    def __init__(self, name, address, image = None, size = None):
+        self.name = name
+        self.address = address
+        self.image = image
+        # bytes covered by the region: the image span or the given size
+        self.size = image.span if image is not None else size
+        self.erase = False
+        self.update = False
+        self.program = False
+        self.verify = False
+        self.blank_check = False
+
+    @property
+    def end(self):
+        return self.address + self.size
+
+    def sectors(self):
+        ## [start, end) of the region rounded out to 4K sectors
+        return self.address & ~(SECTOR - 1), (self.end + SECTOR - 1) & ~(SECTOR - 1)
+
+
+class Job:
+    def __init__(self, regions, erase = 'sectors', verify = 'page', name = None):
+        self.regions = regions
+        self.erase = erase
+        self.verify = verify
+        self.name = name
+        self.validate()
+
+    def validate(self):
+        ## regions must not overlap, and a sector erased for one region must
+        ## not hold a region that is kept
+        regions = sorted(self.regions, key = lambda r: r.address)
+        for a, b in zip(regions, regions[1:]):
+            if b.address < a.end:
+                raise ManifestError('Regions {} and {} overlap at 0x{:06x}'.format(a.name, b.name, b.address))
+        for a in regions:
+            if not a.erase:
+                continue
+            start, end = a.sectors()
+            for b in regions:
+                if b is a or b.erase or b.size == 0:
+                    continue
+                if b.address < end and start < b.end:
+                    raise ManifestError('Erasing the sectors of {} would erase {} at 0x{:06x}'.format(a.name, b.name, max(start, b.address)))
+        if self.erase == 'chip':
+            for r in regions:
+                if r.update or (r.size > 0 and not r.erase and not r.program):
+                    raise ManifestError('Chip erase would erase {}'.format(r.name))
+
+    def erase_ranges(self):
+        ## merged [start, end) sector ranges of all erased regions, adjacent
+        ## regions are merged so the planner can use bigger blocks
+        ranges = []
+        for r in sorted(self.regions, key = lambda r: r.address):
+            if not r.erase or r.size == 0:
+                continue
+            start, end = r.sectors()
+            if len(ranges) > 0 and start <= ranges[-1][1]:
+                ranges[-1][1] = max(end, ranges[-1][1])
+            else:
+                ranges.append([start, end])
+        return [(start, end) for start, end in ranges]
+
+    def plan(self, flash):
+        ## the erase plan of the whole job as [(address, op)]
+        if self.erase == 'chip':
+            return [(0, 'chip')]
+        if self.erase == 'none':
+            return []
+        plan = []
+        for start, end in self.erase_ranges():
+            plan += flash.plan_erase(start, end - start)
+        return plan
+
+    def run(self, flash, log = print):
+        ## runs the job on an open Flash, returns one result dict per region
+        ## with 'ok' and what failed in 'error'
+        chip_size = flash.get_chip_size()
+        for r in self.regions:
+            if r.end > chip_size:
+                raise ManifestError('{} ends at 0x{:06x}, beyond the chip (0x{:06x} bytes)'.format(r.name, r.end, chip_size))
+        flash.verify = self.verify
+        results = dict([(r.name, {'name': r.name, 'ok': True, 'error': None}) for r in self.regions])
+
+        plan = self.plan(flash)
+        if len(plan) > 0:
+            log('Erasing: {} commands'.format(len(plan)))
+            flash._run_plan(plan)
+        regions = sorted(self.regions, key = lambda r: r.address)
+        for r in regions:
+            if r.program:
+                log('Programming {} at 0x{:06x}'.format(r.name, r.address))
+                flash.write_hex(r.address, r.image, 12 if r.update else None, False, r.update)
+        for r in regions:
+            if r.program and r.verify:
+                ranges = flash.verify_image(r.address, r.image)
+                if len(ranges) > 0:
+                    results[r.name]['ok'] = False
+                    results[r.name]['error'] = 'verify: {} bytes differ, first at 0x{:06x}'.format(
+                        sum([e - s for s, e in ranges]), ranges[0][0])
+            if r.blank_check:
+                found = flash.blank_check(r.address, r.size, 0xFF, True)
+                if found is not None:
+                    results[r.name]['ok'] = False
+                    results[r.name]['error'] = 'not blank at 0x{:06x}'.format(found)
+        return [results[r.name] for r in self.regions]
+
+    def close(self):
+        for r in self.regions:
+            if r.image is not None:
+                r.image.close()
+
+
+def _region(spec, base, index):
+    if not isinstance(spec, dict):
+        raise ManifestError('Region {} is not an object'.format(index))
+    name = str(spec.get('name', 'region{}'.format(index)))
+    spec = dict(spec)
+    spec['name'] = name
+    for key in spec:
+        if key not in REGION_KEYS:
+            raise ManifestError('{}: unknown key "{}"'.format(name, key))
+    if 'address' not in spec:
+        raise ManifestError('{}: no address'.format(name))
+    address = _number(spec['address'], name + ' address')
+    sources = [key for key in ('image', 'data', 'size') if key in spec]
+    if len(sources) != 1:
+        raise ManifestError('{}: expected exactly one of image, data or size'.format(name))
+    if 'image' in spec:
+        path = spec['image']
+        if not os.path.isabs(path):
+            path = os.path.join(base, path)
+        if not os.path.exists(path):
+            raise ManifestError('{}: image {} not found'.format(name, path))
+        try:
+            region = Region(name, address, load_image(path))
+        except ImageError as e:
+            raise ManifestError('{}: {}'.format(name, e))
+    elif 'data' in spec:
+        try:
+            data = bytes.fromhex(spec['data'])
+        except (TypeError, ValueError):
+            raise ManifestError('{}: data is not hex'.format(name))
+        region = Region(name, address, Image([(0, memoryview(data))], name))
+    else:
+        region = Region(name, address, None, _number(spec['size'], name + ' size'))
+
+    content = region.image is not None
+    region.update = _flag(spec, 'update', False)
+    region.erase = _flag(spec, 'erase', content and not region.update)
+    region.program = _flag(spec, 'program', content)
+    region.verify = _flag(spec, 'verify', content)
+    region.blank_check = _flag(spec, 'blank_check', False)
+    if region.update and region.erase:
+        raise ManifestError('{}: update and erase exclude each other'.format(name))
+    if region.program and not content:
+        raise ManifestError('{}: nothing to program'.format(name))
+    if region.blank_check and region.program:
+        raise ManifestError('{}: a programmed region cannot be blank'.format(name))
+    return region
+
+
+def load_manifest(path):
+    try:
+        with open(path, mode='rt') as f:
+            spec = json.load(f)
+    except ValueError as e:
+        raise ManifestError('{}: {}'.format(path, e))
+    if not isinstance(spec, dict) or not isinstance(spec.get('regions'), list):
+        raise ManifestError('{}: expected an object with a "regions" list'.format(path))
+    erase = spec.get('erase', 'sectors')
+    if erase not in ERASE_POLICIES:
+        raise ManifestError('{}: erase must be one of {}'.format(path, ', '.join(ERASE_POLICIES)))
+    verify = spec.get('verify', 'page')
+    if verify not in VERIFY_POLICIES:
+        raise ManifestError('{}: verify must be one of {}'.format(path, ', '.join(VERIFY_POLICIES)))
+    base = os.path.dirname(os.path.abspath(path))
+    regions = [_region(r, base, i) for i, r in enumerate(spec['regions'])]
+    names = [r.name for r in regions]
+    for name in names:
+        if names.count(name) > 1:
+            raise ManifestError('{}: region name {} is used twice'.format(path, name))
+    return Job(regions, erase, verify, path)
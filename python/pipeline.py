@@ -0,0 +1,76 @@
+import queue
+import threading
+import time
+
+## Two stage pipeline: a background thread produces the items of an
+## iterable while the calling thread consumes them, at most depth items
+## wait in between. Flash.write_hex uses it to parse the image and plan the
+## next units while the current one erases or programs; the device stage
+## stays on the calling thread, only the producer runs in the background.
+##
+##     pipeline = Pipeline(units(), 2)
+##     try:
+##         for unit in pipeline:
+##             program(unit)
+##     finally:
+##         pipeline.close()
+##
+## An exception of the producer is raised in the consumer when it gets to
+## the item that failed.
+
+# seconds between checks of the stop flag of a producer waiting for room
+STOP_CHECK = 0.1
+
+
+class Pipeline:
+    def __init__(self, items, depth = 2):
+        self.queue = queue.Queue(depth)
+        self.stopped = threading.Event()
+        # seconds the consumer waited for the producer
+        self.waited = 0.0
+        self.thread = threading.Thread(target = self._produce, args = (items,), daemon = True)
+        self.thread.start()
+
+    def _produce(self, items):
+        try:
+            for item in items:
+                if not self._put((True, item)):
+                    return
+            self._put((False, None))
+        except BaseException as e:
+            self._put((False, e))
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+
+    def _put(self, entry):
+        ## False if the consumer stopped the pipeline
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout = STOP_CHECK)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        while True:
+            started = time.time()
+            more, item = self.queue.get()
+            self.waited += time.time() - started
+            if not more:
+                if item is not None:
+                    raise item
+                return
+            yield item
+
+    def close(self):
+        ## stops the producer and waits for it, items not consumed are dropped
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,204 @@
+import os
+import json
+import struct
+from journal import state_path
+
+## Device descriptor of the flash part, from its JEDEC SFDP table
+## (Serial Flash Discoverable Parameters, JESD216) where the part and the
+## bridge firmware support READ_SFDP (0x5A), otherwise from the built-in
+## W25Q32 values of Flash.
+##
+## Only the Basic Flash Parameter Table is used: density, page size, erase
+## types with their opcodes, typical and maximum erase and program times,
+## the address modes and how a part over 16MB takes 4-byte addresses.
+## Fast read (0x0B, single line) is not described by the table, every
+## JESD216 part takes 8 dummy clocks.
+## Descriptors read from SFDP are cached per JEDEC ID under
+## STATE_DIR/devices, so the table is read once per part type.
+
+SIGNATURE = b'SFDP'
+# parameter ID of the Basic Flash Parameter Table
+BFPT_ID = 0xFF00
+
+# units of the BFPT time fields in seconds
+ERASE_UNITS = [0.001, 0.016, 0.128, 1.0]
+CHIP_UNITS = [0.016, 0.256, 4.0, 64.0]
+PAGE_UNITS = [8e-6, 64e-6]
+
+ADDRESS_MODES = {0: '3', 1: '3or4', 2: '4'}
+
+# DWORD 16 bits 31:24, the ways into 4-byte addressing: B7 with or
+# without write enable first, the 4-byte opcodes (13, 0C, 12, 21, 5C,
+# DC), always 4-byte; the others (address registers) are not used
+FOUR_BYTE_METHODS = [(0x01, 'enter'), (0x02, 'enter'), (0x20, 'dedicated'), (0x40, 'always')]
+
+
+class SfdpError(ValueError):
+    pass
+
+
+class Descriptor:
+    def __init__(self, jedec_id, size, page_size = 256, erase = None, timings = None,
+                 fast_read = (0x0B, 8), address_mode = '3', four_byte = None, source = 'builtin'):
+        self.jedec_id = list(jedec_id)
+        # bytes
+        self.size = size
+        self.page_size = page_size
+        # erase types: size bits (12 for 4K) -> opcode
+        self.erase = dict(erase) if erase is not None else {}
+        # (typical, maximum) seconds per operation, named as Flash.TIMINGS
+        self.timings = dict([(op, tuple(t)) for op, t in timings.items()]) if timings is not None else {}
+        # opcode and dummy clocks of the single line fast read
+        self.fast_read = tuple(fast_read)
+        # '3', '3or4' or '4' address bytes
+        self.address_mode = address_mode
+        # ways into 4-byte addressing, see FOUR_BYTE_METHODS
+        self.four_byte = list(four_byte) if four_byte is not None else []
+        # 'sfdp' or 'builtin'
+        self.source = source
+
+    def to_dict(self):
+        return {
+            'jedec_id': self.jedec_id,
+            'size': self.size,
+            'page_size': self.page_size,
+            'erase': dict([(str(bits), op) for bits, op in self.erase.items()]),
+            'timings': dict([(op, list(t)) for op, t in self.timings.items()]),
+            'fast_read': list(self.fast_read),
+            'address_mode': self.address_mode,
+            'four_byte': self.four_byte,
+            'source': self.source
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['jedec_id'], d['size'], d['page_size'], dict([(int(b), op) for b, op in d['erase'].items()]),
+                   d['timings'], d['fast_read'], d['address_mode'], d.get('four_byte'), d['source'])
+
+    def save(self):
+        path = cache_path(self.jedec_id)
+        tmp = path + '.tmp'
+        with open(tmp, mode='wt') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.replace(tmp, path)
+
+
+def cache_path(jedec_id):
+    return state_path('devices', bytes(jedec_id).hex() + '.json')
+
+
+def load(jedec_id):
+    ## the cached descriptor of the part, None if there is none
+    try:
+        with open(cache_path(jedec_id), mode='rt') as f:
+            return Descriptor.from_dict(json.load(f))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def parse_header(data):
+    ## the 8 byte SFDP header, returns the number of parameter headers
+    if len(data) < 8 or bytes(data[0:4]) != SIGNATURE:
+        raise SfdpError('No SFDP signature')
+    if data[5] != 1:
+        raise SfdpError('SFDP major revision {} is not supported'.format(data[5]))
+    return data[6] + 1
+
+
+def parse_parameters(data):
+    ## the parameter headers, returns [(id, minor, major, dwords, pointer)]
+    params = []
+    for offset in range(0, len(data) - 7, 8):
+        h = data[offset:offset + 8]
+        params.append(((h[7] << 8) | h[0], h[1], h[2], h[3], h[4] | (h[5] << 8) | (h[6] << 16)))
+    return params
+
+
+def find_bfpt(params):
+    ## (pointer, dwords) of the newest Basic Flash Parameter Table
+    bfpt = [p for p in params if p[0] == BFPT_ID]
+    if len(bfpt) == 0:
+        raise SfdpError('No basic flash parameter table')
+    pid, minor, major, dwords, pointer = max(bfpt, key = lambda p: (p[2], p[1]))
+    return pointer, dwords
+
+
+def parse_bfpt(jedec_id, data):
+    ## Descriptor from the Basic Flash Parameter Table data
+    count = len(data) // 4
+    if count < 2:
+        raise SfdpError('Basic flash parameter table too short')
+    dw = struct.unpack('<{}I'.format(count), bytes(data[:count * 4]))
+
+    # DWORD 2: density in bits, or 2^N bits with bit 31 set
+    if dw[1] & 0x80000000:
+        size = (1 << (dw[1] & 0x7FFFFFFF)) // 8
+    else:
+        size = (dw[1] + 1) // 8
+
+    # DWORD 1: address bytes and the 4K erase opcode
+    address_mode = ADDRESS_MODES.get((dw[0] >> 17) & 3, '3')
+    erase = {}
+    if (dw[0] & 3) == 1:
+        erase[12] = (dw[0] >> 8) & 0xFF
+
+    # DWORD 8, 9: erase types, size as 2^N bytes and opcode
+    if count >= 9:
+        types = [(dw[7] & 0xFFFF), (dw[7] >> 16), (dw[8] & 0xFFFF), (dw[8] >> 16)]
+    else:
+        types = []
+    sizes = []
+    for t in types:
+        bits = t & 0xFF
+        sizes.append(bits)
+        if bits != 0:
+            erase[bits] = t >> 8
+
+    timings = {}
+    page_size = 256
+    # DWORD 10: erase times, DWORD 11: page size, program and chip erase
+    # times (JESD216A on); the maximum is a multiple of the typical time
+    if count >= 11:
+        multiplier = 2 * ((dw[9] & 0xF) + 1)
+        for i, bits in enumerate(sizes):
+            if bits == 0:
+                continue
+            units = ERASE_UNITS[(dw[9] >> (9 + 7 * i)) & 3]
+            typ = (((dw[9] >> (4 + 7 * i)) & 0x1F) + 1) * units
+            timings['erase_{}k'.format((1 << bits) >> 10)] = (typ, typ * multiplier)
+        multiplier = 2 * ((dw[10] & 0xF) + 1)
+        page_size = 1 << ((dw[10] >> 4) & 0xF)
+        typ = (((dw[10] >> 8) & 0x1F) + 1) * PAGE_UNITS[(dw[10] >> 13) & 1]
+        timings['page'] = (typ, typ * multiplier)
+        typ = (((dw[10] >> 24) & 0x1F) + 1) * CHIP_UNITS[(dw[10] >> 29) & 3]
+        timings['chip'] = (typ, typ * multiplier)
+    # DWORD 16: 4-byte address entry (JESD216B on)
+    four_byte = []
+    if count >= 16:
+        for bit, method in FOUR_BYTE_METHODS:
+            if (dw[15] >> 24) & bit and method not in four_byte:
+                four_byte.append(method)
+    if size == 0 or page_size < 16:
+        raise SfdpError('Basic flash parameter table is not valid')
+    return Descriptor(jedec_id, size, page_size, erase, timings, (0x0B, 8), address_mode, four_byte, 'sfdp')
+
+
+def discover(jedec_id, read):
+    ## reads and parses the SFDP table with read(address, size), which
+    ## returns the bytes or None when READ_SFDP gets no response
+    ## returns None if there is no usable table
+    try:
+        header = read(0, 8)
+        if header is None:
+            return None
+        count = parse_header(header)
+        params = read(8, count * 8)
+        if params is None:
+            return None
+        pointer, dwords = find_bfpt(parse_parameters(params))
+        bfpt = read(pointer, dwords * 4)
+        if bfpt is None:
+            return None
+        return parse_bfpt(jedec_id, bfpt)
+    except SfdpError:
+        return None
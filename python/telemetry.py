@@ -0,0 +1,162 @@
+import time
+import json
+import csv
+
+## Transaction level telemetry for Flash.
+##
+## Assign an instance to Flash.telemetry to record every USB transaction
+## (opcode of the first frame, frames, bytes out and in, latency from the
+## send to the complete response, resends) and every busy wait. Records and
+## summaries are grouped by the operation the Flash is in: erase, program,
+## read, verify, blank or 'other'. With Flash.telemetry = None (the default)
+## the transport only pays one attribute test per transaction.
+##
+##     flash.telemetry = Telemetry()
+##     flash.write_hex(0, 'image.hex')
+##     print(flash.telemetry.report())
+##     flash.telemetry.save('trace.json')  # or trace.csv
+
+# latency histogram buckets in microseconds, the last one is open ended
+BUCKETS = [50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000]
+
+FIELDS = ['time', 'phase', 'opcode', 'frames', 'bytes_out', 'bytes_in', 'expected', 'latency', 'resend']
+
+
+class _Phase:
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.telemetry._push(self.name)
+        return self
+
+    def __exit__(self, *args):
+        self.telemetry._pop()
+
+
+class Telemetry:
+    def __init__(self, records = True):
+        # with records = False only the summaries are kept
+        self.keep_records = records
+        self.records = []
+        self.started = time.time()
+        self.summary = {}
+        self.waits = {}
+        self._stack = [['other', self.started]]
+
+    def _phase_summary(self, name):
+        s = self.summary.get(name)
+        if s is None:
+            s = {'transactions': 0, 'frames': 0, 'bytes_out': 0, 'bytes_in': 0,
+                 'short': 0, 'resends': 0, 'polls': 0, 'time': 0.0, 'latency': 0.0,
+                 'histogram': [0] * (len(BUCKETS) + 1)}
+            self.summary[name] = s
+        return s
+
+    # phases
+
+    def phase(self, name):
+        ## context manager, transactions inside are counted for name;
+        ## phases nest and time is counted for the innermost one only
+        return _Phase(self, name)
+
+    def _push(self, name):
+        now = time.time()
+        top = self._stack[-1]
+        self._phase_summary(top[0])['time'] += now - top[1]
+        self._stack.append([name, now])
+
+    def _pop(self):
+        now = time.time()
+        name, started = self._stack.pop()
+        self._phase_summary(name)['time'] += now - started
+        self._stack[-1][1] = now
+
+    # recording, called by the transport
+
+    def transaction(self, opcode, frames, bytes_out, bytes_in, expected, latency, resend = False):
+        name = self._stack[-1][0]
+        s = self._phase_summary(name)
+        s['transactions'] += 1
+        s['frames'] += frames
+        s['bytes_out'] += bytes_out
+        s['bytes_in'] += bytes_in
+        s['latency'] += latency
+        if bytes_in < expected:
+            s['short'] += 1
+        if resend:
+            s['resends'] += 1
+        us = latency * 1e6
+        i = 0
+        while i < len(BUCKETS) and us > BUCKETS[i]:
+            i += 1
+        s['histogram'][i] += 1
+        if self.keep_records:
+            self.records.append([time.time() - self.started, name, opcode, frames,
+                                 bytes_out, bytes_in, expected, latency, resend])
+
+    def wait(self, op, elapsed, polls):
+        ## one busy wait of a flash operation (page, erase_4k, chip, ...)
+        self._phase_summary(self._stack[-1][0])['polls'] += polls
+        count, total, longest, total_polls = self.waits.get(op, (0, 0.0, 0.0, 0))
+        self.waits[op] = (count + 1, total + elapsed, max(longest, elapsed), total_polls + polls)
+
+    # results
+
+    def phases(self):
+        ## summary per phase with the time of a phase still running and the
+        ## throughput in MB/s over that time
+        now = time.time()
+        result = {}
+        for name, s in self.summary.items():
+            s = dict(s)
+            s['histogram'] = list(s['histogram'])
+            # outer phases are paused, only the innermost one is running
+            if name == self._stack[-1][0]:
+                s['time'] += now - self._stack[-1][1]
+            moved = s['bytes_out'] + s['bytes_in']
+            s['mbps'] = moved / s['time'] / 1e6 if s['time'] > 0 else 0.0
+            result[name] = s
+        return result
+
+    def report(self):
+        lines = []
+        lines.append('{:<8} {:>8} {:>8} {:>10} {:>10} {:>6} {:>7} {:>8} {:>8} {:>8}'.format(
+            'phase', 'time', 'trans', 'out', 'in', 'short', 'resend', 'polls', 'avg us', 'MB/s'))
+        for name, s in sorted(self.phases().items()):
+            if s['transactions'] == 0:
+                continue
+            lines.append('{:<8} {:>8.3f} {:>8} {:>10} {:>10} {:>6} {:>7} {:>8} {:>8.0f} {:>8.3f}'.format(
+                name, s['time'], s['transactions'], s['bytes_out'], s['bytes_in'], s['short'],
+                s['resends'], s['polls'], s['latency'] / s['transactions'] * 1e6, s['mbps']))
+        for op, (count, total, longest, polls) in sorted(self.waits.items()):
+            lines.append('wait {:<10} {:>6} x {:>8.2f} ms avg, {:>8.2f} ms max, {:.1f} polls avg'.format(
+                op, count, total / count * 1e3, longest * 1e3, polls / count))
+        return '\n'.join(lines)
+
+    def histogram(self, name):
+        ## (upper bound in us or None, count) pairs of the latency histogram
+        s = self._phase_summary(name)
+        return list(zip(BUCKETS + [None], s['histogram']))
+
+    def to_dict(self):
+        return {
+            'phases': self.phases(),
+            'buckets_us': BUCKETS,
+            'waits': dict([(op, {'count': c, 'total': t, 'longest': l, 'polls': p})
+                           for op, (c, t, l, p) in self.waits.items()]),
+            'records': [dict(zip(FIELDS, r)) for r in self.records]
+        }
+
+    def save(self, path):
+        ## .csv writes one row per transaction, anything else is JSON with
+        ## the summaries and the records
+        if path.lower().endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                w = csv.writer(f)
+                w.writerow(FIELDS)
+                w.writerows(self.records)
+        else:
+            with open(path, 'w') as f:
+                json.dump(self.to_dict(), f, indent=1)
@@ -0,0 +1,213 @@
+## Stand-in for the USB2SPI bridge and a W25Q flash behind it, for the tests.
+##
+## Port speaks the spi_ctrl frame protocol (opcode, 16-bit length, payload);
+## frames whose opcode is on the read list are answered with the MISO bytes
+## of the whole frame. Chip keeps the memory of a W25Q-like part, with
+## 4-byte addressing and an optional SFDP table. A program or erase keeps
+## it busy for a number of status polls, not for a time, so the tests do
+## not depend on the load of the host.
+##
+##     chip = Chip()
+##     PORTS['test'] = chip
+##     flash.open('test')
+
+# opcodes spi_ctrl answers
+READS = set([0x05, 0x35, 0x03, 0x0B, 0x90, 0x4B, 0x9F, 0x5A, 0x13, 0x0C])
+
+ERASES = {0x20: 0x1000, 0x21: 0x1000, 0x52: 0x8000, 0x5C: 0x8000, 0xD8: 0x10000, 0xDC: 0x10000}
+
+# chips behind the port names given to serial.Serial
+PORTS = {}
+
+
+class Chip:
+    def __init__(self, size = 4 << 20, jedec = (0xEF, 0x40, 0x16), sfdp = None):
+        self.size = size
+        self.mem = bytearray(b'\xFF' * size)
+        self.jedec = bytes(jedec)
+        self.sfdp = sfdp
+        self.uid = bytes(range(0x10, 0x18))
+        self.wel = False
+        self.four = False
+        # status polls a page program or erase reports busy for, and the
+        # polls left of the current one; done by the first poll the typical
+        # times are tuned without the wall time (see Flash._observe)
+        self.busy = 0
+        self.busy_left = 0
+        # page address -> count: the next programs of that page store 0x00
+        self.corrupt = {}
+        # (op, address) of every program and erase
+        self.log = []
+
+    def is_busy(self):
+        return self.busy_left > 0
+
+    def _address(self, mosi, n):
+        a = 0
+        for b in mosi[1:1 + n]:
+            a = (a << 8) | b
+        return a
+
+    def xfer(self, mosi):
+        op = mosi[0]
+        miso = bytearray(b'\xFF' * len(mosi))
+        if op == 0x05:
+            for i in range(1, len(mosi)):
+                miso[i] = (1 if self.is_busy() else 0) | (2 if self.wel else 0)
+            self.busy_left = max(0, self.busy_left - 1)
+            return miso
+        if op == 0x35:
+            miso[1:] = bytes(len(mosi) - 1)
+            return miso
+        if self.is_busy():
+            return miso
+        an = 4 if self.four or op in (0x13, 0x0C, 0x12, 0x21, 0x5C, 0xDC) else 3
+        if op in (0x03, 0x0B, 0x13, 0x0C):
+            dummies = 1 if op in (0x0B, 0x0C) else 0
+            a = self._address(mosi, an)
+            for i in range(1 + an + dummies, len(mosi)):
+                miso[i] = self.mem[(a + i - 1 - an - dummies) % self.size]
+        elif op == 0x9F:
+            for i in range(1, len(mosi)):
+                miso[i] = self.jedec[(i - 1) % 3]
+        elif op == 0x4B:
+            # 4 dummy bytes, 5 in 4-byte address mode
+            start = 6 if self.four else 5
+            for i in range(start, len(mosi)):
+                miso[i] = self.uid[(i - start) % 8]
+        elif op == 0x5A and self.sfdp is not None:
+            a = self._address(mosi, 3)
+            for i in range(5, len(mosi)):
+                j = a + i - 5
+                miso[i] = self.sfdp[j] if j < len(self.sfdp) else 0xFF
+        elif op == 0x06:
+            self.wel = True
+        elif op == 0x04:
+            self.wel = False
+        elif op == 0xB7:
+            self.four = True
+        elif op == 0xE9:
+            self.four = False
+        elif op in (0x02, 0x12) and self.wel:
+            a = self._address(mosi, an)
+            page = a & ~0xFF
+            self.log.append((op, a))
+            bad = self.corrupt.get(page, 0) > 0
+            if bad:
+                self.corrupt[page] -= 1
+            for i, b in enumerate(mosi[1 + an:]):
+                p = (page | ((a + i) & 0xFF)) % self.size
+                self.mem[p] &= 0 if bad else b
+            self.wel = False
+            self.busy_left = self.busy
+        elif op in ERASES and self.wel:
+            size = ERASES[op]
+            a = self._address(mosi, an) & ~(size - 1)
+            self.log.append((op, a))
+            self.mem[a:a + size] = b'\xFF' * size
+            self.wel = False
+            self.busy_left = self.busy
+        elif op in (0xC7, 0x60) and self.wel:
+            self.log.append((op, 0))
+            self.mem[:] = b'\xFF' * self.size
+            self.wel = False
+            self.busy_left = self.busy
+        return miso
+
+
+class Port:
+    def __init__(self, port, write_timeout = None, timeout = None, **kwargs):
+        if port not in PORTS:
+            raise SerialException('could not open port {}'.format(port))
+        self.port = port
+        self.timeout = timeout
+        self.chip = PORTS[port]
+        self.active = False
+        self.closed = False
+        self.inbuf = bytearray()
+        self.out = bytearray()
+        # response bytes sent so far, [offset, count] of response bytes to
+        # lose at that offset of the stream, and the offset from which the
+        # response comes late: only once the port is polled (in_waiting)
+        self.sent = 0
+        self.lose = None
+        self.hold = None
+        self.late = bytearray()
+        # frames received
+        self.frames = 0
+
+    def write(self, data):
+        self.inbuf += bytes(data)
+        while len(self.inbuf) >= 3:
+            op = self.inbuf[0]
+            length = self.inbuf[1] | (self.inbuf[2] << 8)
+            if len(self.inbuf) < 3 + length:
+                break
+            mosi = bytes(self.inbuf[0:1]) + bytes(self.inbuf[3:3 + length])
+            del self.inbuf[:3 + length]
+            self.frames += 1
+            if op == 0x06 and not self.active:
+                self.active = True
+                continue
+            if op == 0x04:
+                self.active = False
+                continue
+            if not self.active:
+                continue
+            miso = self.chip.xfer(mosi)
+            if op in READS:
+                self._respond(miso)
+        return len(data)
+
+    def _respond(self, miso):
+        if self.lose is not None and self.sent + len(miso) > self.lose[0]:
+            cut = self.lose[0] - self.sent
+            miso = miso[:cut] + miso[cut + self.lose[1]:]
+            self.sent += self.lose[1]
+            self.lose = None
+        if len(self.late) > 0:
+            # queued behind the late part
+            self.late += miso
+            self.sent += len(miso)
+            return
+        if self.hold is not None and self.sent + len(miso) > self.hold:
+            cut = max(0, self.hold - self.sent)
+            self.late += miso[cut:]
+            self.sent += len(miso) - cut
+            miso = miso[:cut]
+            self.hold = None
+        self.out += miso
+        self.sent += len(miso)
+
+    def flush(self):
+        pass
+
+    def readinto(self, buf):
+        n = min(len(buf), len(self.out))
+        buf[:n] = self.out[:n]
+        del self.out[:n]
+        return n
+
+    def read(self, n = 1):
+        data = bytes(self.out[:n])
+        del self.out[:n]
+        return data
+
+    @property
+    def in_waiting(self):
+        self.out += self.late
+        self.late.clear()
+        return len(self.out)
+
+    def reset_input_buffer(self):
+        self.out.clear()
+
+    def fileno(self):
+        raise OSError('no file descriptor')
+
+    def close(self):
+        self.closed = True
+
+
+class SerialException(IOError):
+    pass
@@ -0,0 +1,82 @@
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bridge
+
+# the tests run against bridge.Port; pyserial and progressbar are only
+# needed for real boards
+try:
+    import serial
+except ImportError:
+    serial = types.ModuleType('serial')
+    serial.SerialException = bridge.SerialException
+    sys.modules['serial'] = serial
+serial.Serial = bridge.Port
+serial.SerialException = bridge.SerialException
+
+try:
+    import progressbar
+except ImportError:
+    progressbar = types.ModuleType('progressbar')
+
+    class ProgressBar:
+        def __init__(self, max_value = None, **kwargs):
+            pass
+
+        def start(self):
+            return self
+
+        def update(self, value):
+            pass
+
+        def finish(self):
+            pass
+    progressbar.ProgressBar = ProgressBar
+    sys.modules['progressbar'] = progressbar
+
+import journal
+from flash import Flash
+
+# the typical times scaled down, their ratios drive the erase plan;
+# bridge.Chip is busy for a number of polls and not for a time, done by the
+# first poll unless a test asks otherwise, so neither the plan nor a
+# BusyTimeout depends on the load of the host
+TIME_SCALE = 0.01
+
+
+@pytest.fixture(autouse = True)
+def state(tmp_path, monkeypatch):
+    ## journals, indexes and device caches go to a fresh directory
+    monkeypatch.setattr(journal, 'STATE_DIR', str(tmp_path / 'state'))
+    return tmp_path / 'state'
+
+
+@pytest.fixture
+def chip():
+    chip = bridge.Chip()
+    bridge.PORTS['test'] = chip
+    yield chip
+    bridge.PORTS.pop('test', None)
+
+
+def open_flash(port = 'test'):
+    flash = Flash()
+    flash.verbose = False
+    flash.timeout = 0.05
+    flash.open(port)
+    for op, (typ, tmax) in Flash.TIMINGS.items():
+        flash.timings[op] = [typ * TIME_SCALE, tmax]
+    return flash
+
+
+@pytest.fixture
+def flash(chip):
+    flash = open_flash()
+    yield flash
+    flash.port.close()
@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+import pytest
+
+import bridge
+from asyncflash import AsyncFlash
+from flash import FlashError
+from image import Image
+
+from test_write import pattern
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def open_async():
+    flash = AsyncFlash()
+    flash.timeout = 0.05
+    return flash
+
+
+def test_async_write_and_read(chip):
+    async def session():
+        flash = open_async()
+        await flash.open('test')
+        await flash.erase_range(0x3000, 0x1000)
+        await flash._page_program_async(0x3000, b'async')
+        data = await flash.read(0x3000, 5)
+        flash.port.close()
+        return data
+    assert run(session()) == b'async'
+
+
+def test_inherited_blocking_methods_raise(chip):
+    async def session():
+        flash = open_async()
+        await flash.open('test')
+        try:
+            with pytest.raises(FlashError):
+                list(flash.iter_read(0, 16))
+            with pytest.raises(FlashError):
+                flash.blank_check(0, 0x1000)
+            with pytest.raises(FlashError):
+                flash.unique_id()
+            with pytest.raises(FlashError):
+                flash.write(0, b'x')
+        finally:
+            flash.port.close()
+    run(session())
+
+
+def test_close_after_failed_open(chip, monkeypatch):
+    async def discover(self):
+        raise FlashError('no flash')
+    monkeypatch.setattr(AsyncFlash, '_discover_device_async', discover)
+
+    async def session():
+        flash = open_async()
+        with pytest.raises(FlashError):
+            await flash.open('test')
+        await flash.close()
+        closed = open_async()
+        await closed.close()
+    run(session())
+
+
+def test_async_write_hex_plans_like_flash(flash, chip):
+    ## the same units as Flash.write_hex: one plan per 64K window that
+    ## leaves the gap between the segments alone
+    first = pattern(0x3000)
+    second = pattern(0x4000, 1)
+    segments = [(0, memoryview(first)), (0xB000, memoryview(second))]
+    flash.write_hex(0x40000, Image(segments), None, True)
+    erases = [(op, a) for op, a in chip.log if op in bridge.ERASES]
+    chip.mem[0x40000:0x50000] = bytes(0x10000)
+    del chip.log[:]
+
+    async def session():
+        flash = open_async()
+        await flash.open('test')
+        try:
+            flash.verify = 'image'
+            return await flash.write_hex(0x40000, Image(segments), None, True)
+        finally:
+            flash.port.close()
+    assert run(session()) == len(first) + len(second)
+    assert [(op, a) for op, a in chip.log if op in bridge.ERASES] == erases
+    assert chip.mem[0x40000:0x43000] == first
+    assert chip.mem[0x43000:0x4B000] == bytes(0x8000)
+    assert chip.mem[0x4B000:0x4F000] == second
+
+
+def test_host_stall_before_the_program_is_no_timeout(chip, monkeypatch):
+    ## see test_wait.py
+    chip.busy = 1
+    write = bridge.Port.write
+
+    def stalled(self, data):
+        if len(data) > 3 and data[0] == 0x06 and data[3] == 0x02:
+            time.sleep(0.01)
+        return write(self, data)
+    monkeypatch.setattr(bridge.Port, 'write', stalled)
+
+    async def session():
+        flash = open_async()
+        await flash.open('test')
+        try:
+            flash.timings['page'] = [1e-5, 1e-3]
+            await flash._page_program_async(0x5000, b'stalled')
+        finally:
+            flash.port.close()
+    run(session())
+    assert chip.mem[0x5000:0x5007] == b'stalled'
@@ -0,0 +1,55 @@
+import struct
+
+import pytest
+
+import bridge
+from conftest import open_flash
+from flash import FlashError
+
+from test_write import image, pattern
+
+
+def sfdp_4k_only(size = 4 << 20):
+    ## SFDP table of a part with the 4K erase (0x20) as its only erase type
+    header = b'SFDP' + bytes([6, 1, 0, 0xFF])
+    param = bytes([0x00, 0, 1, 9, 0x10, 0, 0, 0xFF])
+    dwords = [1 | (0x20 << 8), size * 8 - 1, 0, 0, 0, 0, 0, (0x20 << 8) | 12, 0]
+    return header + param + struct.pack('<9I', *dwords)
+
+
+@pytest.fixture
+def small(state):
+    chip = bridge.Chip(sfdp = sfdp_4k_only())
+    bridge.PORTS['small'] = chip
+    flash = open_flash('small')
+    yield flash, chip
+    flash.port.close()
+    bridge.PORTS.pop('small', None)
+
+
+def test_missing_block_erase_falls_back_to_sectors(small):
+    flash, chip = small
+    assert flash.erase_types == {12: 0x20}
+    chip.mem[0x10000:0x20000] = bytes(0x10000)
+    flash.erase_chip_partial(0x10000, 64 * 1024, 1)
+    assert chip.mem[0x10000:0x20000] == b'\xFF' * 0x10000
+    assert set([op for op, a in chip.log]) == set([0x20])
+    with pytest.raises(FlashError):
+        flash._block_erase(0x10000)
+
+
+def test_incremental_64k_units_without_block_erase(small):
+    flash, chip = small
+    chip.mem[0x20000:0x30000] = bytes(0x10000)
+    data = pattern(0x10000)
+    flash.write_hex(0x20000, image(data), 16, True, True)
+    assert chip.mem[0x20000:0x30000] == data
+
+
+def test_plan_erase_uses_blocks_in_the_middle(flash):
+    plan = flash.plan_erase(0x7000, 0x1A000)
+    assert plan == [(0x7000, 'erase_4k'), (0x8000, 'erase_32k'), (0x10000, 'erase_64k'), (0x20000, 'erase_4k')]
+    # blank sectors are left out
+    used = [True] * 16
+    used[8:] = [False] * 8
+    assert flash.plan_erase(0x30000, 0x10000, used) == [(0x30000, 'erase_32k')]
@@ -0,0 +1,99 @@
+import io
+import json
+import threading
+import time
+import types
+
+import pytest
+
+import bridge
+import flash as flash_module
+from flash import Flash, FlashError
+from flashd import op_flash, Daemon, Handler
+
+from test_write import pattern
+
+
+def test_op_flash_restores_verify(flash, tmp_path):
+    path = str(tmp_path / 'a.bin')
+    with open(path, mode='wb') as f:
+        f.write(pattern(0x1000))
+    flash.verify = 'block'
+    result = op_flash(flash, {'path': path, 'address': 0x3000, 'verify': 'none'})
+    assert result['mismatches'] == []
+    assert flash.verify == 'block'
+
+
+def test_failed_open_closes_the_port(chip, monkeypatch):
+    ports = []
+
+    def serial(*args, **kwargs):
+        ports.append(bridge.Port(*args, **kwargs))
+        return ports[-1]
+
+    def discover(self):
+        raise FlashError('no flash')
+    monkeypatch.setattr(flash_module.serial, 'Serial', serial)
+    monkeypatch.setattr(Flash, '_discover_device', discover)
+    flash = Flash()
+    flash.verbose = False
+    with pytest.raises(FlashError):
+        flash.open('test')
+    assert ports[0].closed
+    assert flash.port is None
+
+
+def test_slow_open_holds_only_its_port(chip, monkeypatch):
+    ## the open of 'slow' hangs until the request for 'test' is done
+    bridge.PORTS['slow'] = bridge.Chip()
+    opening = threading.Event()
+    done = threading.Event()
+
+    def serial(port, *args, **kwargs):
+        if port == 'slow':
+            opening.set()
+            done.wait(5)
+        return bridge.Port(port, *args, **kwargs)
+    monkeypatch.setattr(flash_module.serial, 'Serial', serial)
+    daemon = Daemon()
+    slow = threading.Thread(target = daemon.handle, args = ({'op': 'status', 'port': 'slow'},))
+    slow.start()
+    try:
+        opening.wait(5)
+        daemon.handle({'op': 'status', 'port': 'test'})
+        assert slow.is_alive()
+    finally:
+        done.set()
+        slow.join()
+        bridge.PORTS.pop('slow', None)
+        for session in daemon.sessions.values():
+            session.drop()
+
+
+def test_idle_release_leaves_a_busy_session(chip):
+    daemon = Daemon()
+    session = daemon.session('test')
+    session.used -= 10
+    with session.lock:
+        assert not daemon.release('test', 1)
+    session.used = time.time()
+    assert not daemon.release('test', 1)
+    session.used -= 10
+    session.flash.close = lambda: None
+    assert daemon.release('test', 1)
+    assert session.closed
+    # the next request opens the port again
+    assert daemon.session('test') is not session
+    daemon.sessions['test'].drop()
+
+
+def test_every_error_gets_a_response():
+    def handle(request):
+        raise RuntimeError('broken')
+    handler = Handler.__new__(Handler)
+    handler.rfile = io.BytesIO(b'{"op": "ping"}\n{"op": "ping"}\n')
+    handler.wfile = io.BytesIO()
+    handler.server = types.SimpleNamespace(flashd = types.SimpleNamespace(handle = handle))
+    handler.handle()
+    responses = [json.loads(line) for line in handler.wfile.getvalue().splitlines()]
+    assert responses == [{'ok': False, 'error': 'broken', 'type': 'RuntimeError'}] * 2
@@ -0,0 +1,36 @@
+import os
+import runpy
+import sys
+
+import pytest
+
+from flash import Flash
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flasher.py')
+
+
+def run(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['flasher.py'] + list(args))
+    runpy.run_path(SCRIPT, run_name = '__main__')
+
+
+def hexfile(tmp_path):
+    path = str(tmp_path / 'a.hex')
+    with open(path, mode='wt') as f:
+        f.write('01 02 03 04\n')
+    return path
+
+
+def test_verify_mismatch_exits_with_1(chip, tmp_path, monkeypatch):
+    monkeypatch.setattr(Flash, 'verify_image', lambda self, address, image, binfile = None: [(0x1, 0x3)])
+    with pytest.raises(SystemExit) as e:
+        run(monkeypatch, '-p', 'test', '-i', hexfile(tmp_path), '-b', '4')
+    assert e.value.code == 1
+
+
+def test_no_verify_with_verify_none(chip, tmp_path, monkeypatch):
+    def verify_image(self, address, image, binfile = None):
+        raise AssertionError('verified with -V none')
+    monkeypatch.setattr(Flash, 'verify_image', verify_image)
+    run(monkeypatch, '-p', 'test', '-i', hexfile(tmp_path), '-b', '4', '-V', 'none')
+    assert chip.mem[0:4] == b'\x01\x02\x03\x04'
@@ -0,0 +1,30 @@
+import pytest
+
+import bridge
+from conftest import open_flash
+from flash import Flash
+
+
+@pytest.fixture
+def big():
+    chip = bridge.Chip(32 << 20, (0xEF, 0x40, 0x19))
+    bridge.PORTS['big'] = chip
+    yield chip
+    bridge.PORTS.pop('big', None)
+
+
+def test_unique_id(flash, chip):
+    assert flash.unique_id() == chip.uid.hex()
+
+
+@pytest.mark.parametrize('mode', ['dedicated', 'enter'])
+def test_unique_id_in_4_byte_modes(big, mode, monkeypatch):
+    ## the device index and journal keys must not change with the mode
+    monkeypatch.setattr(Flash, '_address_modes', lambda self: [mode])
+    flash = open_flash('big')
+    try:
+        assert flash.address_mode == mode
+        assert big.four == (mode == 'enter')
+        assert flash.unique_id() == big.uid.hex()
+    finally:
+        flash.port.close()
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from image import load_image, detect_format, ImageError, HEX_TEXT, INTEL_HEX, BINARY
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def record(address, payload, rtype = 0):
+    rec = bytes([len(payload), (address >> 8) & 0xFF, address & 0xFF, rtype]) + payload
+    return ':' + (rec + bytes([(-sum(rec)) & 0xFF])).hex().upper() + '\n'
+
+
+def write(tmp_path, name, content):
+    path = str(tmp_path / name)
+    with open(path, mode='wb') as f:
+        f.write(content if isinstance(content, bytes) else content.encode())
+    return path
+
+
+def test_repo_images_are_hex_text():
+    assert detect_format(os.path.join(HERE, 'red.hex')) == HEX_TEXT
+
+
+def test_hex_text_with_comment_and_eof_mark(tmp_path):
+    path = write(tmp_path, 'a.hex', '# build 2020\n01 02 03\nff 00\n\x1a')
+    assert detect_format(path) == HEX_TEXT
+    assert bytes(load_image(path).segments[0][1]) == b'\x01\x02\x03\xff\x00'
+
+
+def test_intel_hex_with_eof_mark(tmp_path):
+    path = write(tmp_path, 'a.hex', '; image\n' + record(0x10, b'\xAA\xBB') + record(0, b'', 1) + '\x1a')
+    assert detect_format(path) == INTEL_HEX
+    image = load_image(path)
+    assert [(offset, bytes(data)) for offset, data in image.segments] == [(0x10, b'\xAA\xBB')]
+
+
+def test_binary(tmp_path):
+    path = write(tmp_path, 'dump.hex', bytes(range(256)))
+    assert detect_format(path) == BINARY
+
+
+def test_ambiguous_text_is_rejected(tmp_path):
+    path = write(tmp_path, 'notes.hex', 'this is not an image\n' + record(0, b'\x01'))
+    with pytest.raises(ImageError):
+        detect_format(path)
+    path = write(tmp_path, 'words.hex', 'hello world\n')
+    with pytest.raises(ImageError):
+        load_image(path)
+
+
+def test_empty_text_is_rejected(tmp_path):
+    for name, content in [('mark.hex', '\x1a01 02 03\n'), ('empty.hex', ''), ('comment.hex', '# nothing\n'),
+                          ('end.hex', record(0, b'', 1))]:
+        path = write(tmp_path, name, content)
+        with pytest.raises(ImageError):
+            load_image(path)
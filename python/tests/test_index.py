@@ -0,0 +1,43 @@
+import bridge
+from devindex import DeviceIndex
+
+from test_write import image, pattern
+
+BASE = 0x40000
+KEPT = 0x41000
+
+
+def test_plan_keeps_sectors_out_of_blocks(flash):
+    plan = flash.plan_erase(BASE, 0x10000)
+    assert plan == [(BASE, 'erase_64k')]
+    plan = flash.plan_erase(BASE, 0x10000, keep = set([KEPT]))
+    covered = [s for a, op in plan for s in range(a, a + (1 << flash.ERASE_SIZES[op]), flash.SECTOR)]
+    assert KEPT not in covered
+    assert sorted(covered) == [s for s in range(BASE, BASE + 0x10000, flash.SECTOR) if s != KEPT]
+
+
+def test_indexed_sector_survives_the_erase_of_its_block(flash, chip):
+    ## every sector of a 64K block changes but one the index has: the
+    ## block is not erased whole, the indexed sector keeps its content
+    index = DeviceIndex(flash.unique_id())
+    first = pattern(0x10000)
+    flash.write_hex(BASE, image(first), None, True, index = index)
+    second = bytearray(pattern(0x10000, 1))
+    second[KEPT - BASE:KEPT - BASE + flash.SECTOR] = first[KEPT - BASE:KEPT - BASE + flash.SECTOR]
+    del chip.log[:]
+    flash.write_hex(BASE, image(bytes(second)), None, True, index = index)
+    assert chip.mem[BASE:BASE + 0x10000] == second
+    for op, a in chip.log:
+        if op in bridge.ERASES:
+            assert not a <= KEPT < a + bridge.ERASES[op]
+        else:
+            assert a & ~0xFFF != KEPT
+
+
+def test_unverified_sectors_are_not_indexed(flash, chip):
+    ## with verify = 'none' only the sectors read back as written are indexed
+    flash.verify = 'none'
+    index = DeviceIndex(flash.unique_id())
+    chip.corrupt[0x61200] = 1
+    flash.write_hex(0x60000, image(pattern(0x3000)), None, True, index = index)
+    assert sorted(index.sectors) == [0x60000, 0x62000]
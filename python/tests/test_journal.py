@@ -0,0 +1,28 @@
+import pytest
+
+from flash import Flash
+from journal import Journal
+
+from test_write import image, pattern
+
+
+def test_interrupted_write_resumes(flash, chip, monkeypatch):
+    data = pattern(0x20000)
+    programmed = []
+    page_program = Flash._page_program
+
+    def interrupted(self, address, block):
+        if len(programmed) == 0x80:
+            raise KeyboardInterrupt()
+        programmed.append(address)
+        page_program(self, address, block)
+    monkeypatch.setattr(Flash, '_page_program', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        flash.write_hex(0x10000, image(data), None, True, journal = Journal())
+    monkeypatch.setattr(Flash, '_page_program', page_program)
+    del chip.log[:]
+    flash.write_hex(0x10000, image(data), None, True, journal = Journal())
+    assert chip.mem[0x10000:0x30000] == data
+    # the erases and blocks of the first run are not repeated
+    assert len([a for op, a in chip.log if op == 0x02]) == 0x200 - 0x80
+    assert [(op, a) for op, a in chip.log if op != 0x02] == [(0xD8, 0x20000)]
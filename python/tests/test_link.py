@@ -0,0 +1,37 @@
+def pattern(size):
+    return bytes([(i * 13 + (i >> 8)) & 0xFF for i in range(size)])
+
+
+def fill(chip, size):
+    data = pattern(size)
+    chip.mem[0:size] = data
+    return data
+
+
+def test_bytes_lost_mid_stream_are_not_accepted(flash, chip):
+    ## the next chunk in flight fills up a chunk that lost bytes, the
+    ## shifted response must be sent again, not returned
+    data = fill(chip, 0x8000)
+    flash.read_chunk = 0x1000
+    flash.port.lose = [3000, 3]
+    assert flash.read(0, 0x8000) == data
+
+
+def test_late_response_keeps_the_complete_frames(flash, chip):
+    data = fill(chip, 1500)
+    port = flash.port
+    port.hold = port.sent + 600
+    frames = port.frames
+    assert flash.read(0, 1500) == data
+    # three reads and the check frame, then the two reads still missing and
+    # the check frame again
+    assert port.frames - frames == 4 + 3
+
+
+def test_lost_bytes_resend_the_whole_batch(flash, chip):
+    data = fill(chip, 1500)
+    port = flash.port
+    port.lose = [port.sent + 600, 2]
+    frames = port.frames
+    assert flash.read(0, 1500) == data
+    assert port.frames - frames == 4 + 4
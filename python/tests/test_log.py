@@ -0,0 +1,13 @@
+import io
+
+from test_write import image
+
+
+def test_messages_go_to_log_file(flash, capsys):
+    ## flash_dump -o - keeps stdout for the dump
+    log = io.StringIO()
+    flash.verbose = True
+    flash.log_file = log
+    flash.write_hex(0, image(b'\x01' * 0x100), None, True)
+    assert capsys.readouterr().out == ''
+    assert 'Writing finished.' in log.getvalue()
@@ -0,0 +1,41 @@
+import time
+
+import pytest
+
+import bridge
+from flash import BusyTimeout
+
+from test_write import image, pattern
+
+
+def test_host_stall_before_the_program_is_no_timeout(flash, chip, monkeypatch):
+    ## the host stalls longer than twice the maximum page time before the
+    ## program frames go out, the part is busy at the first poll after them
+    chip.busy = 1
+    write = bridge.Port.write
+
+    def stalled(self, data):
+        if len(data) > 3 and data[0] == 0x06 and data[3] == 0x02:
+            time.sleep(flash.timings['page'][1] * 3)
+        return write(self, data)
+    monkeypatch.setattr(bridge.Port, 'write', stalled)
+    data = pattern(0x200)
+    flash.write_hex(0x1000, image(data), None, True)
+    assert chip.mem[0x1000:0x1200] == data
+
+
+def test_busy_part_is_polled_until_done(flash, chip):
+    chip.busy = 3
+    for op in flash.timings:
+        # the maximum times do not run out on a loaded host
+        flash.timings[op][1] = 60.0
+    data = pattern(0x2000)
+    flash.write_hex(0x10000, image(data), None, True)
+    assert chip.mem[0x10000:0x12000] == data
+
+
+def test_busy_after_the_maximum_time_is_a_timeout(flash, chip):
+    flash.timings['page'] = [1e-5, 1e-4]
+    chip.busy = 1 << 30
+    with pytest.raises(BusyTimeout):
+        flash._page_program(0x1000, b'\x01' * 16)
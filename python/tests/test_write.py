@@ -0,0 +1,40 @@
+from image import Image
+
+
+def image(data, offset = 0):
+    return Image([(offset, memoryview(data))])
+
+
+def pattern(size, seed = 0):
+    return bytes([(i * 7 + seed) & 0xFF for i in range(size)])
+
+
+def test_write_hex_erases_and_programs(flash, chip):
+    chip.mem[0x10000:0x20000] = bytes(0x10000)
+    data = pattern(0x5000)
+    assert flash.write_hex(0x10000, image(data), None, True) == len(data)
+    assert chip.mem[0x10000:0x15000] == data
+    # the sectors after the image are not erased
+    assert chip.mem[0x15000:0x20000] == bytes(0xB000)
+
+
+def test_block_retry_keeps_the_rest_of_the_sector(flash, chip):
+    ## a page block that fails its CRC is rewritten with its sector, the
+    ## pages programmed before it in the sector survive the erase
+    flash.verify = 'block'
+    data = pattern(0x1000)
+    chip.corrupt[0x2200] = 1
+    flash.write_hex(0x2000, image(data), None, True)
+    assert chip.mem[0x2000:0x3000] == data
+
+
+def test_write_hex_keeps_the_gaps_between_segments(flash, chip):
+    ## two segments in one 64K window: the data between them is not erased
+    chip.mem[0x40000:0x50000] = bytes(0x10000)
+    first = pattern(0x3000)
+    second = pattern(0x4000, 1)
+    flash.write_hex(0x40000, Image([(0, memoryview(first)), (0xB000, memoryview(second))]), None, True)
+    assert chip.mem[0x40000:0x43000] == first
+    assert chip.mem[0x43000:0x4B000] == bytes(0x8000)
+    assert chip.mem[0x4B000:0x4F000] == second
+    assert chip.mem[0x4F000:0x50000] == bytes(0x1000)